@@ -7,3 +7,4 @@ from .agent import run
 from .info import version
 from .pod import init
 from .key import validate, generate
+from .data import backup, export_, import_
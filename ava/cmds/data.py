@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""
+Commands for managing the data of the local pod.
+"""
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+
+import os
+import lmdb
+import click
+
+from ava.runtime import environ
+from ava.runtime import settings
+from ava.spi.context import Context
+from ava.spi.errors import DataError
+from ava.core.data import DataEngine
+from ava.core.data.backup import (copy_to_file, copy_environments,
+                                  copy_tables, environment_names)
+from ava.core.data.frozen import table_paths
+
+from .cli import cli
+
+
+def _start_engine():
+    engine = DataEngine()
+    ctx = Context(None)
+    engine.start(ctx)
+    return engine, ctx
+
+
+@cli.group()
+def data():
+    """ Data management.
+    """
+    pass
+
+
+@data.command()
+@click.argument("dest", type=click.Path())
+@click.option('--no-compact', is_flag=True,
+              help='Copy free pages as well, which is a bit faster.')
+def backup(dest, no_compact=False):
+    """ Back up the data, even while the agent is running. If stores are
+    placed in other environments, sharded or frozen, DEST is a directory
+    which all the environments and frozen tables are copied into.
+    """
+    datapath = os.path.join(environ.pod_dir(), 'data')
+    conf = settings.get('data') or {}
+    tables = table_paths(datapath, (conf.get('frozen') or {}).values())
+    envs = {}
+    try:
+        envs[None] = lmdb.Environment(datapath, readonly=True, create=False)
+        for name in environment_names(datapath):
+            envs[name] = lmdb.Environment(os.path.join(datapath, name),
+                                          readonly=True, create=False)
+    except (lmdb.Error, OSError) as ex:
+        click.echo("Failed to open data: %s" % ex, err=True)
+        for env in envs.values():
+            env.close()
+        return 1
+
+    try:
+        if len(envs) == 1 and not tables:
+            size = copy_to_file(envs[None], dest, compact=not no_compact)
+        else:
+            size = copy_environments(envs, dest, compact=not no_compact)
+            size += copy_tables(datapath, tables, dest)
+    except (lmdb.Error, IOError, OSError, DataError) as ex:
+        click.echo("Failed to back up data: %s" % ex, err=True)
+        return 1
+    finally:
+        for env in envs.values():
+            env.close()
+
+    click.echo("Backed up %d bytes of data to %s." % (size, dest))
+    return 0
+
+
+@data.command('export')
+@click.argument("dest", type=click.File('wb'))
+@click.option('--store', '-s', 'stores', multiple=True,
+              help='A store to export; defaults to all.')
+def export_(dest, stores):
+    """ Export stores to a file, or '-' for the standard output. The agent
+    must be stopped first.
+    """
+    try:
+        engine, ctx = _start_engine()
+    except DataError as ex:
+        click.echo("Failed to open data: %s Is the agent running?" % ex,
+                   err=True)
+        return 1
+
+    try:
+        count = engine.export_stores(dest, [it.encode('utf-8')
+                                            for it in stores] or None)
+    except DataError as ex:
+        click.echo("Failed to export data: %s" % ex, err=True)
+        return 1
+    finally:
+        engine.stop(ctx)
+
+    click.echo("Exported %d records." % count, err=True)
+    return 0
+
+
+@data.command('import')
+@click.argument("src", type=click.File('rb'))
+@click.option('--batch-size', default=10000,
+              help='Records to load in a transaction.')
+def import_(src, batch_size):
+    """ Import stores from a file exported earlier, or '-' for the standard
+    input. The agent must be stopped first.
+    """
+    try:
+        engine, ctx = _start_engine()
+    except DataError as ex:
+        click.echo("Failed to open data: %s Is the agent running?" % ex,
+                   err=True)
+        return 1
+
+    try:
+        count = engine.import_stores(src, batch_size=batch_size)
+    except DataError as ex:
+        click.echo("Failed to import data: %s" % ex, err=True)
+        return 1
+    finally:
+        engine.stop(ctx)
+
+    click.echo("Imported %d records." % count, err=True)
+    return 0
@@ -8,68 +8,1021 @@ Extension packages may provide higher-level APIs based on this.
 from __future__ import (absolute_import, division, unicode_literals)
 
 import os
+import sys
+import time
+import weakref
 import logging
 import lmdb
+import gevent
+from collections import Mapping
+from gevent.queue import Queue, Empty
+from gevent.event import AsyncResult
+from gevent.monkey import get_original
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    import msvcrt
+except ImportError:
+    msvcrt = None
 
 from ava.util import time_uuid
 from ava.runtime import environ
+from ava.runtime import settings
 from ava.spi.errors import DataNotFoundError, DataError
 from ava.spi.stores import IStore, ICursor
+from ava.spi.signals import DATA_MAP_GROWN, AGENT_STARTED, AGENT_STOPPING
+from .queues import Queue as DurableQueue
+from .compression import Compressor, escape, decode
+from .cache import LRUCache, MISSING
+from . import backup as _backup
+from . import transfer as _transfer
+from .expiry import Expiry, deadline_of, now_ms
+from .changes import ChangeLog
+from .timeseries import TimeSeries
+from .sharding import ShardedStore
+from .frozen import FrozenStore
+from . import frozen as _frozen
+from . import analytics as _analytics
 
 _DATA_FILE_DIR = b'data'
 
+# the file locked by the engine using the data path.
+_LOCK_FILE = b'engine.lock'
+
+_CONF_SECTION = 'data'
+
+# databases whose names start with this are internal, not stores.
+_INTERNAL_PREFIX = b'\x1f'
+_INDEX_PREFIX = b'\x1findex\x1f'
+_QUEUE_PREFIX = b'\x1fqueue\x1f'
+_INFLIGHT_PREFIX = b'\x1finflight\x1f'
+_DEADLINE_PREFIX = b'\x1fdeadline\x1f'
+_EXPIRY_PREFIX = b'\x1fexpiry\x1f'
+_CHANGES_DB = b'\x1fchanges'
+_CONSUMERS_DB = b'\x1fconsumers'
+# the indexes written around while they weren't registered.
+_STALE_INDEXES_DB = b'\x1fstale_indexes'
+
+# the directory names of shard environments under the data path.
+_SHARD_ENV_FORMAT = b'shard-%d'
+
+# the directory of frozen tables under the data path.
+_FROZEN_DIR = _frozen.TABLES_DIR
+
+# LMDB options of the durability modes. 'nometasync' syncs the data on
+# commit but not the meta page, so a crash may lose the last commits but
+# not the database's integrity; 'nosync' leaves syncing to the OS.
+# Environments which don't sync fully are flushed periodically.
+_DURABILITY_OPTIONS = {
+    'sync': {},
+    'nometasync': dict(metasync=False),
+    'nosync': dict(sync=False),
+}
+
 logger = logging.getLogger(__name__)
 
+# the identity of the native thread, even if threading is monkey-patched.
+_thread_ident = get_original('thread', 'get_ident')
+
+
+def _lock_data(datapath):
+    """
+    Takes an exclusive lock on a data path, so that no other process, e.g.
+    a data command, runs an engine on the data of a running agent: their
+    counters and caches would diverge.
+
+    :return: the locked file, which is unlocked when it's closed.
+    """
+    if not os.path.isdir(datapath):
+        os.makedirs(datapath)
+    f = open(os.path.join(datapath, _LOCK_FILE), 'a')
+    try:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        elif msvcrt is not None:
+            msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+    except IOError:
+        f.close()
+        raise DataError("The data is in use by another process.")
+    return f
+
+
+def _encode_key(key):
+    if isinstance(key, unicode):
+        return key.encode('utf-8')
+    return key
+
+
+def _parse_counter(value):
+    """
+    Gets the integer of a counter's value, which is kept as decimal digits.
+    """
+    if value is None:
+        return 0
+    try:
+        return int(value)
+    except ValueError:
+        raise DataError("Not a counter: %r" % value[:32])
+
+
+def _prefix_end(prefix):
+    """
+    Gets the lowest key greater than all keys with the given prefix, or None
+    if there is no such key.
+    """
+    prefix = prefix.rstrip(b'\xff')
+    if not prefix:
+        return None
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+def _scan_range(start, stop, prefix):
+    """
+    Narrows the range [start, stop) to the keys with the given prefix.
+    """
+    start = _encode_key(start)
+    stop = _encode_key(stop)
+    if prefix is not None:
+        prefix = _encode_key(prefix)
+        if start is None or start < prefix:
+            start = prefix
+        end = _prefix_end(prefix)
+        if end is not None and (stop is None or end < stop):
+            stop = end
+    return start, stop
+
+
+def _seek_before(cur, key):
+    """
+    Positions the cursor at the highest key lower than the given one, or at
+    the last record if the key is None.
+    """
+    if key is None or not cur.set_range(key):
+        return cur.last()
+    return cur.prev()
+
+
+def _seek_resume(cur, last, reverse, dupsort):
+    """
+    Positions the cursor at the record following the last one visited by a
+    scan in the given direction. Records of a dupsort database are ordered by
+    (key, value) pairs, so `last` is such a pair.
+    """
+    if not dupsort:
+        if reverse:
+            return _seek_before(cur, last)
+        positioned = cur.set_range(last)
+        if positioned and cur.key() == last:
+            positioned = cur.next()
+        return positioned
+
+    key, value = last
+    if cur.set_range_dup(key, value):
+        if reverse:
+            return cur.prev()
+        if cur.value() == value:
+            return cur.next()
+        return True
+
+    # no duplicate of the key sorts at or after the value.
+    if not cur.set_range(key):
+        return cur.last() if reverse else False
+    if cur.key() != key:
+        return cur.prev() if reverse else True
+    return cur.last_dup() if reverse else cur.next_nodup()
+
+
+def _is_open(txn):
+    try:
+        txn.id()
+    except lmdb.Error:
+        return False
+    return True
+
+
+def _abort_quietly(txn):
+    try:
+        txn.abort()
+    except lmdb.Error:
+        pass
+
+
+def _call_capturing(func, args, kwargs):
+    # runs on the threadpool, whose own error handling only logs.
+    try:
+        return True, func(*args, **kwargs)
+    except Exception:
+        return False, sys.exc_info()
+
+
+def _pool_apply(func, args, kwargs):
+    ok, result = gevent.get_hub().threadpool.apply(
+        _call_capturing, (func, args, kwargs))
+    if not ok:
+        raise result[0], result[1], result[2]
+    return result
+
+
+def _fetch_key(txn, key, value):
+    return key
+
+
+def _fetch_value(txn, key, value):
+    return value
+
+
+def _read_batch(env, _db, start, stop, reverse, size, fetch, values,
+                dupsort, last, decode_value, skip):
+    """
+    Reads up to `size` records of a scan in one read transaction.
+
+    :return: a tuple of (items, last, done), where `last` is the position to
+        resume from.
+    """
+    items = []
+    with env.begin(db=_db) as txn:
+        cur = txn.cursor()
+        if last is not None:
+            positioned = _seek_resume(cur, last, reverse, dupsort)
+        elif reverse:
+            positioned = _seek_before(cur, stop)
+        else:
+            positioned = cur.set_range(start) if start else cur.first()
+
+        while positioned:
+            key = cur.key()
+            value = cur.value() if values else None
+            if reverse:
+                if start is not None and key < start:
+                    return items, last, True
+            elif stop is not None and key >= stop:
+                return items, last, True
+
+            last = (key, value) if dupsort else key
+            if skip is not None and skip(txn, key, value):
+                positioned = cur.prev() if reverse else cur.next()
+                continue
+
+            if decode_value and values:
+                value = decode(value)
+            if fetch is None:
+                items.append((key, value))
+            else:
+                items.append(fetch(txn, key, value))
+
+            if len(items) >= size:
+                break
+            positioned = cur.prev() if reverse else cur.next()
+
+    return items, last, not positioned
+
+
+def _scan_db(engine, env, _db, start, stop, reverse=False, limit=None,
+             fetch=None, values=True, dupsort=False, decode_values=False,
+             skip=None):
+    """
+    Streams records of a database in the range [start, stop). Records are
+    read in batches of at most `DataEngine.scan_batch` records, each in a
+    short-lived transaction, and the scan resumes after the last record seen
+    when a transaction is recycled. Batches large enough are read on the
+    threadpool if offloading is enabled.
+
+    :param fetch: a function of (txn, key, value) which gives the item to
+        yield for a record; defaults to the (key, value) pair.
+    :param values: if False, values aren't read and None is passed instead.
+    :param decode_values: whether values are decoded store values.
+    :param skip: a function of (txn, key, value) which tells whether to
+        leave a record out, e.g. an expired one.
+    """
+    values = values or dupsort
+    if start is not None and stop is not None and start >= stop:
+        return
+
+    remaining = limit
+    last = None
+    done = False
+    while not done:
+        size = engine.scan_batch
+        if remaining is not None:
+            size = min(size, remaining)
+        items, last, done = engine.run_heavy(
+            size, _read_batch, env, _db, start, stop, reverse, size,
+            fetch, values, dupsort, last, decode_values, skip)
+
+        for item in items:
+            yield item
+
+        if remaining is not None:
+            remaining -= len(items)
+            if remaining <= 0:
+                return
+
+
+def _index_db_name(store_name, index_name):
+    return _INDEX_PREFIX + store_name + b'\x1f' + index_name
+
+
+class Index(object):
+    """
+    A secondary index of a store. It's kept in a companion database mapping
+    each index key to the keys of the records it's derived from, and updated
+    in the same transaction as the records.
+
+    The key function is called with a record's value and returns an index
+    key, a list of index keys, or None if the record shouldn't be indexed.
+    """
+    def __init__(self, name, key_func, _db, _store):
+        self.name = name
+        self.key_func = key_func
+        self._db = _db
+        self._store = _store
+
+    def index_keys(self, value):
+        if value is None:
+            return set()
+        ret = self.key_func(value)
+        if ret is None:
+            return set()
+        if isinstance(ret, (list, tuple, set, frozenset)):
+            return set(_encode_key(it) for it in ret)
+        return {_encode_key(ret)}
+
+    def update(self, txn, key, old_value, new_value):
+        """
+        Replaces index entries of a record within the given write transaction.
+        """
+        old_keys = self.index_keys(old_value)
+        new_keys = self.index_keys(new_value)
+        for index_key in old_keys - new_keys:
+            txn.delete(index_key, key, db=self._db)
+        for index_key in new_keys - old_keys:
+            txn.put(index_key, key, dupdata=True, db=self._db)
+
+    def find(self, index_key, values=False, limit=None):
+        """
+        Finds the records with the given index key.
+
+        :param index_key: the index key to look up.
+        :param values: whether to include values.
+        :param limit: the maximum number of records.
+        :return: a generator of record keys, or of (key, value) pairs.
+        """
+        index_key = _encode_key(index_key)
+        return self.scan(start=index_key, stop=index_key + b'\x00',
+                         values=values, limit=limit)
+
+    def scan(self, start=None, stop=None, prefix=None, reverse=False,
+             limit=None, values=False):
+        """
+        Finds the records whose index keys are in the range [start, stop), in
+        index order.
+
+        :param start: the first index key, inclusive.
+        :param stop: the last index key, exclusive.
+        :param prefix: only index keys with this prefix.
+        :param reverse: scan from the highest index key downwards.
+        :param limit: the maximum number of records.
+        :param values: whether to include values.
+        :return: a generator of record keys, or of (key, value) pairs.
+        """
+        if values:
+            store_db = self._store._db
+
+            def fetch(txn, index_key, key):
+                return key, decode(txn.get(key, db=store_db))
+        else:
+            fetch = _fetch_value
+
+        skip = None
+        expiry = self._store.expiry
+        if expiry is not None:
+            def skip(txn, index_key, key):
+                return expiry.is_expired(txn, key)
+
+        start, stop = _scan_range(start, stop, prefix)
+        return _scan_db(self._store._engine, self._store._env, self._db, start,
+                        stop, reverse, limit, fetch, dupsort=True, skip=skip)
+
+    def __len__(self):
+        with self._store._env.begin() as txn:
+            return txn.stat(self._db)['entries']
+
 
 class Store(IStore):
-    def __init__(self, name, _db, _engine):
+    def __init__(self, name, _db, _engine, compressor=None, cache=None,
+                 _env=None):
         self.name = name
         self._db = _db
         self._engine = _engine
+        # the LMDB environment keeping the store.
+        self._env = _env or _engine.database
+        self.indexes = {}
+        # values are compressed if set; compressed values are decoded anyway.
+        self.compressor = compressor
+        # an LRUCache in front of get(), if set.
+        self.cache = cache
+        # deadlines of expiring records, once enabled.
+        self.expiry = None
+        # names of the indexes kept from earlier runs which haven't been
+        # created again yet; writes mark them stale meanwhile.
+        self.unregistered_indexes = set()
+        self._stale_db = None
+
+    def _encode(self, value):
+        if self.compressor is None:
+            return escape(value)
+        return self.compressor.encode(value)
+
+    def _invalidate(self, key):
+        if self.cache is not None:
+            self.cache.invalidate(key)
 
     def __len__(self):
-        with self._engine.database.begin() as txn:
+        with self._env.begin() as txn:
             stat = txn.stat(self._db)
             return stat['entries']
 
     def __getitem__(self, key):
-        with self._engine.cursor(self.name) as cur:
-            return cur.get(key)
+        return self.get(key)
 
     def __setitem__(self, key, value):
-        with self._engine.cursor(self.name, readonly=False) as cur:
-            cur.put(key, value)
+        self.put(key, value)
 
     def __delitem__(self, key):
-        with self._engine.cursor(self.name, readonly=False) as cur:
-            cur.remove(key)
+        self.remove(key)
 
     def __iter__(self):
-        return self._engine.cursor(self.name).iternext()
+        return self.scan(values=False)
+
+    def put(self, key, value, ttl=None):
+        """
+        Puts a record.
+
+        :param ttl: seconds after which the record expires; if None, the
+            record doesn't expire, even if it did before.
+        :return: True if written.
+        """
+        if ttl is not None and self.expiry is None:
+            self._engine._enable_expiry(self)
+        if self._engine.coalescer is not None:
+            return self._engine.coalescer.submit('put', self, key, value, ttl)
+
+        with self.cursor(readonly=False) as cur:
+            return cur.put(key, value, ttl)
+
+    def expire(self, key, ttl):
+        """
+        Sets the time to live of an existing record.
 
-    def put(self, key, value):
-        with self._engine.cursor(self.name, readonly=False) as cur:
-            return cur.put(key, value)
+        :param ttl: seconds after which the record expires.
+        :return: False if the record doesn't exist.
+        """
+        if self.expiry is None:
+            self._engine._enable_expiry(self)
+        with self.cursor(readonly=False) as cur:
+            return cur.expire(key, ttl)
+
+    def ttl(self, key):
+        """
+        Gets the remaining time to live of a record.
+
+        :return: the seconds left, or None if the record doesn't exist or
+            doesn't expire.
+        """
+        if self.expiry is None:
+            return None
+        key = _encode_key(key)
+        with self._env.begin() as txn:
+            deadline = self.expiry.deadline(txn, key)
+        if deadline is None:
+            return None
+        return max(deadline - now_ms(), 0) / 1000.0
 
     def get(self, key):
-        with self._engine.cursor(self.name, readonly=True) as cur:
-            return cur.get(key)
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+
+        cache = self.cache
+        if cache is not None:
+            value = cache.get(key)
+            if value is not MISSING:
+                return value
+            version = cache.version
+
+        # a plain transaction lookup avoids setting up a cursor.
+        deadline = None
+        with self._env.begin(db=self._db) as txn:
+            value = decode(txn.get(key))
+            if value is not None and self.expiry is not None:
+                deadline = self.expiry.deadline(txn, key)
+        if deadline is not None:
+            # expiring values aren't cached.
+            return value if deadline > now_ms() else None
+        if cache is not None:
+            cache.put(key, value, version)
+        return value
 
     def remove(self, key):
-        with self._engine.cursor(self.name, readonly=False) as cur:
+        if self._engine.coalescer is not None:
+            return self._engine.coalescer.submit('remove', self, key)
+
+        with self.cursor(readonly=False) as cur:
             return cur.remove(key)
 
-    def cursor(self, readonly=True):
-        return self._engine.cursor(self.name, readonly=readonly)
+    def incr(self, key, delta=1, ttl=None):
+        """
+        Adds to a counter atomically, in one write transaction.
+
+        :param delta: the amount to add, which may be negative.
+        :param ttl: seconds after which the counter expires, set only when
+            it's created, e.g. for the window of a rate limit.
+        :return: the new count.
+        """
+        if ttl is not None and self.expiry is None:
+            self._engine._enable_expiry(self)
+        if self._engine.coalescer is not None:
+            return self._engine.coalescer.submit('incr', self, key, delta,
+                                                 ttl)
+
+        with self.cursor(readonly=False) as cur:
+            return cur.incr(key, delta, ttl)
+
+    def incr_many(self, deltas):
+        """
+        Adds to multiple counters in one write transaction.
+
+        :param deltas: a mapping or an iterable of (key, delta) pairs.
+        :return: a list of the new counts, one for each pair.
+        """
+        if isinstance(deltas, Mapping):
+            deltas = deltas.items()
+        elif self._engine.offload_enabled:
+            deltas = list(deltas)
+
+        size = len(deltas) if isinstance(deltas, list) else 0
+        return self._engine.run_heavy_write(self._env, size, self._incr_many,
+                                            deltas)
+
+    def _incr_many(self, deltas):
+        with self._engine.batch() as batch:
+            for key, delta in deltas:
+                batch.incr(self, key, delta)
+        return batch.results
+
+    def compare_and_swap(self, key, expected, new):
+        """
+        Replaces the value of a record atomically if it's the expected one.
+
+        :param expected: the expected value, or None if the record is
+            expected not to exist.
+        :param new: the new value, or None to remove the record.
+        :return: True if the value was replaced.
+        """
+        if self._engine.coalescer is not None:
+            return self._engine.coalescer.submit('compare_and_swap', self,
+                                                 key, expected, new)
+
+        with self.cursor(readonly=False) as cur:
+            return cur.compare_and_swap(key, expected, new)
+
+    def update(self, key, func):
+        """
+        Replaces the value of a record with the result of a function of it,
+        in one write transaction. The function runs while the writer lock
+        is held, so it should be quick.
+
+        :param func: a function of the current value, or of None if the
+            record doesn't exist, which returns the new value, or None to
+            remove the record.
+        :return: the new value.
+        """
+        with self.cursor(readonly=False) as cur:
+            return cur.update(key, func)
+
+    def cursor(self, readonly=True, buffers=False):
+        _txn = self._engine._begin(self._env, write=not readonly,
+                                   buffers=buffers)
+        return Cursor(_txn, self._db, _readonly=readonly, _store=self)
+
+    def read_view(self, buffers=True):
+        """
+        Opens a read-only cursor which keeps its transaction open for a batch
+        of lookups. With `buffers` on, values are returned as buffers into the
+        memory map instead of copies; they are valid only until the view
+        exits.
+
+        :param buffers: whether to return values without copying.
+        :return: the cursor, to be used as a context manager.
+        """
+        return self.cursor(readonly=True, buffers=buffers)
+
+    def open_value(self, key):
+        """
+        Opens the value of a record for streaming without copying it out of
+        the memory map. The result can be returned directly as a WSGI
+        response body; the read transaction is released when it's closed.
+
+        :param key: the record's key.
+        :return: a ValueStream, or None if the record doesn't exist.
+        """
+        cur = self.read_view(buffers=True)
+        cur.__enter__()
+        try:
+            value = cur.get(key)
+        except:
+            cur.__exit__(None, None, None)
+            raise
+
+        if value is None:
+            cur.__exit__(None, None, None)
+            return None
+        return ValueStream(cur, value)
+
+    def scan(self, start=None, stop=None, prefix=None, reverse=False,
+             limit=None, keys=True, values=True):
+        """
+        Streams records in key order. Records are read in short-lived
+        transactions of at most `DataEngine.scan_batch` records each, and
+        the scan resumes after the last key seen when a transaction is
+        recycled. Hence, a long scan doesn't pin a reader slot, but it may
+        observe writes made while it's running.
+
+        :param start: the first key, inclusive.
+        :param stop: the last key, exclusive.
+        :param prefix: only keys with this prefix.
+        :param reverse: scan from the highest key downwards.
+        :param limit: the maximum number of records.
+        :param keys: whether to include keys.
+        :param values: whether to include values.
+        :return: a generator of (key, value) pairs, or of keys or values only
+            if the other is excluded.
+        """
+        if keys and values:
+            fetch = None
+        elif values:
+            fetch = _fetch_value
+        else:
+            fetch = _fetch_key
+
+        skip = None
+        expiry = self.expiry
+        if expiry is not None:
+            def skip(txn, key, value):
+                return expiry.is_expired(txn, key)
+
+        start, stop = _scan_range(start, stop, prefix)
+        return _scan_db(self._engine, self._env, self._db, start, stop,
+                        reverse, limit, fetch, values=values,
+                        decode_values=True, skip=skip)
+
+    def count(self, start=None, stop=None, prefix=None):
+        """
+        Counts the records in the range [start, stop) exactly, in one read
+        transaction. Keys are passed over as buffers into the memory map and
+        values aren't read; the count of a whole store comes from the
+        B-tree's stats. Ranges estimated to be large are counted on the
+        threadpool if offloading is enabled.
+
+        :return: the number of records.
+        """
+        start, stop = _scan_range(start, stop, prefix)
+        if start is None and stop is None and self.expiry is None:
+            return len(self)
+        if start is not None and stop is not None and start >= stop:
+            return 0
+        size = self.approx_count(start, stop)
+        return self._engine.run_heavy(size, self._count, start, stop)
+
+    def _count(self, start, stop):
+        expiry = self.expiry
+        stop = buffer(stop) if stop is not None else None
+        count = 0
+        with self._env.begin(db=self._db, buffers=True) as txn:
+            cur = txn.cursor()
+            if not (cur.set_range(start) if start else cur.first()):
+                return 0
+            for key in cur.iternext(values=False):
+                if stop is not None and key >= stop:
+                    break
+                if expiry is None or not expiry.is_expired(txn, key):
+                    count += 1
+        return count
+
+    def approx_count(self, start=None, stop=None, prefix=None):
+        """
+        Estimates the number of records in the range [start, stop) from the
+        B-tree's entry count and where the range falls between the first
+        and last keys, without scanning. It assumes keys are spread evenly
+        over the key space; records which have expired but haven't been
+        removed yet are counted.
+
+        :return: the estimated number of records.
+        """
+        start, stop = _scan_range(start, stop, prefix)
+        with self._env.begin(db=self._db) as txn:
+            entries = txn.stat(self._db)['entries']
+            if start is None and stop is None:
+                return entries
+            cur = txn.cursor()
+            if not cur.first():
+                return 0
+            first = cur.key()
+            cur.last()
+            last = cur.key()
+        fraction = _analytics.key_fraction(first, last, start, stop)
+        return int(round(entries * fraction))
+
+    def first_key(self, start=None, stop=None, prefix=None):
+        """
+        Gets the lowest key in the range [start, stop) without reading
+        values.
+
+        :return: the key, or None if the range is empty.
+        """
+        return self._edge_key(start, stop, prefix, reverse=False)
+
+    def last_key(self, start=None, stop=None, prefix=None):
+        """
+        Gets the highest key in the range [start, stop) without reading
+        values.
+
+        :return: the key, or None if the range is empty.
+        """
+        return self._edge_key(start, stop, prefix, reverse=True)
+
+    def _edge_key(self, start, stop, prefix, reverse):
+        start, stop = _scan_range(start, stop, prefix)
+        expiry = self.expiry
+        with self._env.begin(db=self._db) as txn:
+            cur = txn.cursor()
+            if reverse:
+                positioned = _seek_before(cur, stop)
+            else:
+                positioned = cur.set_range(start) if start else cur.first()
+            while positioned:
+                key = cur.key()
+                if reverse:
+                    if start is not None and key < start:
+                        return None
+                elif stop is not None and key >= stop:
+                    return None
+                if expiry is None or not expiry.is_expired(txn, key):
+                    return key
+                positioned = cur.prev() if reverse else cur.next()
+        return None
+
+    def remove_range(self, start=None, stop=None, prefix=None):
+        """
+        Removes the records in the range [start, stop), in transactions of
+        at most `DataEngine.scan_batch` records each, yielding to other
+        greenlets in between.
+
+        :param start: the first key, inclusive.
+        :param stop: the last key, exclusive.
+        :param prefix: only keys with this prefix.
+        :return: the number of records removed.
+        """
+        start, stop = _scan_range(start, stop, prefix)
+        count = 0
+        while True:
+            keys = self._engine.write_to(self._env, self._remove_batch, start,
+                                         stop, self._engine.scan_batch)
+            for key in keys:
+                self._invalidate(key)
+            if keys:
+                self._engine._notify_changes()
+            count += len(keys)
+            if len(keys) < self._engine.scan_batch:
+                return count
+            gevent.sleep(0)
+
+    def _remove_batch(self, txn, start, stop, limit):
+        cur = Cursor(txn, self._db, _readonly=False, _store=self)
+        keys = []
+        positioned = cur.seek_range(start) if start else cur.first()
+        while positioned and len(keys) < limit:
+            key = cur.key()
+            if stop is not None and key >= stop:
+                break
+            keys.append(key)
+            positioned = cur.next()
+        for key in keys:
+            cur._apply('delete', key, None)
+        return keys
+
+    def create_index(self, name, key_func, rebuild=False):
+        """
+        Creates a secondary index, or attaches to the one created earlier
+        with the same name. Index definitions aren't persisted, so they
+        should be created again whenever the agent starts; if the store is
+        written before then, the index is rebuilt when it's created.
+
+        :param name: the index name.
+        :param key_func: a function of a record's value which returns an
+            index key, a list of index keys, or None.
+        :param rebuild: rebuild an existing index, e.g. when the key function
+            has changed.
+        :return: the index.
+        """
+        return self._engine.create_index(self.name, name, key_func,
+                                         rebuild=rebuild)
+
+    def get_index(self, name):
+        return self.indexes.get(_encode_key(name))
+
+    def drop_index(self, name):
+        return self._engine.drop_index(self.name, name)
+
+    def put_many(self, items):
+        """
+        Puts multiple records in one write transaction.
+
+        :param items: a mapping or an iterable of (key, value) pairs.
+        :return: a list of results, one for each item.
+        """
+        if isinstance(items, Mapping):
+            items = items.items()
+        elif self._engine.offload_enabled:
+            items = list(items)
+
+        size = len(items) if isinstance(items, list) else 0
+        return self._engine.run_heavy_write(self._env, size, self._put_many,
+                                            items)
+
+    def _put_many(self, items):
+        with self._engine.batch() as batch:
+            for key, value in items:
+                batch.put(self, key, value)
+        return batch.results
+
+    def remove_many(self, keys):
+        """
+        Removes multiple records in one write transaction.
+
+        :param keys: an iterable of keys.
+        :return: a list of results, one for each key.
+        """
+        if self._engine.offload_enabled:
+            keys = list(keys)
+
+        size = len(keys) if isinstance(keys, list) else 0
+        return self._engine.run_heavy_write(self._env, size,
+                                            self._remove_many, keys)
+
+    def _remove_many(self, keys):
+        with self._engine.batch() as batch:
+            for key in keys:
+                batch.remove(self, key)
+        return batch.results
 
 
 class Cursor(ICursor):
-    def __init__(self, _txn, _db, _readonly=True):
+    def __init__(self, _txn, _db, _readonly=True, _store=None, _batch=None):
 
         self._txn = _txn
         self._db = _db
         self._readonly = _readonly
+        self._store = _store
         self._cursor = lmdb.Cursor(_db, _txn)
+        # the batch or snapshot owning the transaction, if any; otherwise,
+        # the cursor owns it and logs its writes for replaying them if the
+        # map is full.
+        self._batch = _batch
+        self._log = []
+
+    def _rebind(self, _txn):
+        self._txn = _txn
+        self._cursor = lmdb.Cursor(self._db, _txn)
+
+    def _write(self, op, key, value=None):
+        """
+        Applies a logged write. If the map is full, it's grown and the
+        transaction is started over by replaying the log.
+        """
+        while True:
+            try:
+                ret = self._apply(op, key, value)
+                break
+            except lmdb.MapFullError:
+                self._recover()
+
+        if self._batch is not None:
+            self._batch._log.append((self._store, op, key, value))
+        else:
+            self._log.append((op, key, value))
+        return ret
+
+    def _apply(self, op, key, value):
+        if self._store is not None:
+            self._store._invalidate(key)
+        if op == 'put':
+            self._on_put(key, value)
+            return self._cursor.put(key, self._encode(value))
+        if op == 'expire':
+            if not self._cursor.set_key(key):
+                return False
+            self._store.expiry.set(self._txn, key, value)
+            return True
+        if op == 'append':
+            # the key is new if it's appended at all.
+            ret = self._cursor.put(key, self._encode(value), append=True)
+            if ret:
+                self._on_insert(key, value)
+            return ret
+
+        if not self._cursor.set_key(key):
+            return None
+        value = decode(self._cursor.value())
+        self._cursor.delete(True)
+        self._on_delete(key, value)
+        return value
+
+    def _recover(self):
+        if self._batch is not None:
+            return self._batch._recover()
+        if self._store is None:
+            raise DataError("Map is full.")
+
+        engine = self._store._engine
+        _abort_quietly(self._txn)
+        while True:
+            self._rebind(engine._regrow(self._store._env))
+            try:
+                for op, key, value in self._log:
+                    self._apply(op, key, value)
+                return
+            except lmdb.MapFullError:
+                self._txn.abort()
+
+    def _encode(self, value):
+        if self._store is None:
+            return escape(value)
+        return self._store._encode(value)
+
+    def _record(self, key, op):
+        engine = self._store._engine
+        # the change log can't be enabled with other environments.
+        if engine.changes is not None and self._store._env is engine.database:
+            engine.changes.record(self._txn, self._store.name, key, op)
+
+    def _mark_stale_indexes(self):
+        """
+        Records that indexes which aren't registered have missed a write,
+        so they're rebuilt when they're created again.
+        """
+        store = self._store
+        for name in store.unregistered_indexes:
+            self._txn.put(_index_db_name(store.name, name), b'',
+                          db=store._stale_db)
+
+    def _on_insert(self, key, value):
+        """
+        Keeps the store's indexes in step with a new record.
+        """
+        if self._store is None:
+            return
+        self._record(key, 'put')
+        self._mark_stale_indexes()
+        if not self._store.indexes:
+            return
+        for index in self._store.indexes.values():
+            index.update(self._txn, key, None, value)
+
+    def _on_put(self, key, value):
+        """
+        Keeps the store's indexes in step with a record about to be written,
+        and clears its deadline.
+        """
+        if self._store is None:
+            return
+        self._record(key, 'put')
+        self._mark_stale_indexes()
+        if self._store.expiry is not None:
+            self._store.expiry.clear(self._txn, key)
+        if not self._store.indexes:
+            return
+        old_value = decode(self._txn.get(key, db=self._db))
+        for index in self._store.indexes.values():
+            index.update(self._txn, key, old_value, value)
+
+    def _on_delete(self, key, value):
+        """
+        Keeps the store's indexes in step with a deleted record, and clears
+        its deadline.
+        """
+        if self._store is None:
+            return
+        self._record(key, 'delete')
+        self._mark_stale_indexes()
+        if self._store.expiry is not None:
+            self._store.expiry.clear(self._txn, key)
+        if not self._store.indexes:
+            return
+        for index in self._store.indexes.values():
+            index.update(self._txn, key, value, None)
 
     def __enter__(self, *args, **kwargs):
         self._txn.__enter__(*args, **kwargs)
@@ -77,8 +1030,37 @@ class Cursor(ICursor):
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self._cursor.__exit__(exc_type, exc_val, exc_tb)
-        self._txn.__exit__(exc_type, exc_val, exc_tb)
+        if self._batch is not None:
+            return
+        if exc_type is not None:
+            # the transaction may be gone if the map couldn't be grown.
+            _abort_quietly(self._txn)
+            return self._invalidate_logged()
+        if self._readonly:
+            return self._txn.__exit__(exc_type, exc_val, exc_tb)
+
+        try:
+            while True:
+                try:
+                    self._txn.commit()
+                    break
+                except lmdb.MapFullError:
+                    # the failed commit has aborted the transaction already.
+                    self._recover()
+        finally:
+            self._invalidate_logged()
+        if self._log and self._store is not None:
+            self._store._engine._notify_changes()
+
+    def _invalidate_logged(self):
+        """
+        Invalidates cached values of the keys written, once the transaction
+        has ended, in case a read raced with it.
+        """
+        if self._store is None or self._store.cache is None:
+            return
+        for _, key, _ in self._log:
+            self._store.cache.invalidate(key)
 
     def first(self):
         return self._cursor.first()
@@ -93,32 +1075,46 @@ class Cursor(ICursor):
         return self._cursor.last()
 
     def iternext(self, keys=True, values=False):
-        return self._cursor.iternext(keys=True, values=False)
+        return self._decode_items(
+            self._cursor.iternext(keys=keys, values=values), keys, values)
 
     def iterprev(self, keys=True, values=False):
-        return self._cursor.iterprev(keys=True, values=False)
+        return self._decode_items(
+            self._cursor.iterprev(keys=keys, values=values), keys, values)
+
+    @staticmethod
+    def _decode_items(it, keys, values):
+        if not values:
+            return it
+        if not keys:
+            return (decode(value) for value in it)
+        return ((key, decode(value)) for key, value in it)
 
     def close(self):
         self._cursor.close()
 
     def value(self):
         """
-        Gets raw value of the record.
+        Gets value of the record.
         :return: record's value.
         """
-        return self._cursor.value()
+        return decode(self._cursor.value())
 
     def key(self):
         return self._cursor.key()
 
+    def _is_expired(self, key):
+        return (self._store is not None and self._store.expiry is not None and
+                self._store.expiry.is_expired(self._txn, key))
+
     def get(self, key):
         if isinstance(key, unicode):
             key = key.encode('utf-8')
 
-        if not self._cursor.set_key(key):
+        if not self._cursor.set_key(key) or self._is_expired(key):
             return None
 
-        return self._cursor.value()
+        return decode(self._cursor.value())
 
     def load(self, key):
         """
@@ -136,7 +1132,8 @@ class Cursor(ICursor):
         Actually deletes document and its revisions if required.
         :return:
         """
-        return self._cursor.delete(True)
+        key = self._cursor.key()
+        return self._write('delete', key) is not None
 
     def remove(self, key):
         """
@@ -147,10 +1144,7 @@ class Cursor(ICursor):
         if isinstance(key, unicode):
             key = key.encode('utf-8')
 
-        if not self._cursor.set_key(key):
-            return False
-
-        return self._cursor.delete(True)
+        return self._write('delete', key) is not None
 
     def seek(self, key):
         """
@@ -187,7 +1181,7 @@ class Cursor(ICursor):
 
     def post(self, value):
         key = time_uuid.utcnow().hex
-        if self._cursor.put(key, value):
+        if self._write('put', key, value):
             return key
         return None
 
@@ -198,72 +1192,1487 @@ class Cursor(ICursor):
         :return:
         """
         if self._cursor.first():
-            return self._cursor.pop(self._cursor.key())
+            return self._write('delete', self._cursor.key())
 
-    def put(self, key, value):
+    def put(self, key, value, ttl=None):
+        """
+        Puts a record.
+
+        :param ttl: seconds after which the record expires; expiry must have
+            been enabled for the store.
+        :return: True if written.
+        """
         if isinstance(key, unicode):
             key = key.encode('utf-8')
+        if ttl is not None:
+            self._check_expiry()
 
-        return self._cursor.put(key, value)
+        ret = self._write('put', key, value)
+        if ttl is not None:
+            self._write('expire', key, deadline_of(ttl))
+        return ret
+
+    def expire(self, key, ttl):
+        """
+        Sets the time to live of an existing record. Expiry must have been
+        enabled for the store, as it can't be within a transaction.
+
+        :param ttl: seconds after which the record expires.
+        :return: False if the record doesn't exist.
+        """
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        self._check_expiry()
+
+        return self._write('expire', key, deadline_of(ttl))
+
+    def _check_expiry(self):
+        if self._store is None or self._store.expiry is None:
+            raise DataError("Expiry isn't enabled for the store.")
+
+    def append(self, key, value):
+        """
+        Puts a record whose key is greater than any key in the store, which
+        is faster than put() when loading records in key order.
+
+        :return: False if the key isn't greater than the last one.
+        """
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+
+        return self._write('append', key, value)
 
     def exists(self, key):
         if isinstance(key, unicode):
             key = key.encode('utf-8')
 
         if self._cursor.set_key(key):
-            return True
+            return not self._is_expired(key)
         return False
 
+    def _replace(self, key, old_value, new_value):
+        """
+        Writes the outcome of a read-modify-write. The record keeps its
+        deadline, if any.
+        """
+        if new_value is None:
+            if old_value is not None:
+                self._write('delete', key)
+            return
+        if new_value == old_value:
+            return
+        deadline = None
+        if old_value is not None and self._store is not None and \
+                self._store.expiry is not None:
+            deadline = self._store.expiry.deadline(self._txn, key)
+        self._write('put', key, new_value)
+        if deadline is not None:
+            self._write('expire', key, deadline)
+
+    def update(self, key, func):
+        """
+        Replaces the value of a record with the result of a function of it,
+        within the cursor's transaction.
+
+        :param func: a function of the current value, or of None if the
+            record doesn't exist, which returns the new value, or None to
+            remove the record.
+        :return: the new value.
+        """
+        key = _encode_key(key)
+        old_value = self.get(key)
+        new_value = func(old_value)
+        self._replace(key, old_value, new_value)
+        return new_value
+
+    def compare_and_swap(self, key, expected, new):
+        """
+        Replaces the value of a record if it's the expected one.
+
+        :param expected: the expected value, or None if the record is
+            expected not to exist.
+        :param new: the new value, or None to remove the record.
+        :return: True if the value was replaced.
+        """
+        key = _encode_key(key)
+        old_value = self.get(key)
+        if old_value != expected:
+            return False
+        self._replace(key, old_value, new)
+        return True
+
+    def incr(self, key, delta=1, ttl=None):
+        """
+        Adds to a counter, which is kept as decimal digits and starts from
+        zero if the record doesn't exist.
+
+        :param delta: the amount to add, which may be negative.
+        :param ttl: seconds after which the counter expires, set only when
+            it's created; expiry must have been enabled for the store.
+        :return: the new count.
+        """
+        key = _encode_key(key)
+        if ttl is not None:
+            self._check_expiry()
+        old_value = self.get(key)
+        count = _parse_counter(old_value) + delta
+        self._replace(key, old_value, b'%d' % count)
+        if ttl is not None and old_value is None:
+            self._write('expire', key, deadline_of(ttl))
+        return count
+
+
+class ValueStream(object):
+    """
+    An iterable over a value in the memory map, which can be used as a WSGI
+    response body. The cursor's transaction is kept open until the stream
+    is closed. Chunks are memoryviews, so the response should carry a
+    Content-Length of len(stream) to let the server send them unframed.
+    """
+    def __init__(self, _cursor, value, chunk_size=65536):
+        self._cursor = _cursor
+        self._value = memoryview(value)
+        self.chunk_size = chunk_size
+
+    def __len__(self):
+        return len(self._value)
+
+    def __iter__(self):
+        size = len(self._value)
+        for offset in xrange(0, size, self.chunk_size):
+            yield self._value[offset:offset + self.chunk_size]
+
+    def close(self):
+        if self._cursor is not None:
+            self._value = memoryview(b'')
+            self._cursor.__exit__(None, None, None)
+            self._cursor = None
+
+
+class Batch(object):
+    """
+    Collects mutations to one or more stores and applies them in a single
+    write transaction. The transaction is committed when the batch exits
+    normally; otherwise, it's aborted and none of the mutations take effect.
+    If the map gets full, it's grown and the mutations are replayed in a new
+    transaction. The transaction is begun in the environment of the first
+    store written, and all the stores must share it.
+    """
+    def __init__(self, _engine):
+        self._engine = _engine
+        self._env = None
+        self._txn = None
+        self._cursors = {}
+        self._log = []
+        self.results = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self._txn is None:
+            return
+        try:
+            if exc_type is not None:
+                # the transaction may be gone if the map couldn't be grown.
+                return _abort_quietly(self._txn)
+            while True:
+                try:
+                    self._txn.commit()
+                    break
+                except lmdb.MapFullError:
+                    self._recover()
+            if self._log:
+                self._engine._notify_changes()
+        finally:
+            # invalidates cached values in case a read raced with the
+            # transaction.
+            for store, _, key, _ in self._log:
+                store._invalidate(key)
+            self._cursors.clear()
+            self._txn = None
+
+    def _recover(self):
+        _abort_quietly(self._txn)
+        while True:
+            self._txn = self._engine._regrow(self._env)
+            for cur in self._cursors.values():
+                cur._rebind(self._txn)
+            try:
+                for store, op, key, value in self._log:
+                    self._cursors[store]._apply(op, key, value)
+                return
+            except lmdb.MapFullError:
+                self._txn.abort()
+
+    def cursor(self, store_name):
+        """
+        Gets a cursor bound to the batch's transaction.
+
+        :param store_name: the name of an existing store, or the store.
+        :return: the cursor.
+        """
+        if isinstance(store_name, Store):
+            store = store_name
+        else:
+            store = self._engine.get_store(_encode_key(store_name),
+                                           create=False)
+            if store is None:
+                raise DataNotFoundError(store_name)
+            if not isinstance(store, Store):
+                raise DataError("Only LMDB stores can join a batch.")
+
+        cur = self._cursors.get(store)
+        if cur is None:
+            if self._txn is None:
+                self._env = store._env
+                self._txn = self._engine._begin(self._env, write=True)
+            elif store._env is not self._env:
+                raise DataError("Stores in a batch must share an environment.")
+            cur = Cursor(self._txn, store._db, _readonly=False, _store=store,
+                         _batch=self)
+            self._cursors[store] = cur
+        return cur
+
+    def put(self, store_name, key, value, ttl=None):
+        ret = self.cursor(store_name).put(key, value, ttl)
+        self.results.append(ret)
+        return ret
+
+    def append(self, store_name, key, value):
+        ret = self.cursor(store_name).append(key, value)
+        self.results.append(ret)
+        return ret
+
+    def remove(self, store_name, key):
+        ret = self.cursor(store_name).remove(key)
+        self.results.append(ret)
+        return ret
+
+    def post(self, store_name, value):
+        ret = self.cursor(store_name).post(value)
+        self.results.append(ret)
+        return ret
+
+    def incr(self, store_name, key, delta=1, ttl=None):
+        ret = self.cursor(store_name).incr(key, delta, ttl)
+        self.results.append(ret)
+        return ret
+
+    def compare_and_swap(self, store_name, key, expected, new):
+        ret = self.cursor(store_name).compare_and_swap(key, expected, new)
+        self.results.append(ret)
+        return ret
+
+    def update(self, store_name, key, func):
+        ret = self.cursor(store_name).update(key, func)
+        self.results.append(ret)
+        return ret
+
+
+class Snapshot(object):
+    """
+    A read-only transaction shared by lookups in one or more stores, which
+    see a consistent snapshot of them. The transaction is begun in the
+    environment of the first store read, and all the stores must share it.
+    It's released when the snapshot exits.
+    """
+    def __init__(self, _engine, buffers=True):
+        self._engine = _engine
+        self._buffers = buffers
+        self._env = None
+        self._txn = None
+        self._cursors = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        if self._txn is None:
+            return
+        for cur in self._cursors.values():
+            cur._cursor.close()
+        self._cursors.clear()
+        _abort_quietly(self._txn)
+        self._txn = None
+
+    def cursor(self, store_name):
+        """
+        Gets a cursor bound to the view's transaction. It's closed along
+        with the view, so it shouldn't be used as a context manager.
+
+        :param store_name: the name of an existing store, or the store.
+        :return: the cursor.
+        """
+        if isinstance(store_name, Store):
+            store = store_name
+        else:
+            store = self._engine.get_store(_encode_key(store_name),
+                                           create=False)
+            if store is None:
+                raise DataNotFoundError(store_name)
+            if not isinstance(store, Store):
+                raise DataError("Only LMDB stores can join a snapshot.")
+
+        cur = self._cursors.get(store)
+        if cur is None:
+            if self._txn is None:
+                self._env = store._env
+                self._txn = self._engine._begin(self._env,
+                                                buffers=self._buffers)
+            elif store._env is not self._env:
+                raise DataError("Stores in a snapshot must share an "
+                                "environment.")
+            cur = Cursor(self._txn, store._db, _readonly=True, _store=store,
+                         _batch=self)
+            self._cursors[store] = cur
+        return cur
+
+    def __getitem__(self, store_name):
+        return self.cursor(store_name)
+
+    def get(self, store_name, key):
+        return self.cursor(store_name).get(key)
+
+    def exists(self, store_name, key):
+        return self.cursor(store_name).exists(key)
+
+    def scan(self, store_name, start=None, stop=None, prefix=None,
+             reverse=False, limit=None, keys=True, values=True):
+        """
+        Streams records of a store in key order, within the view's
+        transaction. Unlike Store.scan(), it holds the snapshot however long
+        it runs, so it's meant for short ranges.
+
+        :return: a generator of (key, value) pairs, or of keys or values only
+            if the other is excluded.
+        """
+        cur = self.cursor(store_name)
+        start, stop = _scan_range(start, stop, prefix)
+        if start is not None and stop is not None and start >= stop:
+            return
+        # a cursor of its own, so the store's cursor keeps its position.
+        it = self._txn.cursor(cur._db)
+        if reverse:
+            positioned = _seek_before(it, stop)
+        else:
+            positioned = it.set_range(start) if start else it.first()
+
+        count = 0
+        while positioned and (limit is None or count < limit):
+            key = it.key()
+            if reverse:
+                if start is not None and key < start:
+                    return
+            elif stop is not None and key >= stop:
+                return
+            if not cur._is_expired(key):
+                count += 1
+                if keys and values:
+                    yield key, decode(it.value())
+                elif values:
+                    yield decode(it.value())
+                else:
+                    yield key
+            positioned = it.prev() if reverse else it.next()
+
+
+class WriteCoalescer(object):
+    """
+    Gathers write requests from concurrent greenlets and applies them in
+    group commits. A request waits at most `max_delay` seconds for others to
+    join its transaction, and a transaction holds at most `max_batch`
+    requests. Every caller is woken up with the result of its own request.
+    """
+    _STOP = object()
+
+    def __init__(self, _engine, max_delay=0.002, max_batch=1000):
+        self._engine = _engine
+        self.max_delay = max_delay
+        self.max_batch = max_batch
+        self.commits = 0
+        self._queue = Queue()
+        self._greenlet = None
+
+    def start(self):
+        self._greenlet = gevent.spawn(self._run)
+
+    def stop(self):
+        """
+        Applies the pending requests and stops the background greenlet.
+        """
+        if self._greenlet is not None:
+            self._queue.put(self._STOP)
+            self._greenlet.join()
+            self._greenlet = None
+
+    def submit(self, op, store, *args):
+        """
+        Queues a write request and waits until it's committed.
+
+        :param op: the batch operation, e.g. 'put' or 'remove'.
+        :param store: the store.
+        :return: the result of the operation.
+        """
+        result = AsyncResult()
+        self._queue.put((op, store, args, result))
+        return result.get()
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is self._STOP:
+                break
+
+            pending = [item]
+            deadline = time.time() + self.max_delay
+            while len(pending) < self.max_batch:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except Empty:
+                    break
+                if item is self._STOP:
+                    stopping = True
+                    break
+                pending.append(item)
+
+            try:
+                self._commit(pending)
+            except Exception as ex:
+                # the greenlet must outlive any failure, or every later
+                # write would wait forever.
+                logger.exception("Failed to commit batch.")
+                for _, _, _, result in pending:
+                    if not result.ready():
+                        result.set_exception(ex)
+
+    def _apply(self, pending):
+        # requests are committed in one transaction per environment.
+        groups = {}
+        for i, (_, store, _, _) in enumerate(pending):
+            groups.setdefault(store._env, []).append(i)
+
+        outcomes = [None] * len(pending)
+        for env, indexes in groups.iteritems():
+            self._engine.run_heavy_write(env, len(indexes),
+                                         self._apply_group, pending, indexes,
+                                         outcomes)
+        return outcomes
+
+    def _apply_group(self, pending, indexes, outcomes):
+        """
+        Applies requests in one transaction. If a request fails, the
+        transaction is aborted and the others are applied again without it,
+        so that it only fails its own caller.
+        """
+        while indexes:
+            failed = None
+            try:
+                with self._engine.batch() as batch:
+                    for pos, i in enumerate(indexes):
+                        op, store, args, _ = pending[i]
+                        failed = pos
+                        outcomes[i] = (getattr(batch, op)(store, *args), None)
+                    failed = None
+                return
+            except lmdb.MapFullError:
+                # raised on the threadpool, for the map to be grown on the
+                # hub, which applies the group again.
+                raise
+            except Exception as ex:
+                if isinstance(ex, lmdb.Error):
+                    ex = DataError(str(ex))
+                if failed is None:
+                    logger.exception("Failed to commit batch.")
+                    for i in indexes:
+                        outcomes[i] = (None, ex)
+                    return
+                outcomes[indexes[failed]] = (None, ex)
+                indexes = indexes[:failed] + indexes[failed + 1:]
+
+    def _commit(self, pending):
+        try:
+            outcomes = self._apply(pending)
+            self.commits += 1
+        except Exception as ex:
+            logger.exception("Failed to commit batch.")
+            if isinstance(ex, lmdb.Error):
+                ex = DataError(str(ex))
+            outcomes = [(None, ex)] * len(pending)
+
+        for (ret, error), (_, _, _, result) in zip(outcomes, pending):
+            if error is None:
+                result.set(ret)
+            else:
+                result.set_exception(error)
+
 
 class DataEngine(object):
     def __init__(self):
         logger.debug("Initializing data engine...")
         self.datapath = None
         self.database = None
+        self.context = None
+        # the locked file of the data path while the engine runs.
+        self._lock = None
         self.stores = {}
+        self.queues = {}
+        self.coalescer = None
+        self.scan_batch = 1000
+        self.map_growth = 1024 * 1024 * 1024
+        self.max_map_size = 0
+        # seconds a write waits for readers to grow the map; 0 for no limit.
+        self.grow_timeout = 5
+        # the used share of a map at which housekeeping grows it ahead of
+        # need, while no reader is in the way.
+        self.grow_threshold = 0.8
+        self.map_growths = 0
+        # environments whose writers on the hub are held off, while the map
+        # is grown for a write transaction or one runs on the threadpool.
+        self._held_off = set()
+        # the environments of write transactions on the hub, and those and
+        # the greenlets of read transactions which are held open, e.g. by
+        # snapshots, by transaction.
+        self._writers = weakref.WeakKeyDictionary()
+        self._held_readers = weakref.WeakKeyDictionary()
+        self._hub_thread = _thread_ident()
+        self.offload_enabled = False
+        self.offload_threshold = 1000
+        # compression and cache settings of stores by name.
+        self.compression = {}
+        self.caching = {}
+        self.sweep_interval = 1
+        self.sweep_batch = 1000
+        self._sweeper = None
+        # the change log, once enabled.
+        self.changes = None
+        self.timeseries = {}
+        # retention settings of time series by name.
+        self.retention = {}
+        # environments other than the main one, by name.
+        self.environments = {}
+        self._env_options = {}
+        # names of the environments keeping stores, by store name.
+        self.placement = {}
+        # the number of shards of sharded stores, by store name.
+        self.shards = {}
+        # paths of the tables of frozen stores, by store name.
+        self.frozen = {}
+        # durability modes of environments by name, and of the others.
+        self.durability = {}
+        self.durability_mode = 'sync'
+        self.flush_interval = 1
+        self._flusher = None
+        # the environments which don't sync on every commit.
+        self._lazy_envs = []
 
     def start(self, ctx=None):
         logger.debug("Starting data engine...")
 
         # register with the context
         ctx.bind('dataengine', self)
+        self.context = ctx
 
         self.datapath = os.path.join(environ.pod_dir(), _DATA_FILE_DIR)
         logger.debug("Data path: %s", self.datapath)
 
+        conf = settings.get(_CONF_SECTION) or {}
+        self.compression = dict((_encode_key(k), v) for k, v in
+                                (conf.get('compression') or {}).iteritems())
+        self.caching = dict((_encode_key(k), v) for k, v in
+                            (conf.get('cache') or {}).iteritems())
+        self.retention = dict((_encode_key(k), v) for k, v in
+                              (conf.get('retention') or {}).iteritems())
+        self.placement = dict((_encode_key(k), _encode_key(v)) for k, v in
+                              (conf.get('placement') or {}).iteritems())
+        self.shards = dict((_encode_key(k), v) for k, v in
+                           (conf.get('shards') or {}).iteritems())
+        self.frozen = dict((_encode_key(k), v) for k, v in
+                           (conf.get('frozen') or {}).iteritems())
+        self.map_growth = conf.get('map_growth', self.map_growth)
+        self.max_map_size = conf.get('max_map_size', self.max_map_size)
+        self.grow_timeout = conf.get('grow_timeout', self.grow_timeout)
+        self.grow_threshold = conf.get('grow_threshold', self.grow_threshold)
+
+        durability = conf.get('durability') or {}
+        self.durability_mode = durability.get('mode', self.durability_mode)
+        self.durability = dict(
+            (_encode_key(k), v) for k, v in
+            (durability.get('environments') or {}).iteritems())
+        self.flush_interval = durability.get('flush_interval',
+                                             self.flush_interval)
+        for mode in [self.durability_mode] + self.durability.values():
+            if mode not in _DURABILITY_OPTIONS:
+                raise DataError("Unknown durability mode: %s" % mode)
+
+        self._lock = _lock_data(self.datapath)
         try:
-            self.database = lmdb.Environment(self.datapath,
-                                             map_size=2000000000,
-                                             max_dbs=1024)
-            with self.database.begin(write=False) as txn:
-                cur = txn.cursor()
-                for k, v in iter(cur):
-                    logger.debug("Found existing store: %s", k)
-                    _db = self.database.open_db(k, create=False)
-                    self.stores[k] = Store(k, _db, self)
+            # spare read-only transactions are reset and renewed by LMDB
+            # instead of being set up from scratch on every begin().
+            # The map is grown on demand, and is never smaller than the
+            # existing data file.
+            self._env_options = dict(
+                map_size=conf.get('map_size', 2 * 1024 * 1024 * 1024),
+                max_dbs=conf.get('max_dbs', 1024),
+                max_spare_txns=conf.get('max_spare_txns', 16))
+            self.database = self._create_environment(self.datapath,
+                                                     self.durability_mode)
+            for store in self._load_stores(self.database):
+                if store.name not in self.placement and \
+                        store.name not in self.shards:
+                    self.stores[store.name] = store
+
+            for env_name in set(self.placement.values()):
+                env = self._open_environment(env_name)
+                for store in self._load_stores(env):
+                    if self.placement.get(store.name) == env_name:
+                        self.stores[store.name] = store
+
+            shards = {}
+            for i in range(max(self.shards.values() or [0])):
+                env = self._open_environment(_SHARD_ENV_FORMAT % i)
+                for store in self._load_stores(env):
+                    shards.setdefault(store.name, []).append(store)
+            for name, count in self.shards.iteritems():
+                if name in shards:
+                    self.stores[name] = self._create_sharded(name, count)
+
+            for name in self.frozen:
+                if os.path.exists(self._frozen_path(name)):
+                    self.open_frozen(name)
+                else:
+                    logger.warning("Table of frozen store %s not found.",
+                                   name)
+            # and those built at runtime.
+            for path in _frozen.table_paths(self.datapath):
+                name = _encode_key(os.path.splitext(os.path.basename(path))[0])
+                if name in self.frozen:
+                    continue
+                if name in self.stores:
+                    logger.warning("Store %s shadows a frozen table.", name)
+                    continue
+                self.open_frozen(name)
         except lmdb.Error:
             logger.exception("Failed to open database.", exc_info=True)
+            self._lock.close()
+            self._lock = None
             raise
 
+        self.scan_batch = conf.get('scan_batch', self.scan_batch)
+
+        offload = conf.get('offload') or {}
+        self.offload_enabled = offload.get('enabled', self.offload_enabled)
+        self.offload_threshold = offload.get('threshold',
+                                             self.offload_threshold)
+
+        # so housekeeping applies retention before a series is first used.
+        for name in self.retention:
+            if isinstance(self.stores.get(name), FrozenStore):
+                logger.warning("Frozen store %s has no retention.", name)
+                continue
+            self.get_timeseries(name)
+
+        change_log = conf.get('change_log') or {}
+        if change_log.get('enabled'):
+            self.enable_change_log(change_log.get('truncate_batch', 1000))
+
+        expiry = conf.get('expiry') or {}
+        self.sweep_interval = expiry.get('sweep_interval',
+                                         self.sweep_interval)
+        self.sweep_batch = expiry.get('sweep_batch', self.sweep_batch)
+        # the task engine is started after this one.
+        ctx.connect(self._schedule_sweeper, signal=AGENT_STARTED)
+        ctx.connect(self._schedule_flusher, signal=AGENT_STARTED)
+        ctx.connect(self._on_stopping, signal=AGENT_STOPPING)
+
+        group_commit = conf.get('group_commit') or {}
+        if group_commit.get('enabled'):
+            self.enable_group_commit(
+                max_delay=group_commit.get('max_delay', 0.002),
+                max_batch=group_commit.get('max_batch', 1000))
+
         logger.debug("Data engine started.")
 
     def stop(self, ctx=None):
         logger.debug("Stopping data engine...")
+        if self.context is not None:
+            self.context.disconnect(self._schedule_sweeper,
+                                    signal=AGENT_STARTED)
+            self.context.disconnect(self._schedule_flusher,
+                                    signal=AGENT_STARTED)
+            self.context.disconnect(self._on_stopping, signal=AGENT_STOPPING)
+        if self._sweeper is not None:
+            self._sweeper.kill()
+            self._sweeper = None
+        if self._flusher is not None:
+            self._flusher.kill()
+            self._flusher = None
+        self.disable_group_commit()
+        self.disable_change_log()
+        self._on_stopping()
+        del self._lazy_envs[:]
+        for env in self.environments.values():
+            env.close()
+        self.environments.clear()
         if self.database:
             self.database.close()
+        if self._lock is not None:
+            self._lock.close()
+            self._lock = None
 
         logger.debug("Data engine stopped.")
 
     def store_names(self):
         return self.stores.keys()
 
-    def create_store(self, name):
+    def _create_environment(self, path, mode):
+        env = lmdb.Environment(path, **dict(self._env_options,
+                                            **_DURABILITY_OPTIONS[mode]))
+        if mode != 'sync':
+            self._lazy_envs.append(env)
+        return env
+
+    def _open_environment(self, env_name):
+        """
+        Opens an environment in a directory under the data path, with the
+        same settings as the main one apart from its durability mode.
+        """
+        env = self.environments.get(env_name)
+        if env is None:
+            path = os.path.join(self.datapath, env_name)
+            logger.debug("Opening environment: %s", path)
+            env = self._create_environment(
+                path, self.durability.get(env_name, self.durability_mode))
+            self.environments[env_name] = env
+        return env
+
+    def _load_stores(self, env):
+        """
+        Opens the existing stores of an environment.
+
+        :return: a list of the stores.
+        """
+        stores = {}
+        with env.begin(write=False) as txn:
+            for k in txn.cursor().iternext(values=False):
+                if k.startswith(_INTERNAL_PREFIX):
+                    continue
+                logger.debug("Found existing store: %s", k)
+                _db = env.open_db(k, create=False)
+                stores[k] = Store(k, _db, self, self._compressor(k),
+                                  self._cache(k), _env=env)
+        for name in self._internal_db_names(_DEADLINE_PREFIX, env):
+            store = stores.get(name[len(_DEADLINE_PREFIX):])
+            if store is not None:
+                self._enable_expiry(store)
+        for store in stores.values():
+            self._find_indexes(store)
+        return stores.values()
+
+    def _find_indexes(self, store):
+        """
+        Notes the indexes a store has kept from earlier runs, which are
+        unregistered until they're created again.
+        """
+        prefix = _index_db_name(store.name, b'')
+        names = [it[len(prefix):] for it in
+                 self._internal_db_names(prefix, store._env)]
+        if names:
+            store._stale_db = store._env.open_db(_STALE_INDEXES_DB)
+            store.unregistered_indexes.update(names)
+
+    def _environment_of(self, store_name):
+        env_name = self.placement.get(store_name)
+        if env_name is None:
+            return self.database
+        return self._open_environment(env_name)
+
+    def _create_sharded(self, name, count, compression=None, cache=None):
+        shards = []
+        for i in range(count):
+            env = self._open_environment(_SHARD_ENV_FORMAT % i)
+            shards.append(self._open_store(env, name, compression, cache))
+        return ShardedStore(name, shards, self)
+
+    def _open_store(self, env, name, compression=None, cache=None):
+        _db = env.open_db(name, dupsort=False, create=True)
+        store = Store(name, _db, self, self._compressor(name, compression),
+                      self._cache(name, cache), _env=env)
+        with env.begin() as txn:
+            expiring = txn.get(_DEADLINE_PREFIX + name) is not None
+        if expiring:
+            self._enable_expiry(store)
+        self._find_indexes(store)
+        return store
+
+    def _plain_stores(self):
+        """
+        Gets the stores, with sharded stores broken into their shards.
+        """
+        for store in self.stores.values():
+            if isinstance(store, ShardedStore):
+                for shard in store.shards:
+                    yield shard
+            elif isinstance(store, Store):
+                yield store
+
+    def _schedule_sweeper(self, **kwargs):
+        taskengine = self.context.get('taskengine')
+        if taskengine is None or not self.sweep_interval:
+            return
+
+        task = taskengine.get_task(__name__ + '.housekeep')
+        if task is None:
+            task = taskengine.register(self.housekeep)
+        self._sweeper = taskengine.run_periodic(task.key, self.sweep_interval)
+
+    def _schedule_flusher(self, **kwargs):
+        taskengine = self.context.get('taskengine')
+        if taskengine is None or not self._lazy_envs or \
+                not self.flush_interval:
+            return
+
+        task = taskengine.get_task(__name__ + '.flush')
+        if task is None:
+            task = taskengine.register(self.flush)
+        self._flusher = taskengine.run_periodic(task.key, self.flush_interval)
+
+    def _on_stopping(self, **kwargs):
+        try:
+            self.flush()
+        except DataError:
+            pass  # it's been logged.
+
+    def flush(self):
+        """
+        Syncs the environments which don't sync on every commit to disk.
+        It's run periodically by the task engine, and when the agent stops.
+
+        :return: the number of environments flushed.
+        """
+        for env in self._lazy_envs:
+            try:
+                env.sync(True)
+            except lmdb.Error as ex:
+                logger.exception("Failed to flush environment: %s",
+                                 env.path())
+                raise DataError(ex.message)
+        return len(self._lazy_envs)
+
+    def housekeep(self):
+        """
+        Removes expired records, and records of time series beyond their
+        retention, reloads frozen stores whose tables were replaced, and
+        grows maps which are filling up. It's run periodically by the task
+        engine.
+        """
+        self.sweep_expired()
+        for series in self.timeseries.values():
+            if series.retention:
+                series.apply_retention()
+        for store in self.stores.values():
+            if isinstance(store, FrozenStore):
+                self._reload_frozen(store)
+        for env in [self.database] + self.environments.values():
+            self._grow_ahead(env)
+
+    def _grow_ahead(self, env):
+        """
+        Grows a map which is filling up while no reader is in the way, so
+        that writes seldom have to wait for long readers to grow it.
+        """
+        if not self.grow_threshold:
+            return
+        info = env.info()
+        used = (info['last_pgno'] + 1) * env.stat()['psize']
+        if used >= info['map_size'] * self.grow_threshold:
+            self.grow_map(env, wait=False)
+
+    def _frozen_path(self, name):
+        path = self.frozen.get(name)
+        if path is None:
+            return os.path.join(self.datapath, _FROZEN_DIR,
+                                name + _frozen.TABLE_EXT)
+        return os.path.join(self.datapath, path)
+
+    def open_frozen(self, name):
+        """
+        Opens a frozen store, i.e. a read-only store backed by a sorted
+        table which is memory-mapped instead of kept in LMDB. Its table is
+        at the path given in the `frozen` section of the config, relative
+        to the data path, or at frozen/<name>.tbl; those are all opened
+        when the engine starts.
+
+        :return: the FrozenStore.
+        """
+        name = _encode_key(name)
+        store = self.stores.get(name)
+        if isinstance(store, FrozenStore):
+            return store
+        if store is not None:
+            raise DataError("Store already exists: %s" % name)
+        try:
+            store = FrozenStore(name, self._frozen_path(name))
+        except (IOError, OSError, ValueError) as ex:
+            logger.exception("Failed to open frozen store.")
+            raise DataError(str(ex))
+        self.stores[name] = store
+        return store
+
+    def build_frozen(self, name, items):
+        """
+        Builds a new version of a frozen store from records sorted by key,
+        which are streamed to a new table. The table replaces the old one
+        by a rename, so readers never see it half-built, and the store is
+        reloaded. No write transaction is involved.
+
+        :param items: an iterable of (key, value) pairs in key order.
+        :return: the FrozenStore.
+        """
+        name = _encode_key(name)
+        store = self.stores.get(name)
+        if store is not None and not isinstance(store, FrozenStore):
+            raise DataError("Store already exists: %s" % name)
+        try:
+            _frozen.build(self._frozen_path(name), items)
+        except (IOError, OSError) as ex:
+            logger.exception("Failed to build frozen store.")
+            raise DataError(str(ex))
+        if store is None:
+            return self.open_frozen(name)
+        self._reload_frozen(store)
+        return store
+
+    def _reload_frozen(self, store):
+        try:
+            store.reload()
+        except (IOError, OSError, DataError):
+            logger.exception("Failed to reload frozen store: %s", store.name)
+
+    def enable_expiry(self, store_name):
+        """
+        Opens the databases keeping deadlines of a store's records, which
+        can't be done within a transaction.
+
+        :return: the store's Expiry.
+        """
+        store_name = _encode_key(store_name)
+        store = self.get_store(store_name, create=False)
+        if store is None:
+            raise DataNotFoundError(store_name)
+        if isinstance(store, ShardedStore):
+            for shard in store.shards:
+                self._enable_expiry(shard)
+            return None
+        if not isinstance(store, Store):
+            raise DataError("Expiry isn't supported by the store.")
+        return self._enable_expiry(store)
+
+    def _enable_expiry(self, store):
+        if store.expiry is not None:
+            return store.expiry
+
+        try:
+            deadline_db = store._env.open_db(_DEADLINE_PREFIX + store.name)
+            order_db = store._env.open_db(_EXPIRY_PREFIX + store.name)
+        except lmdb.Error as ex:
+            logger.exception("Failed to enable expiry.")
+            raise DataError(ex.message)
+        store.expiry = Expiry(deadline_db, order_db)
+        return store.expiry
+
+    def enable_change_log(self, truncate_batch=1000):
+        """
+        Starts recording mutations of stores in the change log, in the same
+        transactions as the mutations. The log is kept in the main
+        environment, so it can't be enabled along with placement or
+        sharding.
+
+        :param truncate_batch: the maximum entries truncated at a time.
+        :return: the ChangeLog.
+        """
+        if self.changes is not None:
+            return self.changes
+        if self.placement or self.shards:
+            raise DataError("The change log doesn't cover placement or "
+                            "shard environments.")
+        try:
+            log_db = self.database.open_db(_CHANGES_DB)
+            consumers_db = self.database.open_db(_CONSUMERS_DB)
+        except lmdb.Error as ex:
+            logger.exception("Failed to open change log.")
+            raise DataError(ex.message)
+        self.changes = ChangeLog(log_db, consumers_db, self, truncate_batch)
+        return self.changes
+
+    def disable_change_log(self, purge=False):
+        """
+        Stops recording mutations of stores.
+
+        :param purge: whether to remove the log and its consumers as well.
+        """
+        changes = self.changes
+        if changes is None:
+            return
+        self.changes = None
+        changes.close()
+        if purge:
+            self._drop_dbs([changes._log_db, changes._consumers_db])
+
+    def _notify_changes(self):
+        if self.changes is not None:
+            self.changes.notify()
+
+    def sweep_expired(self):
+        """
+        Removes expired records in transactions of at most `sweep_batch`
+        records each. The records are found in deadline order, so the cost
+        depends on the number of expired records, not the stores' sizes.
+        It's run periodically by the task engine.
+
+        :return: the number of records removed.
+        """
+        count = 0
+        for store in self._plain_stores():
+            if store.expiry is None:
+                continue
+            while True:
+                keys = self.write_to(store._env, self._sweep, store, now_ms())
+                for key in keys:
+                    store._invalidate(key)
+                if keys:
+                    self._notify_changes()
+                count += len(keys)
+                if len(keys) < self.sweep_batch:
+                    break
+                gevent.sleep(0)
+        if count:
+            logger.debug("Removed %d expired records.", count)
+        return count
+
+    def _sweep(self, txn, store, now):
+        keys = store.expiry.expired_keys(txn, now, self.sweep_batch)
+        cur = Cursor(txn, store._db, _readonly=False, _store=store)
+        for key in keys:
+            cur._apply('delete', key, None)
+            # in case the record has gone without its deadline.
+            store.expiry.clear(txn, key)
+        return keys
+
+    def offload(self, func, *args, **kwargs):
+        """
+        Runs a function on gevent's native threadpool if offloading is
+        enabled, and waits for its result without blocking other greenlets.
+        LMDB releases the GIL while working, so the hub keeps serving.
+        The function should begin and end its own transactions, as a write
+        transaction can't move between threads.
+
+        :return: the function's result.
+        """
+        if not self.offload_enabled:
+            return func(*args, **kwargs)
+        return _pool_apply(func, args, kwargs)
+
+    def run_heavy(self, size, func, *args, **kwargs):
+        """
+        Runs a function which works on `size` records. It's offloaded to the
+        threadpool if the size reaches `offload_threshold`; otherwise, it's
+        run inline.
+
+        :return: the function's result.
+        """
+        if size >= self.offload_threshold:
+            return self.offload(func, *args, **kwargs)
+        return func(*args, **kwargs)
+
+    def run_heavy_write(self, env, size, func, *args, **kwargs):
+        """
+        Same as run_heavy(), for a function which writes to an environment
+        and commits once. While it runs on the threadpool, the writers on
+        the hub are held off, as they would be while the map is grown, so
+        none can commit between an aborted transaction of it and its
+        replay. If the map gets full, it's grown on the hub and the function
+        is called again.
+
+        :return: the function's result.
+        """
+        if size < self.offload_threshold or not self.offload_enabled:
+            return func(*args, **kwargs)
+        self._hold_off_writers(env)
+        try:
+            while True:
+                try:
+                    return _pool_apply(func, args, kwargs)
+                except lmdb.MapFullError:
+                    self.grow_map(env)
+        finally:
+            self._held_off.discard(env)
+
+    def _offloaded(self):
+        """
+        Checks whether the caller runs on the threadpool, where gevent
+        mustn't be used.
+        """
+        return _thread_ident() != self._hub_thread
+
+    def write(self, func, *args, **kwargs):
+        """
+        Calls a function with a new write transaction as the first argument,
+        then commits. If the map gets full, it's grown and the function is
+        called again in another transaction, so the function should have no
+        side effects beyond the transaction.
+
+        :return: the function's result.
+        """
+        return self.write_to(self.database, func, *args, **kwargs)
+
+    def write_to(self, env, func, *args, **kwargs):
+        """
+        Same as write(), in a transaction of the given environment.
+        """
+        while True:
+            try:
+                with self._begin(env, write=True) as txn:
+                    return func(txn, *args, **kwargs)
+            except lmdb.MapFullError:
+                if self._offloaded():
+                    raise
+                self.grow_map(env)
+
+    def _begin(self, env, write=False, buffers=False):
+        """
+        Begins a transaction. Write transactions on the hub wait while the
+        writers of the environment are held off; read transactions are
+        taken note of, so a greenlet holding one can't wait for itself to
+        grow the map. On the threadpool, writers are held off on its behalf.
+        """
+        if self._offloaded():
+            return env.begin(write=write, buffers=buffers)
+        if write:
+            while env in self._held_off:
+                gevent.sleep(0.01)
+            txn = env.begin(write=True, buffers=buffers)
+            self._writers[txn] = env
+            return txn
+        txn = env.begin(buffers=buffers)
+        self._held_readers[txn] = (env, gevent.getcurrent())
+        return txn
+
+    def _hold_off_writers(self, env):
+        """
+        Waits until no write transaction of an environment is open on the
+        hub and its writers aren't held off already, then holds them off.
+        The caller must discard the environment from `_held_off` when done.
+        """
+        while env in self._held_off or any(
+                txn_env is env and _is_open(txn)
+                for txn, txn_env in self._writers.items()):
+            gevent.sleep(0.01)
+        self._held_off.add(env)
+
+    def _regrow(self, env):
+        """
+        Grows the map for a write transaction which got MapFullError and
+        has been aborted, and begins another one. Other writers are held
+        off meanwhile, so the writes of the aborted transaction can be
+        replayed as they were, without overwriting newer commits. On the
+        threadpool, the error is raised again instead, for the map to be
+        grown on the hub.
+
+        :return: the new write transaction.
+        """
+        if self._offloaded():
+            raise lmdb.MapFullError("Map is full.")
+        self._hold_off_writers(env)
+        try:
+            self.grow_map(env)
+        finally:
+            self._held_off.discard(env)
+        return self._begin(env, write=True)
+
+    def _active_readers(self, env):
+        """
+        Gets the number of read transactions of an environment active in
+        this process.
+        """
+        pid = str(os.getpid())
+        count = 0
+        for line in env.readers().splitlines()[1:]:
+            fields = line.split()
+            if len(fields) == 3 and fields[0] == pid and fields[2] != '-':
+                count += 1
+        return count
+
+    def _own_readers(self, env):
+        """
+        Gets the number of read transactions of an environment held open by
+        the current greenlet.
+        """
+        current = gevent.getcurrent()
+        count = 0
+        for txn, (txn_env, greenlet) in self._held_readers.items():
+            if txn_env is env and greenlet is current and _is_open(txn):
+                count += 1
+        return count
+
+    def grow_map(self, env=None, wait=True):
+        """
+        Grows the map by `map_growth` bytes. No transaction may be active in
+        this process while the map is remapped, so it waits for the readers
+        in other greenlets to finish, for up to `grow_timeout` seconds if
+        it's set. It fails at once if the only readers are the caller's.
+
+        :param env: the environment; defaults to the main one.
+        :param wait: whether to wait for readers; if False, the map isn't
+            grown while there are any.
+        :return: the new map size, or None if it wasn't grown.
+        """
+        if env is None:
+            env = self.database
+        started = time.time()
+        warned = started
+        while True:
+            readers = self._active_readers(env)
+            if readers == 0:
+                break
+            if not wait:
+                return None
+            if readers <= self._own_readers(env):
+                raise DataError("Can't grow map while holding a read "
+                                "transaction.")
+            now = time.time()
+            if self.grow_timeout and now - started >= self.grow_timeout:
+                raise DataError("Timed out waiting for readers to grow map.")
+            if now - warned >= 10:
+                logger.warning("Waiting %d seconds for readers to grow map.",
+                               now - started)
+                warned = now
+            gevent.sleep(0.01)
+
+        info = env.info()
+        psize = env.stat()['psize']
+        map_size = info['map_size'] + self.map_growth
+        map_size = (map_size + psize - 1) // psize * psize
+        if self.max_map_size and map_size > self.max_map_size:
+            raise DataError("Map size limit reached: %d" % self.max_map_size)
+
+        logger.info("Growing data map to %d bytes...", map_size)
+        env.set_mapsize(map_size)
+        self.map_growths += 1
+        if self.context is not None:
+            self.context.send(signal=DATA_MAP_GROWN, sender=self,
+                              map_size=map_size)
+        return map_size
+
+    def usage(self):
+        """
+        Gets the usage of the map for capacity planning.
+
+        :return: a dict of statistics.
+        """
+        info = self.database.info()
+        psize = self.database.stat()['psize']
+        used = (info['last_pgno'] + 1) * psize
+        return dict(map_size=info['map_size'],
+                    used_size=used,
+                    used_ratio=used / info['map_size'],
+                    page_size=psize,
+                    num_readers=info['num_readers'],
+                    max_readers=info['max_readers'],
+                    map_growths=self.map_growths)
+
+    def _compressor(self, name, compression=None):
+        if compression is None:
+            compression = self.compression.get(name)
+        if not compression:
+            return None
+        if isinstance(compression, Compressor):
+            return compression
+        if compression is True:
+            compression = {}
+        return Compressor(level=compression.get('level', 6),
+                          threshold=compression.get('threshold', 512))
+
+    def _cache(self, name, cache=None):
+        if cache is None:
+            cache = self.caching.get(name)
+        if not cache:
+            return None
+        if isinstance(cache, LRUCache):
+            return cache
+        if cache is True:
+            cache = {}
+        return LRUCache(max_entries=cache.get('max_entries', 1000),
+                        max_bytes=cache.get('max_bytes', 0))
+
+    def backup(self, path, compact=True, environment=None):
+        """
+        Writes a consistent copy of the data to a file while the engine
+        keeps serving. The copy holds a read transaction until it's done,
+        so the map can't be grown meanwhile. It's offloaded to the
+        threadpool if offloading is enabled.
+
+        If there are placement or shard environments or frozen stores and
+        no environment is named, all the environments are copied into a
+        directory laid out like the data path, each in a transaction of its
+        own, along with the tables of the frozen stores.
+
+        :param path: the backup file's path, or a directory to write data
+            files into.
+        :param compact: whether to omit free pages, which shrinks the copy
+            of a file bloated by deletes.
+        :param environment: the name of a placement or shard environment
+            to copy alone.
+        :return: the size of the backup in bytes.
+        """
+        logger.info("Backing up data to %s...", path)
+        tables = sorted(os.path.relpath(store.path, self.datapath)
+                        for store in self.stores.values()
+                        if isinstance(store, FrozenStore))
+        try:
+            if environment is not None or not (self.environments or tables):
+                return self.offload(_backup.copy_to_file,
+                                    self._named_environment(environment),
+                                    path, compact)
+            envs = dict(self.environments)
+            envs[None] = self.database
+            size = self.offload(_backup.copy_environments, envs, path,
+                                compact)
+            return size + self.offload(_backup.copy_tables, self.datapath,
+                                       tables, path)
+        except (lmdb.Error, IOError, OSError) as ex:
+            logger.exception("Failed to back up data.")
+            raise DataError(str(ex))
+
+    def backup_stream(self, compact=True, chunk_size=65536,
+                      environment=None):
+        """
+        Streams a consistent copy of an environment, e.g. as a response
+        body. The copy is always made on the threadpool. A stream holds a
+        single data file, so if there are placement or shard environments,
+        the one to copy must be named, and it leaves out the tables of
+        frozen stores; backup() copies them all.
+
+        :param compact: whether to omit free pages.
+        :param chunk_size: the maximum bytes of a chunk.
+        :param environment: the name of a placement or shard environment,
+            or '' for the main one.
+        :return: a generator of chunks of the data file.
+        """
+        if environment is None and self.environments:
+            raise DataError("A streamed backup covers one environment; "
+                            "name it or use backup().")
+        return _backup.stream_copy(self._named_environment(environment),
+                                   compact, chunk_size)
+
+    def _named_environment(self, name):
+        if not name:
+            return self.database
+        env = self.environments.get(_encode_key(name))
+        if env is None:
+            raise DataNotFoundError(name)
+        return env
+
+    def map_reduce(self, store_name, mapper, reducer, initial=None,
+                   partitions=None, values=True):
+        """
+        Scans a store in partitions concurrently on the threadpool, e.g. for
+        counting records by type. The key space is split into ranges by
+        probing the B-tree, and each range is read in a read-only
+        transaction of its own. A sharded store is split shard by shard.
+
+        :param mapper: a function of an iterator of a range's (key, value)
+            pairs which returns a partial result. It runs in a native
+            thread, so it mustn't use gevent.
+        :param reducer: a function of two results which combines them.
+        :param initial: the result to start the reduction from.
+        :param partitions: the ranges to split the store into; defaults to
+            four for each thread of the pool, so that busy ranges don't
+            hold up the others.
+        :param values: whether to read values; if False, values are None.
+        :return: the combined result.
+        """
+        store = self.get_store(_encode_key(store_name), create=False)
+        if store is None:
+            raise DataNotFoundError(store_name)
+        if isinstance(store, ShardedStore):
+            stores = store.shards
+        elif isinstance(store, Store):
+            stores = [store]
+        else:
+            raise DataError("Partitioned scans aren't supported by the "
+                            "store.")
+        if partitions is None:
+            partitions = gevent.get_hub().threadpool.maxsize * 4
+        partitions = max(partitions // len(stores), 1)
+
+        try:
+            return _analytics.map_reduce(stores, mapper, reducer, initial,
+                                         partitions, values)
+        except lmdb.Error as ex:
+            logger.exception("Failed to scan store.")
+            raise DataError(ex.message)
+
+    def export_stores(self, out, store_names=None):
+        """
+        Writes stores as a stream of length-prefixed msgpack entries.
+
+        :param out: a file-like object.
+        :param store_names: the stores to export; defaults to all.
+        :return: the number of records written.
+        """
+        return _transfer.export_stores(self, out, store_names)
+
+    def import_stores(self, src, batch_size=10000):
+        """
+        Loads stores written by export_stores(). Records whose keys are
+        sorted after the existing ones are appended, which is much faster
+        for loading a dump into empty stores.
+
+        :param src: a file-like object.
+        :param batch_size: the records in a transaction.
+        :return: the number of records loaded.
+        """
+        try:
+            return _transfer.import_stores(self, src, batch_size)
+        except lmdb.Error as ex:
+            logger.exception("Failed to import stores.")
+            raise DataError(ex.message)
+
+    def create_store(self, name, compression=None, cache=None):
+        """
+        Creates a store, or opens the existing one.
+
+        :param name: the store's name.
+        :param compression: True or a dict of zlib `level` and `threshold`
+            to compress values; defaults to the store's settings in the
+            `compression` section of the config. Stored values are readable
+            whether compression is on or not.
+        :param cache: True or a dict of `max_entries` and `max_bytes` to
+            cache values read by get(); defaults to the store's settings in
+            the `cache` section of the config.
+        :return: the store, which is a ShardedStore if the store is listed
+            in the `shards` section of the config.
+        """
         if isinstance(name, unicode):
             name = name.encode('utf-8')
+        if isinstance(self.stores.get(name), FrozenStore):
+            raise DataError("Frozen stores are read-only: %s" % name)
 
         try:
-            _db = self.database.open_db(name, dupsort=False, create=True)
-            store = Store(name, _db, self)
+            if name in self.shards:
+                store = self._create_sharded(name, self.shards[name],
+                                             compression, cache)
+            else:
+                store = self._open_store(self._environment_of(name), name,
+                                         compression, cache)
             self.stores[name] = store
             return store
         except lmdb.Error as ex:
@@ -280,13 +2689,173 @@ class DataEngine(object):
         try:
             store = self.stores.get(name)
             if store is not None:
-                with self.database.begin(write=True) as txn:
-                    txn.drop(store._db)
+                if isinstance(store, ShardedStore):
+                    for shard in store.shards:
+                        self._remove_store(shard)
+                elif isinstance(store, Store):
+                    self._remove_store(store)
+                elif isinstance(store, FrozenStore):
+                    self._remove_frozen(store)
+                self.timeseries.pop(name, None)
+                self._notify_changes()
                 del self.stores[name]
         except lmdb.Error as ex:
             logger.exception("Failed to remove store.", ex)
             raise DataError(ex.message)
 
+    def _remove_store(self, store):
+        env = store._env
+        dbs = [env.open_db(it, create=False)
+               for it in self._internal_db_names(
+                   _index_db_name(store.name, b''), env)]
+        if store.expiry is not None:
+            dbs.append(store.expiry._deadline_db)
+            dbs.append(store.expiry._order_db)
+        dbs.append(store._db)
+        self.run_heavy_write(env, len(store), self._drop_dbs, dbs, store.name,
+                             env)
+        if store.cache is not None:
+            store.cache.clear()
+
+    def _remove_frozen(self, store):
+        # a table built at runtime would be opened again on restart, while
+        # a configured one is left for the config to be changed.
+        if store.name in self.frozen:
+            return
+        try:
+            os.remove(store.path)
+        except OSError as ex:
+            logger.exception("Failed to remove frozen store.")
+            raise DataError(str(ex))
+
+    def _drop_dbs(self, dbs, store_name=None, env=None):
+        if env is None:
+            env = self.database
+        with self._begin(env, write=True) as txn:
+            for _db in dbs:
+                txn.drop(_db)
+            if store_name is not None and self.changes is not None and \
+                    env is self.database:
+                self.changes.record(txn, store_name, b'', 'drop')
+
+    def _internal_db_names(self, prefix, env=None):
+        if env is None:
+            env = self.database
+        with env.begin() as txn:
+            cur = txn.cursor()
+            if not cur.set_range(prefix):
+                return []
+            return [k for k in cur.iternext(values=False)
+                    if k.startswith(prefix)]
+
+    def create_index(self, store_name, index_name, key_func, rebuild=False):
+        """
+        Creates a secondary index of a store. A new or rebuilt index is
+        registered first and then backfilled from existing records in
+        batches of `scan_batch` records per transaction, yielding to other
+        greenlets in between. Until the backfill finishes, lookups may miss
+        records written before the index was created.
+
+        An existing index is rebuilt as well if the store was written while
+        it wasn't registered, e.g. after a restart, before it's created
+        again.
+
+        :return: the index.
+        """
+        store_name = _encode_key(store_name)
+        index_name = _encode_key(index_name)
+        store = self.get_store(store_name, create=False)
+        if store is None:
+            raise DataNotFoundError(store_name)
+        if not isinstance(store, Store):
+            raise DataError("Indexes aren't supported by the store.")
+
+        env = store._env
+        db_name = _index_db_name(store_name, index_name)
+        try:
+            with env.begin() as txn:
+                exists = txn.get(db_name) is not None
+                stale = store._stale_db is not None and \
+                    txn.get(db_name, db=store._stale_db) is not None
+            _db = env.open_db(db_name, dupsort=True, create=True)
+            index = Index(index_name, key_func, _db, store)
+
+            if stale and not rebuild:
+                logger.info("Rebuilding stale index %s of store %s.",
+                            index_name, store_name)
+                rebuild = True
+            if exists and rebuild:
+                with self._begin(env, write=True) as txn:
+                    txn.drop(_db, delete=False)
+            store.indexes[index_name] = index
+            store.unregistered_indexes.discard(index_name)
+            if not exists or rebuild:
+                self._backfill_index(store, index)
+            if stale:
+                self._clear_stale(store, db_name)
+            return index
+        except lmdb.Error as ex:
+            logger.exception("Failed to create index.")
+            raise DataError(ex.message)
+
+    def _backfill_index(self, store, index):
+        logger.debug("Building index %s of store %s...", index.name,
+                     store.name)
+        def backfill(txn, last):
+            cur = txn.cursor(store._db)
+            if last is None:
+                positioned = cur.first()
+            else:
+                positioned = _seek_resume(cur, last, False, False)
+
+            count = 0
+            while positioned and count < self.scan_batch:
+                last, value = cur.item()
+                index.update(txn, last, None, decode(value))
+                count += 1
+                positioned = cur.next()
+            return positioned, last
+
+        positioned, last = True, None
+        while positioned:
+            positioned, last = self.run_heavy_write(
+                store._env, self.scan_batch, self.write_to, store._env,
+                backfill, last)
+            # let other greenlets run between batches.
+            gevent.sleep(0)
+
+    def _clear_stale(self, store, db_name):
+        self.write_to(store._env,
+                      lambda txn: txn.delete(db_name, db=store._stale_db))
+
+    def drop_index(self, store_name, index_name):
+        store_name = _encode_key(store_name)
+        index_name = _encode_key(index_name)
+        store = self.stores.get(store_name)
+        if not isinstance(store, Store):
+            return False
+
+        env = store._env
+        db_name = _index_db_name(store_name, index_name)
+        index = store.indexes.pop(index_name, None)
+        store.unregistered_indexes.discard(index_name)
+        try:
+            if index is not None:
+                _db = index._db
+            else:
+                with env.begin() as txn:
+                    if txn.get(db_name) is None:
+                        return False
+                _db = env.open_db(db_name, create=False)
+            with self._begin(env, write=True) as txn:
+                txn.drop(_db)
+                if store._stale_db is not None:
+                    txn.delete(db_name, db=store._stale_db)
+            return True
+        except lmdb.Error as ex:
+            logger.exception("Failed to drop index.")
+            raise DataError(ex.message)
+
     def remove_all_stores(self):
         for name in self.stores.keys():
             self.remove_store(name)
@@ -294,17 +2863,134 @@ class DataEngine(object):
     def store_exists(self, name):
         return name in self.stores
 
-    def cursor(self, store_name, readonly=True):
+    def get_timeseries(self, name, retention=None):
+        """
+        Gets or creates the named time series, which is kept in a store of
+        the same name.
+
+        :param name: the time series' name.
+        :param retention: seconds to keep records for; defaults to the
+            `retention` section of the config, or forever.
+        :return: the TimeSeries.
+        """
+        name = _encode_key(name)
+        series = self.timeseries.get(name)
+        if series is None:
+            series = TimeSeries(self.get_store(name),
+                                self.retention.get(name))
+            self.timeseries[name] = series
+        if retention is not None:
+            series.retention = retention
+        return series
+
+    def get_queue(self, name, visibility_timeout=30):
+        """
+        Gets or creates the named durable queue.
+
+        :param name: the queue's name.
+        :param visibility_timeout: the default seconds before a delivered
+            message is delivered again unless acknowledged.
+        :return: the queue.
+        """
+        name = _encode_key(name)
+        queue = self.queues.get(name)
+        if queue is not None:
+            return queue
+
+        try:
+            ready_db = self.database.open_db(_QUEUE_PREFIX + name)
+            inflight_db = self.database.open_db(_INFLIGHT_PREFIX + name)
+        except lmdb.Error as ex:
+            logger.exception("Failed to open queue.")
+            raise DataError(ex.message)
+
+        queue = DurableQueue(name, ready_db, inflight_db, self,
+                             visibility_timeout=visibility_timeout)
+        self.queues[name] = queue
+        return queue
+
+    def remove_queue(self, name):
+        name = _encode_key(name)
+        queue = self.get_queue(name)
+        try:
+            with self._begin(self.database, write=True) as txn:
+                txn.drop(queue._ready_db)
+                txn.drop(queue._inflight_db)
+        except lmdb.Error as ex:
+            logger.exception("Failed to remove queue.")
+            raise DataError(ex.message)
+        finally:
+            del self.queues[name]
+
+    def cursor(self, store_name, readonly=True, buffers=False):
+        """
+        Opens a cursor on the named store in a new transaction.
+
+        :param store_name: the store's name.
+        :param readonly: whether the transaction is read-only.
+        :param buffers: if True, keys and values are returned as buffers into
+            the memory map, which are valid only during the transaction.
+        :return: the cursor, to be used as a context manager.
+        """
         if isinstance(store_name, unicode):
             store_name = store_name.encode('utf-8')
 
+        store = self.stores.get(store_name)
+        if store is not None:
+            return store.cursor(readonly=readonly, buffers=buffers)
+
         _write = True
         if readonly:
             _write = False
 
         _db = self.database.open_db(store_name, create=False, dupsort=True)
-        _txn = self.database.begin(write=_write, buffers=False)
-        return Cursor(_txn, _db, _readonly=readonly)
+        _txn = self._begin(self.database, write=_write, buffers=buffers)
+        return Cursor(_txn, _db, _readonly=readonly, _store=store)
+
+    def batch(self):
+        """
+        Creates a batch for applying mutations to stores in one write
+        transaction.
+
+        :return: the batch, to be used as a context manager.
+        """
+        return Batch(self)
+
+    def snapshot(self, buffers=True):
+        """
+        Opens a snapshot for reading several stores in one read transaction,
+        e.g. for the lookups of a request, which see the same version of
+        them and pay for one transaction instead of one per lookup. Unlike
+        Store.read_view(), it isn't bound to a single store.
+
+        :param buffers: whether to return values as buffers into the memory
+            map, as Store.read_view() does, which are valid only until the
+            snapshot exits; if False, they're copied.
+        :return: the Snapshot, to be used as a context manager.
+        """
+        return Snapshot(self, buffers=buffers)
+
+    def enable_group_commit(self, max_delay=0.002, max_batch=1000):
+        """
+        Routes writes made through stores to a coalescer which applies
+        requests from concurrent greenlets in group commits.
+
+        :param max_delay: the maximum seconds a request waits for others.
+        :param max_batch: the maximum requests in one transaction.
+        """
+        if self.coalescer is not None:
+            return
+        logger.debug("Enabling group commit...")
+        self.coalescer = WriteCoalescer(self, max_delay, max_batch)
+        self.coalescer.start()
+
+    def disable_group_commit(self):
+        if self.coalescer is None:
+            return
+        logger.debug("Disabling group commit...")
+        coalescer = self.coalescer
+        self.coalescer = None
+        coalescer.stop()
 
     def stat(self):
         ret = self.database.stat()
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+Partitioned scans of stores for analytics.
+
+A store's key space is split into ranges by probing the B-tree at points
+spread evenly between its first and last keys. The ranges are scanned
+concurrently on gevent's native threadpool, each in a read-only
+transaction of its own; LMDB readers don't block each other or writers,
+and LMDB releases the GIL while it's working.
+"""
+from __future__ import (absolute_import, division, unicode_literals)
+
+import os
+import struct
+
+import gevent
+
+from .compression import decode
+
+_POINT_FORMAT = b'>Q'
+_POINT_SIZE = struct.calcsize(_POINT_FORMAT)
+
+
+def _to_point(suffix):
+    return struct.unpack(_POINT_FORMAT,
+                         suffix[:_POINT_SIZE].ljust(_POINT_SIZE, b'\0'))[0]
+
+
+def key_fraction(first, last, start, stop):
+    """
+    Estimates the share of the keys between `first` and `last` which are in
+    the range [start, stop), assuming the keys are spread evenly over the
+    key space between them.
+
+    :return: a number between 0 and 1.
+    """
+    prefix = os.path.commonprefix([first, last])
+
+    def point(key, default):
+        if key is None:
+            return default
+        if not key.startswith(prefix):
+            return lo if key < prefix else hi
+        return min(max(_to_point(key[len(prefix):]), lo), hi)
+
+    lo = _to_point(first[len(prefix):])
+    hi = _to_point(last[len(prefix):])
+    if hi <= lo:
+        return 1.0
+    return max(point(stop, hi) - point(start, lo), 0) / (hi - lo)
+
+
+def split_ranges(txn, _db, count):
+    """
+    Splits the keys of a database into up to `count` ranges. The bounds are
+    the keys found at points spread evenly over the key space, so ranges
+    hold similar numbers of records if the keys are spread evenly too.
+
+    :return: a list of (start, stop) ranges, where `stop` is exclusive and
+        None for the last range.
+    """
+    cur = txn.cursor(_db)
+    if not cur.first():
+        return []
+    first = cur.key()
+    cur.last()
+    last = cur.key()
+
+    prefix = os.path.commonprefix([first, last])
+    lo = _to_point(first[len(prefix):])
+    hi = _to_point(last[len(prefix):])
+    bounds = [first]
+    for i in range(1, count):
+        point = prefix + struct.pack(_POINT_FORMAT, lo + (hi - lo) * i // count)
+        if cur.set_range(point) and cur.key() > bounds[-1]:
+            bounds.append(cur.key())
+    return zip(bounds, bounds[1:] + [None])
+
+
+def _iter_range(txn, cur, start, stop, values, expiry):
+    positioned = cur.set_range(start)
+    while positioned:
+        key = cur.key()
+        if stop is not None and key >= stop:
+            return
+        if expiry is None or not expiry.is_expired(txn, key):
+            yield key, decode(cur.value()) if values else None
+        positioned = cur.next()
+
+
+def _map_range(store, start, stop, mapper, values):
+    with store._env.begin(db=store._db) as txn:
+        cur = txn.cursor()
+        return mapper(_iter_range(txn, cur, start, stop, values,
+                                  store.expiry))
+
+
+def map_reduce(stores, mapper, reducer, initial=None, partitions=16,
+               values=True):
+    """
+    Scans stores in partitions on the threadpool, and combines the results.
+
+    :param stores: the stores, e.g. the shards of a sharded store.
+    :param mapper: a function of an iterator of a partition's (key, value)
+        pairs which returns a partial result. It runs in a native thread,
+        so it mustn't use gevent.
+    :param reducer: a function of two results which combines them.
+    :param initial: the result to start the reduction from; if None, it
+        starts from the first partial result.
+    :param partitions: the number of ranges to split each store into.
+    :param values: whether to read values; if False, values are None.
+    :return: the combined result, or `initial` if the stores are empty.
+    """
+    tasks = []
+    for store in stores:
+        with store._env.begin() as txn:
+            ranges = split_ranges(txn, store._db, partitions)
+        tasks.extend((store, start, stop) for start, stop in ranges)
+
+    pool = gevent.get_hub().threadpool
+    pending = [pool.spawn(_map_range, store, start, stop, mapper, values)
+               for store, start, stop in tasks]
+    results = [it.get() for it in pending]
+    if initial is not None:
+        return reduce(reducer, results, initial)
+    if not results:
+        return None
+    return reduce(reducer, results)
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""
+Hot backups of the data environment.
+
+LMDB copies the environment within a read transaction, so a backup is
+consistent while writers carry on. A compacting copy omits free pages and
+renumbers the others, hence it's usually smaller than the data file. A
+backup is restored by putting it in place as the data file of a pod.
+
+Stores placed in other environments or sharded live in subdirectories of
+the data path, each with a data file of its own; a backup of all of them
+is a directory laid out the same way, along with the tables of frozen
+stores.
+"""
+from __future__ import (absolute_import, division, unicode_literals)
+
+import os
+import shutil
+import lmdb
+import gevent
+from gevent.os import make_nonblocking, nb_read
+
+from ava.spi.errors import DataError
+
+# the name of the data file of an environment.
+DATA_FILE_NAME = b'data.mdb'
+
+
+def copy_to_file(env, path, compact=True):
+    """
+    Copies an environment to a file. The copy is written to a temporary
+    file first and renamed when complete, so an existing backup is replaced
+    atomically.
+
+    :param env: the lmdb environment.
+    :param path: the file's path, or a directory to write a data file into.
+    :param compact: whether to omit free pages.
+    :return: the size of the copy in bytes.
+    """
+    if os.path.isdir(path):
+        path = os.path.join(path, DATA_FILE_NAME)
+    tmp_path = path + b'.tmp'
+
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    try:
+        env.copyfd(fd, compact=compact)
+        os.fsync(fd)
+        size = os.fstat(fd).st_size
+    except:
+        os.close(fd)
+        os.remove(tmp_path)
+        raise
+    os.close(fd)
+    os.rename(tmp_path, path)
+    return size
+
+
+def environment_names(datapath):
+    """
+    Gets the names of the environments in subdirectories of a data path.
+    """
+    return sorted(name for name in os.listdir(datapath)
+                  if os.path.isfile(os.path.join(datapath, name,
+                                                 DATA_FILE_NAME)))
+
+
+def copy_environments(envs, path, compact=True):
+    """
+    Copies environments to a directory laid out like the data path: the
+    data file of the main environment at the top, and those of the others
+    in subdirectories named after them. Each environment is copied in a
+    read transaction of its own, so the copies are consistent one by one
+    but not with each other.
+
+    :param envs: a dict of the environments by name, where the name of the
+        main one is None.
+    :param path: the directory, which is created if needed.
+    :param compact: whether to omit free pages.
+    :return: the total size of the copies in bytes.
+    """
+    if os.path.exists(path) and not os.path.isdir(path):
+        raise DataError("Backups of several environments go to a "
+                        "directory: %s" % path)
+    size = 0
+    for name, env in sorted(envs.items()):
+        target = path if name is None else os.path.join(path, name)
+        if not os.path.isdir(target):
+            os.makedirs(target)
+        size += copy_to_file(env, target, compact)
+    return size
+
+
+def copy_tables(datapath, tables, path):
+    """
+    Copies the tables of frozen stores to a directory, at the same paths
+    relative to it as to the data path. Tables are replaced by renames, not
+    written in place, so each copy is of a single version.
+
+    :param datapath: the data path.
+    :param tables: the tables' paths relative to the data path.
+    :param path: the directory.
+    :return: the total size of the copies in bytes.
+    """
+    size = 0
+    for table in tables:
+        target = os.path.join(path, table)
+        if not os.path.isdir(os.path.dirname(target)):
+            os.makedirs(os.path.dirname(target))
+        shutil.copyfile(os.path.join(datapath, table), target + b'.tmp')
+        os.rename(target + b'.tmp', target)
+        size += os.path.getsize(target)
+    return size
+
+
+def stream_copy(env, compact=True, chunk_size=65536):
+    """
+    Copies an environment as a stream. LMDB writes the copy to a pipe on
+    the threadpool, and the pipe is read without blocking other greenlets.
+    Closing the generator early abandons the copy.
+
+    :param env: the lmdb environment.
+    :param compact: whether to omit free pages.
+    :param chunk_size: the maximum bytes of a chunk.
+    :return: a generator of chunks.
+    """
+    read_fd, write_fd = os.pipe()
+
+    def copy():
+        try:
+            env.copyfd(write_fd, compact=compact)
+        except lmdb.Error as ex:
+            # e.g. the stream has been closed.
+            return ex
+        finally:
+            os.close(write_fd)
+
+    try:
+        make_nonblocking(read_fd)
+        result = gevent.get_hub().threadpool.spawn(copy)
+        while True:
+            chunk = nb_read(read_fd, chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+        error = result.get()
+        if error is not None:
+            raise DataError(error.message)
+    finally:
+        os.close(read_fd)
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+Read-through cache of store values.
+
+Write paths invalidate the keys they touch both when a write is applied and
+once its transaction ends, and each invalidation bumps the cache's version.
+A value read from the database is cached only if no invalidation happened
+since the read began, so a read racing a commit can't leave a stale value
+behind.
+"""
+from __future__ import (absolute_import, division, unicode_literals)
+
+import threading
+from collections import OrderedDict
+
+# distinguishes a miss from a cached None, i.e. a record known not to exist.
+MISSING = object()
+
+
+class LRUCache(object):
+    """
+    A cache bounded by the number of entries, the bytes of keys and values,
+    or both, which evicts the least recently used entries first.
+    """
+    def __init__(self, max_entries=1000, max_bytes=0):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.version = 0
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        # writes may be committed on the threadpool.
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """
+        Looks up a key.
+
+        :return: the cached value, or MISSING.
+        """
+        with self._lock:
+            value = self._entries.pop(key, MISSING)
+            if value is MISSING:
+                self.misses += 1
+                return MISSING
+            self._entries[key] = value
+            self.hits += 1
+            return value
+
+    def put(self, key, value, version):
+        """
+        Caches a value read from the database.
+
+        :param version: the cache's version when the read began.
+        """
+        with self._lock:
+            if version != self.version:
+                return
+            self._remove(key)
+            self._entries[key] = value
+            self.size += self._weight(key, value)
+            while self._entries and (
+                    (self.max_entries and
+                     len(self._entries) > self.max_entries) or
+                    (self.max_bytes and self.size > self.max_bytes)):
+                old_key, old_value = self._entries.popitem(last=False)
+                self.size -= self._weight(old_key, old_value)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            self.version += 1
+            self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self.version += 1
+            self._entries.clear()
+            self.size = 0
+
+    def stats(self):
+        """
+        Gets the cache's size and counters.
+
+        :return: a dict of metrics.
+        """
+        return dict(entries=len(self._entries),
+                    size=self.size,
+                    hits=self.hits,
+                    misses=self.misses,
+                    evictions=self.evictions)
+
+    def _remove(self, key):
+        value = self._entries.pop(key, MISSING)
+        if value is not MISSING:
+            self.size -= self._weight(key, value)
+
+    @staticmethod
+    def _weight(key, value):
+        if value is None:
+            return len(key)
+        return len(key) + len(value)
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+"""
+Change log of stores.
+
+Every mutation of a store is recorded in an append-only database, in the
+same transaction as the mutation, under an 8-byte big-endian sequence
+number. Consumers tail the log from a sequence number and acknowledge what
+they've processed; entries acknowledged by all consumers are truncated.
+"""
+from __future__ import (absolute_import, division, unicode_literals)
+
+import struct
+import logging
+from collections import namedtuple
+
+import gevent
+import lmdb
+from gevent.event import Event
+from msgpack import packb, unpackb
+
+from ava.spi.errors import DataError
+
+logger = logging.getLogger(__name__)
+
+_SEQ_FORMAT = b'>Q'
+
+Change = namedtuple('Change', 'seq store key op')
+
+
+def _pack_seq(seq):
+    return struct.pack(_SEQ_FORMAT, seq)
+
+
+def _unpack_seq(packed):
+    return struct.unpack(_SEQ_FORMAT, packed)[0]
+
+
+class ChangeLog(object):
+    """
+    The change log of a data engine. Tails wait on an event which is set,
+    through an async watcher, whenever a write transaction commits, so they
+    can be woken up from the threadpool as well.
+    """
+    def __init__(self, _log_db, _consumers_db, _engine, truncate_batch=1000):
+        self._log_db = _log_db
+        self._consumers_db = _consumers_db
+        self._engine = _engine
+        self.truncate_batch = truncate_batch
+        self._available = Event()
+        self._watcher = gevent.get_hub().loop.async()
+        self._watcher.start(self._available.set)
+        self.seq = self._last_seq()
+
+    def _last_seq(self):
+        seq = 0
+        with self._engine.database.begin() as txn:
+            cur = txn.cursor(self._log_db)
+            if cur.last():
+                seq = _unpack_seq(cur.key())
+            # sequence numbers aren't reused after the log is truncated.
+            for packed in txn.cursor(self._consumers_db).iternext(keys=False):
+                seq = max(seq, _unpack_seq(packed))
+        return seq
+
+    def close(self):
+        self._watcher.stop()
+
+    def record(self, txn, store_name, key, op):
+        """
+        Appends an entry within a write transaction. Numbers taken by an
+        aborted transaction are skipped, so the sequence may have gaps.
+        """
+        self.seq += 1
+        if not txn.put(_pack_seq(self.seq), packb([store_name, key, op]),
+                       db=self._log_db, append=True):
+            raise DataError("Change %d isn't after the last one logged."
+                            % self.seq)
+
+    def notify(self):
+        """
+        Wakes up tails after a commit. It's safe to call from any thread.
+        """
+        self._watcher.send()
+
+    def read(self, since=0, limit=1000):
+        """
+        Reads entries after a sequence number.
+
+        :return: a list of Change tuples.
+        """
+        changes = []
+        with self._engine.database.begin() as txn:
+            cur = txn.cursor(self._log_db)
+            positioned = cur.set_range(_pack_seq(since + 1))
+            while positioned and len(changes) < limit:
+                store_name, key, op = unpackb(cur.value())
+                changes.append(Change(_unpack_seq(cur.key()), store_name,
+                                      key, op))
+                positioned = cur.next()
+        return changes
+
+    def tail(self, since=None, consumer=None, timeout=None, batch=1000):
+        """
+        Streams entries after a sequence number, waiting for new ones once
+        caught up, without blocking other greenlets.
+
+        :param since: the sequence number to start after; defaults to the
+            consumer's acknowledged one, or the start of the log.
+        :param consumer: the consumer's name.
+        :param timeout: the seconds to wait for new entries before the
+            stream ends; None to wait forever.
+        :param batch: the maximum entries read in a transaction.
+        :return: a generator of Change tuples.
+        """
+        if since is None:
+            since = self.position(consumer) if consumer is not None else 0
+
+        while True:
+            # no greenlet switch happens between clearing the event and
+            # reading, so no commit can be missed.
+            self._available.clear()
+            changes = self.read(since, batch)
+            if changes:
+                for change in changes:
+                    yield change
+                since = changes[-1].seq
+                continue
+            if not self._available.wait(timeout):
+                return
+
+    def position(self, consumer):
+        """
+        Gets the sequence number a consumer has acknowledged up to.
+
+        :return: the sequence number, or 0 if the consumer is unknown.
+        """
+        consumer = _encode_name(consumer)
+        with self._engine.database.begin() as txn:
+            packed = txn.get(consumer, db=self._consumers_db)
+        return 0 if packed is None else _unpack_seq(packed)
+
+    def consumers(self):
+        """
+        :return: a dict of the sequence numbers acknowledged by consumers.
+        """
+        with self._engine.database.begin() as txn:
+            cur = txn.cursor(self._consumers_db)
+            return dict((name, _unpack_seq(packed)) for name, packed in cur)
+
+    def ack(self, consumer, seq):
+        """
+        Acknowledges the entries up to a sequence number for a consumer,
+        which is registered by its first acknowledgement. Entries
+        acknowledged by all consumers are truncated, at most
+        `truncate_batch` of them at a time.
+
+        :return: the number of entries truncated.
+        """
+        consumer = _encode_name(consumer)
+        try:
+            return self._engine.write(self._ack, consumer, seq)
+        except lmdb.Error as ex:
+            logger.exception("Failed to acknowledge changes.")
+            raise DataError(ex.message)
+
+    def _ack(self, txn, consumer, seq):
+        packed = txn.get(consumer, db=self._consumers_db)
+        if packed is None or _unpack_seq(packed) < seq:
+            txn.put(consumer, _pack_seq(seq), db=self._consumers_db)
+
+        acked = min(_unpack_seq(it) for it in
+                    txn.cursor(self._consumers_db).iternext(keys=False))
+        count = 0
+        cur = txn.cursor(self._log_db)
+        while count < self.truncate_batch and cur.first() and \
+                _unpack_seq(cur.key()) <= acked:
+            cur.delete()
+            count += 1
+        return count
+
+    def remove_consumer(self, consumer):
+        consumer = _encode_name(consumer)
+        return self._engine.write(
+            lambda txn: txn.delete(consumer, db=self._consumers_db))
+
+
+def _encode_name(name):
+    if isinstance(name, unicode):
+        return name.encode('utf-8')
+    return name
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""
+Value compression for stores.
+
+A compressed value starts with a header of a magic marker and a codec byte.
+Values without the marker are raw, so data written before compression was
+enabled stays readable, and small values are kept raw without a header. A
+raw value which happens to start with the marker is escaped with the raw
+codec's header.
+"""
+from __future__ import (absolute_import, division, unicode_literals)
+
+import zlib
+
+MAGIC = b'\x1fz'
+_RAW = MAGIC + b'\x00'
+_ZLIB = MAGIC + b'\x01'
+_HEADER_SIZE = len(_RAW)
+
+
+def escape(value):
+    """
+    Encodes a value to be written raw.
+    """
+    if value[:2] == MAGIC:
+        return _RAW + value
+    return value
+
+
+def decode(value):
+    """
+    Decodes a value read from a store.
+
+    :param value: the stored value, a string or buffer, or None.
+    :return: the original value.
+    """
+    if value is None or value[:2] != MAGIC:
+        return value
+
+    header = value[:_HEADER_SIZE]
+    if header == _ZLIB:
+        try:
+            return zlib.decompress(buffer(value, _HEADER_SIZE))
+        except zlib.error:
+            # a raw value written before values were escaped.
+            return value
+    if header == _RAW:
+        return value[_HEADER_SIZE:]
+    return value
+
+
+class Compressor(object):
+    """
+    Compresses values of a store with zlib. Values shorter than `threshold`
+    bytes, or which don't shrink, are written raw.
+    """
+    def __init__(self, level=6, threshold=512):
+        self.level = level
+        self.threshold = threshold
+
+    def encode(self, value):
+        if len(value) < self.threshold:
+            return escape(value)
+
+        compressed = zlib.compress(value, self.level)
+        if len(compressed) + _HEADER_SIZE >= len(value):
+            return escape(value)
+        return _ZLIB + compressed
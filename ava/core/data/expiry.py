@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""
+Expiry of records.
+
+Deadlines of a store's records are kept in two companion databases: one
+maps record keys to deadlines, and the other is ordered by deadline for
+sweeping. Hence, a sweep visits only the records which have expired.
+Deadlines are kept as 8-byte big-endian milliseconds since the epoch.
+"""
+from __future__ import (absolute_import, division, unicode_literals)
+
+import time
+import struct
+
+_DEADLINE_FORMAT = b'>Q'
+_DEADLINE_SIZE = struct.calcsize(_DEADLINE_FORMAT)
+
+
+def now_ms():
+    return int(time.time() * 1000)
+
+
+def deadline_of(ttl):
+    """
+    Gets the deadline of a record which lives for the given seconds.
+    """
+    return now_ms() + int(ttl * 1000)
+
+
+class Expiry(object):
+    """
+    Deadlines of a store's records, which are updated in the same
+    transactions as the records.
+    """
+    def __init__(self, _deadline_db, _order_db):
+        self._deadline_db = _deadline_db
+        self._order_db = _order_db
+
+    def deadline(self, txn, key):
+        """
+        :return: the record's deadline in milliseconds, or None if it
+            doesn't expire.
+        """
+        packed = txn.get(key, db=self._deadline_db)
+        if packed is None:
+            return None
+        return struct.unpack(_DEADLINE_FORMAT, packed)[0]
+
+    def is_expired(self, txn, key, now=None):
+        deadline = self.deadline(txn, key)
+        if deadline is None:
+            return False
+        if now is None:
+            now = now_ms()
+        return deadline <= now
+
+    def set(self, txn, key, deadline):
+        self.clear(txn, key)
+        packed = struct.pack(_DEADLINE_FORMAT, deadline)
+        txn.put(key, packed, db=self._deadline_db)
+        txn.put(packed + key, b'', db=self._order_db)
+
+    def clear(self, txn, key):
+        packed = txn.pop(key, db=self._deadline_db)
+        if packed is not None:
+            txn.delete(packed + key, db=self._order_db)
+
+    def expired_keys(self, txn, now, limit):
+        """
+        Gets keys of records expired by the given time, earliest first.
+
+        :param now: the time in milliseconds.
+        :param limit: the maximum number of keys.
+        """
+        keys = []
+        cur = txn.cursor(self._order_db)
+        stop = struct.pack(_DEADLINE_FORMAT, now)
+        positioned = cur.first()
+        while positioned and len(keys) < limit:
+            key = cur.key()
+            if key[:_DEADLINE_SIZE] > stop:
+                break
+            keys.append(key[_DEADLINE_SIZE:])
+            positioned = cur.next()
+        return keys
@@ -0,0 +1,491 @@
+# -*- coding: utf-8 -*-
+"""
+Frozen stores: immutable sorted tables for read-only datasets.
+
+A table is a file of records sorted by key, followed by a fixed-width
+index of their offsets and a footer. It's memory-mapped and queried by
+binary search, so opening one costs nothing and lookups need no
+transactions. A new version is built next to the old one and renamed over
+it, which readers pick up on reload().
+
+Layout, integers being big-endian:
+
+    header:  magic (4 bytes) + version (1 byte)
+    records: key length (4) + value length (4) + key + value, by key
+    index:   record offsets (8 each)
+    footer:  index offset (8) + record count (8) + magic (4)
+"""
+from __future__ import (absolute_import, division, unicode_literals)
+
+import os
+import mmap
+import struct
+import logging
+import bisect
+import tempfile
+import itertools
+
+from ava.spi.errors import DataError, DataNotFoundError
+from ava.spi.stores import IStore, ICursor
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'AVAF'
+VERSION = 1
+
+_HEADER = struct.Struct(b'>4sB')
+_RECORD = struct.Struct(b'>II')
+_OFFSET = struct.Struct(b'>Q')
+_FOOTER = struct.Struct(b'>QQ4s')
+_KEY_LENGTH = struct.Struct(b'>I')
+
+# every this many keys are kept in memory to narrow down binary searches.
+FENCE_STEP = 8
+
+# the directory of tables under the data path, and their file extension.
+TABLES_DIR = b'frozen'
+TABLE_EXT = b'.tbl'
+
+
+def _encode_key(key):
+    if isinstance(key, unicode):
+        return key.encode('utf-8')
+    return key
+
+
+class FrozenBuilder(object):
+    """
+    Writes a table from records streamed in strictly increasing key order.
+    The table is written to a temporary file which is renamed to the path
+    when it's finished, so readers see either version in full.
+    """
+    def __init__(self, path):
+        self.path = path
+        dirname = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        fd, self._tmp_path = tempfile.mkstemp(dir=dirname, suffix='.tmp')
+        self._file = os.fdopen(fd, 'wb')
+        # offsets are spooled to disk, so memory use doesn't grow with size.
+        self._offsets = tempfile.TemporaryFile(dir=dirname)
+        self._file.write(_HEADER.pack(MAGIC, VERSION))
+        self._pos = _HEADER.size
+        self.count = 0
+        self.last = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.finish()
+        else:
+            self.abort()
+
+    def add(self, key, value):
+        key = _encode_key(key)
+        if self.last is not None and key <= self.last:
+            raise DataError("Keys must be added in increasing order: %r" %
+                            key)
+        if value is None:
+            raise DataError("Value can't be None.")
+        self._offsets.write(_OFFSET.pack(self._pos))
+        self._file.write(_RECORD.pack(len(key), len(value)))
+        self._file.write(key)
+        self._file.write(value)
+        self._pos += _RECORD.size + len(key) + len(value)
+        self.count += 1
+        self.last = key
+
+    def finish(self):
+        """
+        Writes the index and the footer, then renames the table into place.
+
+        :return: the number of records.
+        """
+        index_offset = self._pos
+        self._offsets.seek(0)
+        while True:
+            chunk = self._offsets.read(65536)
+            if not chunk:
+                break
+            self._file.write(chunk)
+        self._offsets.close()
+        self._file.write(_FOOTER.pack(index_offset, self.count, MAGIC))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        os.rename(self._tmp_path, self.path)
+        logger.debug("Built table %s of %d records.", self.path, self.count)
+        return self.count
+
+    def abort(self):
+        self._offsets.close()
+        self._file.close()
+        os.remove(self._tmp_path)
+
+
+def table_paths(datapath, paths=()):
+    """
+    Gets the paths of the tables under a data path, relative to it: those
+    in the tables directory, and those of the given paths which exist.
+    """
+    found = set(path for path in paths
+                if os.path.isfile(os.path.join(datapath, path)))
+    dirname = os.path.join(datapath, TABLES_DIR)
+    if os.path.isdir(dirname):
+        found.update(os.path.join(TABLES_DIR, name)
+                     for name in os.listdir(dirname)
+                     if name.endswith(TABLE_EXT))
+    return sorted(found)
+
+
+def build(path, items):
+    """
+    Builds a table from (key, value) pairs sorted by key.
+
+    :return: the number of records.
+    """
+    with FrozenBuilder(path) as builder:
+        for key, value in items:
+            builder.add(key, value)
+    return builder.count
+
+
+class FrozenTable(object):
+    """
+    A memory-mapped table. Positions are record numbers in key order.
+    Every FENCE_STEP-th key is read into a list when it's opened, so a
+    search bisects the list natively and then only probes one block of
+    records in the map.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            self.identity = (stat.st_ino, stat.st_mtime, stat.st_size)
+            if stat.st_size < _HEADER.size + _FOOTER.size:
+                raise DataError("Not a frozen table: %s" % path)
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version = _HEADER.unpack_from(self._map, 0)
+        index_offset, self.count, end_magic = _FOOTER.unpack_from(
+            self._map, len(self._map) - _FOOTER.size)
+        if magic != MAGIC or end_magic != MAGIC:
+            raise DataError("Not a frozen table: %s" % path)
+        if version != VERSION:
+            raise DataError("Unsupported table version: %d" % version)
+        self._index_offset = index_offset
+        self._fences = [self.key_at(pos) for pos in
+                        xrange(0, self.count, FENCE_STEP)]
+
+    def __len__(self):
+        return self.count
+
+    def _offsets(self, pos, size):
+        start = self._index_offset + pos * 8
+        return struct.unpack(b'>%dQ' % size, self._map[start:start + size * 8])
+
+    def _key_of(self, offset):
+        key_len = _KEY_LENGTH.unpack(self._map[offset:offset + 4])[0]
+        return self._map[offset + 8:offset + 8 + key_len]
+
+    def key_at(self, pos):
+        return self._key_of(self._offsets(pos, 1)[0])
+
+    def item_at(self, pos):
+        return self._item_of(self._offsets(pos, 1)[0])
+
+    def _item_of(self, offset):
+        _map = self._map
+        key_len, value_len = _RECORD.unpack(_map[offset:offset + 8])
+        start = offset + 8
+        end = start + key_len
+        return _map[start:end], _map[end:end + value_len]
+
+    def bisect(self, key, after_prefix=False):
+        """
+        Finds the position of the first record whose key isn't lower than
+        the given one, or, with `after_prefix`, the first one after the keys
+        starting with it. It's the count if there's none.
+        """
+        if after_prefix:
+            size = len(key)
+            below = lambda found: found[:size] <= key
+            block = bisect.bisect_right([it[:size] for it in self._fences],
+                                        key)
+        else:
+            below = lambda found: found < key
+            block = bisect.bisect_left(self._fences, key)
+        # the position is in the block before the first fence not below.
+        if block == 0:
+            return 0
+        return self._search_block(block - 1, below)[0]
+
+    def _search_block(self, block, below):
+        """
+        Binary-searches a block for the first record for which `below` is
+        false, reading the block's offsets at once.
+
+        :return: a tuple of (position, offset), where the offset is None if
+            the position is past the block.
+        """
+        lo = block * FENCE_STEP
+        size = min(FENCE_STEP, self.count - lo)
+        offsets = self._offsets(lo, size)
+        first, last = 0, size
+        while first < last:
+            mid = (first + last) // 2
+            if below(self._key_of(offsets[mid])):
+                first = mid + 1
+            else:
+                last = mid
+        return lo + first, offsets[first] if first < size else None
+
+    def get(self, key):
+        fences = self._fences
+        block = bisect.bisect_right(fences, key) - 1
+        if block < 0:
+            return None
+        _map = self._map
+        lo = block * FENCE_STEP
+        if fences[block] == key:
+            size = 1
+        else:
+            size = min(FENCE_STEP, self.count - lo)
+        # the search is inlined, as this is the hot path.
+        start = self._index_offset + lo * 8
+        offsets = struct.unpack(b'>%dQ' % size, _map[start:start + size * 8])
+        first, last = 0, size
+        while first < last:
+            mid = (first + last) // 2
+            at = offsets[mid]
+            key_len, value_len = _RECORD.unpack(_map[at:at + 8])
+            found = _map[at + 8:at + 8 + key_len]
+            if found == key:
+                at += 8 + key_len
+                return _map[at:at + value_len]
+            if found < key:
+                first = mid + 1
+            else:
+                last = mid
+        return None
+
+    def close(self):
+        self._map.close()
+
+
+def _positions(table, start, stop, prefix):
+    """
+    Finds the positions [first, end) of the records of a table in the range
+    [start, stop) with the given prefix.
+    """
+    first, end = 0, table.count
+    if start is not None:
+        first = table.bisect(_encode_key(start))
+    if stop is not None:
+        end = table.bisect(_encode_key(stop))
+    if prefix is not None:
+        prefix = _encode_key(prefix)
+        first = max(first, table.bisect(prefix))
+        end = min(end, table.bisect(prefix, after_prefix=True))
+    return first, max(first, end)
+
+
+class FrozenStore(IStore):
+    """
+    A read-only store backed by a frozen table. Mutations raise DataError;
+    new versions are installed by building a table at the same path and
+    calling reload().
+    """
+    def __init__(self, name, path):
+        self.name = name
+        self.path = path
+        self.table = FrozenTable(path)
+
+    def reload(self):
+        """
+        Switches to the table at the path if it has been replaced. The old
+        table stays mapped until no cursor or scan uses it any more.
+
+        :return: True if a new table was loaded.
+        """
+        stat = os.stat(self.path)
+        if (stat.st_ino, stat.st_mtime, stat.st_size) == self.table.identity:
+            return False
+        logger.debug("Reloading frozen store: %s", self.name)
+        self.table = FrozenTable(self.path)
+        return True
+
+    def __len__(self):
+        return len(self.table)
+
+    def __getitem__(self, key):
+        return self.get(key)
+
+    def __iter__(self):
+        return self.scan(values=False)
+
+    def _read_only(self, *args, **kwargs):
+        raise DataError("Frozen stores are read-only.")
+
+    put = remove = put_many = remove_many = _read_only
+    incr = incr_many = compare_and_swap = update = _read_only
+    remove_range = expire = create_index = _read_only
+    __setitem__ = __delitem__ = _read_only
+
+    def ttl(self, key):
+        return None
+
+    def get(self, key):
+        return self.table.get(_encode_key(key))
+
+    def cursor(self, readonly=True, buffers=False):
+        if not readonly:
+            self._read_only()
+        return FrozenCursor(self.table)
+
+    def read_view(self, buffers=True):
+        return self.cursor()
+
+    def scan(self, start=None, stop=None, prefix=None, reverse=False,
+             limit=None, keys=True, values=True):
+        """
+        Streams records in key order from the table loaded when the scan
+        starts.
+        """
+        table = self.table
+        first, end = _positions(table, start, stop, prefix)
+        positions = xrange(first, end)
+        if reverse:
+            positions = reversed(positions)
+        for pos in itertools.islice(positions, limit):
+            if keys and values:
+                yield table.item_at(pos)
+            elif values:
+                yield table.item_at(pos)[1]
+            else:
+                yield table.key_at(pos)
+
+    def count(self, start=None, stop=None, prefix=None):
+        """
+        Counts the records in a range exactly, from the positions of its
+        bounds.
+        """
+        first, end = _positions(self.table, start, stop, prefix)
+        return end - first
+
+    approx_count = count
+
+    def first_key(self, start=None, stop=None, prefix=None):
+        table = self.table
+        first, end = _positions(table, start, stop, prefix)
+        return table.key_at(first) if first < end else None
+
+    def last_key(self, start=None, stop=None, prefix=None):
+        table = self.table
+        first, end = _positions(table, start, stop, prefix)
+        return table.key_at(end - 1) if first < end else None
+
+    def get_index(self, name):
+        return None
+
+    def drop_index(self, name):
+        return False
+
+
+class FrozenCursor(ICursor):
+    """
+    A cursor over a frozen table. It keeps the table it was opened on,
+    even if the store reloads another.
+    """
+    def __init__(self, table):
+        self._table = table
+        self._pos = -1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _at(self, pos):
+        if 0 <= pos < self._table.count:
+            self._pos = pos
+            return True
+        self._pos = -1
+        return False
+
+    def first(self):
+        return self._at(0)
+
+    def last(self):
+        return self._at(self._table.count - 1)
+
+    def next(self):
+        return self._at(self._pos + 1) if self._pos >= 0 else False
+
+    def prev(self):
+        return self._at(self._pos - 1) if self._pos >= 0 else False
+
+    def iternext(self, keys=True, values=False):
+        if self._pos < 0 and not self.first():
+            return
+        while self._pos >= 0:
+            yield self._item(keys, values)
+            self.next()
+
+    def iterprev(self, keys=True, values=False):
+        if self._pos < 0 and not self.last():
+            return
+        while self._pos >= 0:
+            yield self._item(keys, values)
+            self.prev()
+
+    def _item(self, keys, values):
+        if keys and values:
+            return self._table.item_at(self._pos)
+        if values:
+            return self._table.item_at(self._pos)[1]
+        return self._table.key_at(self._pos)
+
+    def key(self):
+        return self._table.key_at(self._pos) if self._pos >= 0 else b''
+
+    def value(self):
+        return self._table.item_at(self._pos)[1] if self._pos >= 0 else b''
+
+    def get(self, key):
+        return self._table.get(_encode_key(key))
+
+    def load(self, key):
+        value = self.get(key)
+        if value is None:
+            raise DataNotFoundError()
+        return value
+
+    def exists(self, key):
+        return self.get(key) is not None
+
+    def seek(self, key):
+        key = _encode_key(key)
+        pos = self._table.bisect(key)
+        if self._at(pos) and self._table.key_at(pos) == key:
+            return True
+        self._pos = -1
+        return False
+
+    def seek_range(self, key):
+        return self._at(self._table.bisect(_encode_key(key)))
+
+    def count(self):
+        return 1 if self._pos >= 0 else 0
+
+    def close(self):
+        self._pos = -1
+
+    def _read_only(self, *args, **kwargs):
+        raise DataError("Frozen stores are read-only.")
+
+    put = remove = delete = pop = post = append = expire = _read_only
+    incr = compare_and_swap = update = _read_only
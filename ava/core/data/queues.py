@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+"""
+Durable queues kept in the data engine.
+
+Messages waiting for delivery are kept in a database ordered by sequence
+numbers. A delivered message is moved to a database of in-flight messages,
+ordered by the deadline of its visibility timeout, until it's acknowledged.
+If it's not acknowledged in time, it's moved back and delivered again.
+"""
+from __future__ import (absolute_import, division, unicode_literals)
+
+import time
+import struct
+import logging
+import lmdb
+from gevent.event import Event
+
+from ava.spi.errors import DataError
+
+logger = logging.getLogger(__name__)
+
+_SEQ_FORMAT = b'>Q'
+_SEQ_SIZE = struct.calcsize(_SEQ_FORMAT)
+
+
+def _pack_seq(seq):
+    return struct.pack(_SEQ_FORMAT, seq)
+
+
+def _unpack_seq(key):
+    return struct.unpack(_SEQ_FORMAT, key[:_SEQ_SIZE])[0]
+
+
+def _pack_deadline(deadline):
+    # deadlines are kept in milliseconds.
+    return struct.pack(_SEQ_FORMAT, int(deadline * 1000))
+
+
+def _unpack_deadline(receipt):
+    return struct.unpack(_SEQ_FORMAT, receipt[:_SEQ_SIZE])[0] / 1000.0
+
+
+class Message(object):
+    """
+    A message delivered from a queue.
+    """
+    def __init__(self, key, value, receipt):
+        self.key = key
+        self.value = value
+        # identifies the delivery for acknowledging it.
+        self.receipt = receipt
+
+    def __repr__(self):
+        return "Message(%r, %r)" % (self.key, self.value)
+
+
+class Queue(object):
+    """
+    A durable FIFO queue with at-least-once delivery. Consumers block on an
+    event which is set whenever messages are put or returned to the queue,
+    so nothing is polled.
+    """
+    def __init__(self, name, _ready_db, _inflight_db, _engine,
+                 visibility_timeout=30):
+        self.name = name
+        self.visibility_timeout = visibility_timeout
+        self._ready_db = _ready_db
+        self._inflight_db = _inflight_db
+        self._engine = _engine
+        self._available = Event()
+        self._seq = self._last_seq()
+        self.puts = 0
+        self.deliveries = 0
+        self.acks = 0
+        self.nacks = 0
+        self.redeliveries = 0
+
+    def _last_seq(self):
+        seq = 0
+        with self._engine.database.begin() as txn:
+            cur = txn.cursor(self._ready_db)
+            if cur.last():
+                seq = _unpack_seq(cur.key())
+            cur = txn.cursor(self._inflight_db)
+            for receipt in cur.iternext(values=False):
+                seq = max(seq, _unpack_seq(receipt[_SEQ_SIZE:]))
+        return seq
+
+    def __len__(self):
+        with self._engine.database.begin() as txn:
+            return txn.stat(self._ready_db)['entries']
+
+    def put(self, value):
+        """
+        Appends a message.
+
+        :param value: the message's value.
+        :return: the message's key.
+        """
+        return self.put_many([value])[0]
+
+    def put_many(self, values):
+        """
+        Appends messages in one write transaction.
+
+        :param values: an iterable of values.
+        :return: the keys of the messages.
+        """
+        values = list(values)
+
+        def append(txn):
+            cur = txn.cursor(self._ready_db)
+            keys = []
+            for i, value in enumerate(values):
+                key = _pack_seq(self._seq + i + 1)
+                if not cur.put(key, value, append=True):
+                    raise DataError("Message %d isn't after the last one "
+                                    "queued." % (self._seq + i + 1))
+                keys.append(key)
+            return keys
+
+        try:
+            keys = self._engine.write(append)
+        except lmdb.Error as ex:
+            logger.exception("Failed to put messages.")
+            raise DataError(str(ex))
+
+        self._seq += len(keys)
+        self.puts += len(keys)
+        self._available.set()
+        return keys
+
+    def get(self, timeout=None, visibility_timeout=None):
+        """
+        Takes the first message, waiting for one if the queue is empty.
+
+        :param timeout: the maximum seconds to wait; None to wait forever.
+        :param visibility_timeout: seconds before the message is delivered
+            again unless acknowledged.
+        :return: the message, or None if timed out.
+        """
+        messages = self.get_batch(1, timeout, visibility_timeout)
+        if messages:
+            return messages[0]
+        return None
+
+    def get_batch(self, n, timeout=None, visibility_timeout=None):
+        """
+        Takes up to `n` messages in one write transaction, waiting for at
+        least one if the queue is empty.
+
+        :param n: the maximum number of messages.
+        :param timeout: the maximum seconds to wait; None to wait forever.
+        :param visibility_timeout: seconds before the messages are delivered
+            again unless acknowledged.
+        :return: a list of messages, which is empty if timed out.
+        """
+        if visibility_timeout is None:
+            visibility_timeout = self.visibility_timeout
+        if timeout is not None:
+            timeout_at = time.time() + timeout
+
+        while True:
+            # no greenlet switch happens between clearing the event and
+            # taking messages, so no put can be missed.
+            self._available.clear()
+            messages, next_deadline = self._take(n, visibility_timeout)
+            if messages:
+                return messages
+
+            now = time.time()
+            wait = None
+            if timeout is not None:
+                wait = timeout_at - now
+                if wait <= 0:
+                    return []
+            if next_deadline is not None:
+                wait = next_deadline - now if wait is None \
+                    else min(wait, next_deadline - now)
+            self._available.wait(wait)
+
+    def _take(self, n, visibility_timeout):
+        now = time.time()
+
+        def take(txn):
+            requeued = self._requeue_expired(txn, now)
+
+            messages = []
+            ready = txn.cursor(self._ready_db)
+            deadline = _pack_deadline(now + visibility_timeout)
+            while len(messages) < n and ready.first():
+                key, value = ready.item()
+                ready.delete()
+                receipt = deadline + key
+                txn.put(receipt, value, db=self._inflight_db)
+                messages.append(Message(key, value, receipt))
+
+            next_deadline = None
+            inflight = txn.cursor(self._inflight_db)
+            if inflight.first():
+                next_deadline = _unpack_deadline(inflight.key())
+            return messages, next_deadline, requeued
+
+        try:
+            messages, next_deadline, requeued = self._engine.write(take)
+        except lmdb.Error as ex:
+            logger.exception("Failed to take messages.")
+            raise DataError(str(ex))
+
+        self.redeliveries += requeued
+        self.deliveries += len(messages)
+        return messages, next_deadline
+
+    def _requeue_expired(self, txn, now):
+        inflight = txn.cursor(self._inflight_db)
+        expired = _pack_deadline(now)
+        count = 0
+        while inflight.first() and inflight.key()[:_SEQ_SIZE] <= expired:
+            receipt, value = inflight.item()
+            txn.put(receipt[_SEQ_SIZE:], value, db=self._ready_db)
+            inflight.delete()
+            count += 1
+        return count
+
+    def ack(self, message):
+        """
+        Acknowledges a delivered message, which is then removed for good.
+
+        :param message: the message or its receipt.
+        :return: False if the delivery has expired or was acknowledged.
+        """
+        receipt = getattr(message, 'receipt', message)
+        try:
+            ret = self._engine.write(
+                lambda txn: txn.delete(receipt, db=self._inflight_db))
+        except lmdb.Error as ex:
+            logger.exception("Failed to acknowledge message.")
+            raise DataError(str(ex))
+        if ret:
+            self.acks += 1
+        return ret
+
+    def nack(self, message):
+        """
+        Returns a delivered message to the queue for immediate redelivery.
+        It keeps its place ahead of messages put after it.
+
+        :param message: the message or its receipt.
+        :return: False if the delivery has expired or was acknowledged.
+        """
+        receipt = getattr(message, 'receipt', message)
+
+        def requeue(txn):
+            value = txn.pop(receipt, db=self._inflight_db)
+            if value is not None:
+                txn.put(receipt[_SEQ_SIZE:], value, db=self._ready_db)
+            return value
+
+        try:
+            value = self._engine.write(requeue)
+        except lmdb.Error as ex:
+            logger.exception("Failed to return message.")
+            raise DataError(str(ex))
+        if value is None:
+            return False
+        self.nacks += 1
+        self._available.set()
+        return True
+
+    def stats(self):
+        """
+        Gets the queue's depth and delivery counters since it was opened.
+
+        :return: a dict of metrics.
+        """
+        with self._engine.database.begin() as txn:
+            ready = txn.stat(self._ready_db)['entries']
+            inflight = txn.stat(self._inflight_db)['entries']
+        return dict(ready=ready,
+                    inflight=inflight,
+                    puts=self.puts,
+                    deliveries=self.deliveries,
+                    acks=self.acks,
+                    nacks=self.nacks,
+                    redeliveries=self.redeliveries)
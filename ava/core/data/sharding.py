@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+"""
+Stores sharded across LMDB environments.
+
+Each environment has its own writer lock, so writes to different shards
+can be committed concurrently when they're offloaded to the threadpool. A record's shard is
+chosen by the CRC-32 of its key; scans merge the shards in key order.
+"""
+from __future__ import (absolute_import, division, unicode_literals)
+
+import heapq
+import zlib
+from collections import Mapping
+
+import gevent
+
+from ava.spi.errors import DataError
+from ava.spi.stores import IStore
+
+
+def shard_of(key, count):
+    """
+    Gets the index of the shard keeping a key.
+    """
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    return (zlib.crc32(key) & 0xffffffff) % count
+
+
+def _merge(streams, reverse):
+    """
+    Merges streams of (key, value) pairs which are sorted by key.
+    """
+    heap = []
+    for i, it in enumerate(streams):
+        for key, value in it:
+            heap.append((_order(key, reverse), i, key, value, it))
+            break
+    heapq.heapify(heap)
+
+    while heap:
+        _, i, key, value, it = heap[0]
+        yield key, value
+        for key, value in it:
+            heapq.heapreplace(heap, (_order(key, reverse), i, key, value, it))
+            break
+        else:
+            heapq.heappop(heap)
+
+
+class _Descending(object):
+    __slots__ = ('key',)
+
+    def __init__(self, key):
+        self.key = key
+
+    def __lt__(self, other):
+        return self.key > other.key
+
+    def __eq__(self, other):
+        return self.key == other.key
+
+
+def _order(key, reverse):
+    return _Descending(key) if reverse else key
+
+
+def _scan_shard(shard, start, stop, prefix, reverse, limit, values):
+    """
+    Scans a shard for (key, value) pairs, whose values are None if they
+    aren't read.
+    """
+    if values:
+        return shard.scan(start=start, stop=stop, prefix=prefix,
+                          reverse=reverse, limit=limit)
+    return ((key, None) for key in shard.scan(start=start, stop=stop,
+                                              prefix=prefix, reverse=reverse,
+                                              limit=limit, values=False))
+
+
+class ShardedStore(IStore):
+    """
+    A store whose records are spread over stores of the same name in
+    several environments. Secondary indexes, cursors and batches are
+    bound to a single transaction, so they aren't supported.
+    """
+    def __init__(self, name, shards, _engine):
+        self.name = name
+        # the stores of the shards, in shard order.
+        self.shards = shards
+        self._engine = _engine
+
+    def shard(self, key):
+        """
+        Gets the store of the shard keeping a key.
+        """
+        return self.shards[shard_of(key, len(self.shards))]
+
+    def __len__(self):
+        return sum(len(it) for it in self.shards)
+
+    def __getitem__(self, key):
+        return self.get(key)
+
+    def __setitem__(self, key, value):
+        self.put(key, value)
+
+    def __delitem__(self, key):
+        self.remove(key)
+
+    def __iter__(self):
+        return self.scan(values=False)
+
+    def put(self, key, value, ttl=None):
+        return self.shard(key).put(key, value, ttl)
+
+    def expire(self, key, ttl):
+        return self.shard(key).expire(key, ttl)
+
+    def ttl(self, key):
+        return self.shard(key).ttl(key)
+
+    def get(self, key):
+        return self.shard(key).get(key)
+
+    def remove(self, key):
+        return self.shard(key).remove(key)
+
+    def incr(self, key, delta=1, ttl=None):
+        return self.shard(key).incr(key, delta, ttl)
+
+    def compare_and_swap(self, key, expected, new):
+        return self.shard(key).compare_and_swap(key, expected, new)
+
+    def update(self, key, func):
+        return self.shard(key).update(key, func)
+
+    def cursor(self, readonly=True, buffers=False):
+        raise DataError("Cursors aren't supported by sharded stores.")
+
+    def read_view(self, buffers=True):
+        raise DataError("Read views aren't supported by sharded stores.")
+
+    def scan(self, start=None, stop=None, prefix=None, reverse=False,
+             limit=None, keys=True, values=True):
+        """
+        Streams records in key order, merged from the shards. Each shard is
+        scanned in its own batches of transactions. Keys are always read,
+        as the merge needs them, but values only if they're asked for.
+        """
+        streams = [_scan_shard(it, start, stop, prefix, reverse, limit,
+                               values)
+                   for it in self.shards]
+        count = 0
+        for key, value in _merge(streams, reverse):
+            if limit is not None and count >= limit:
+                return
+            count += 1
+            if keys and values:
+                yield key, value
+            elif values:
+                yield value
+            else:
+                yield key
+
+    def count(self, start=None, stop=None, prefix=None):
+        return sum(it.count(start, stop, prefix) for it in self.shards)
+
+    def approx_count(self, start=None, stop=None, prefix=None):
+        return sum(it.approx_count(start, stop, prefix) for it in self.shards)
+
+    def first_key(self, start=None, stop=None, prefix=None):
+        keys = [it.first_key(start, stop, prefix) for it in self.shards]
+        return min([k for k in keys if k is not None] or [None])
+
+    def last_key(self, start=None, stop=None, prefix=None):
+        keys = [it.last_key(start, stop, prefix) for it in self.shards]
+        return max([k for k in keys if k is not None] or [None])
+
+    def remove_range(self, start=None, stop=None, prefix=None):
+        return sum(it.remove_range(start, stop, prefix) for it in self.shards)
+
+    def create_index(self, name, key_func, rebuild=False):
+        raise DataError("Indexes aren't supported by sharded stores.")
+
+    def get_index(self, name):
+        return None
+
+    def drop_index(self, name):
+        return False
+
+    def _partition(self, keys):
+        """
+        Groups the positions of keys by shard.
+        """
+        parts = {}
+        count = len(self.shards)
+        for i, key in enumerate(keys):
+            parts.setdefault(shard_of(key, count), []).append(i)
+        return parts
+
+    def _run_shards(self, parts, func, args):
+        """
+        Calls `func(shard, part_args)` for each shard in its own greenlet,
+        and puts the results back in the order of the arguments. The
+        greenlets only overlap while a shard's write is offloaded to the
+        threadpool; otherwise, the shards are written one after another.
+        """
+        jobs = [(positions, gevent.spawn(func, self.shards[index],
+                                         [args[i] for i in positions]))
+                for index, positions in parts.iteritems()]
+        gevent.joinall([job for _, job in jobs], raise_error=True)
+        results = [None] * len(args)
+        for positions, job in jobs:
+            for i, ret in zip(positions, job.value):
+                results[i] = ret
+        return results
+
+    def put_many(self, items):
+        """
+        Puts multiple records, in one write transaction per shard. The
+        shards are written concurrently if their parts are large enough to
+        be offloaded to the threadpool.
+
+        :param items: a mapping or an iterable of (key, value) pairs.
+        :return: a list of results, one for each item.
+        """
+        if isinstance(items, Mapping):
+            items = items.items()
+        else:
+            items = list(items)
+        parts = self._partition([key for key, _ in items])
+        return self._run_shards(parts, lambda shard, part: shard.put_many(part),
+                                items)
+
+    def remove_many(self, keys):
+        """
+        Removes multiple records, in one write transaction per shard.
+
+        :param keys: an iterable of keys.
+        :return: a list of results, one for each key.
+        """
+        keys = list(keys)
+        parts = self._partition(keys)
+        return self._run_shards(parts,
+                                lambda shard, part: shard.remove_many(part),
+                                keys)
+
+    def incr_many(self, deltas):
+        """
+        Adds to multiple counters, in one write transaction per shard.
+
+        :param deltas: a mapping or an iterable of (key, delta) pairs.
+        :return: a list of the new counts, one for each pair.
+        """
+        if isinstance(deltas, Mapping):
+            deltas = deltas.items()
+        else:
+            deltas = list(deltas)
+        parts = self._partition([key for key, _ in deltas])
+        return self._run_shards(parts,
+                                lambda shard, part: shard.incr_many(part),
+                                deltas)
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""
+Time series kept in stores.
+
+Records are keyed by the sortable bytes of TimeUUIDs, i.e. 16 bytes with
+the time fields first, so key order is time order and a time range is a
+key range. Range bounds are the lowest TimeUUIDs of their times.
+"""
+from __future__ import (absolute_import, division, unicode_literals)
+
+import time
+
+from ava.util.time_uuid import TimeUUID
+from ava.spi.errors import DataError
+from .sharding import ShardedStore
+
+# attempts at drawing a TimeUUID which isn't taken before giving up.
+_MAX_ATTEMPTS = 100
+
+
+def _bound(value):
+    """
+    Gets the lowest key at a time, which may be a datetime in UTC, a
+    timestamp or a TimeUUID.
+    """
+    if value is None:
+        return None
+    if isinstance(value, TimeUUID):
+        return value.sortable_bytes
+    return TimeUUID.convert(value, randomize=False,
+                            lowest_val=True).sortable_bytes
+
+
+def _insert(compare_and_swap, value, timestamp=None):
+    """
+    Adds a value under a new TimeUUID. TimeUUIDs of the same time differ
+    only in 14 random bits, so another one is drawn if the key is taken.
+    """
+    for _ in range(_MAX_ATTEMPTS):
+        if timestamp is None:
+            uid = TimeUUID.with_utcnow()
+        else:
+            uid = TimeUUID.convert(timestamp)
+        if compare_and_swap(uid.sortable_bytes, None, value):
+            return uid
+    raise DataError("No free TimeUUID at the time of the value.")
+
+
+class TimeSeries(object):
+    """
+    A series of values ordered by the times they are appended at.
+    """
+    def __init__(self, store, retention=None):
+        self.store = store
+        # seconds to keep records for, or None to keep them forever.
+        self.retention = retention
+
+    def __len__(self):
+        return len(self.store)
+
+    def append(self, value, timestamp=None):
+        """
+        Appends a value.
+
+        :param value: the value.
+        :param timestamp: the time of the value, as a datetime in UTC or a
+            timestamp; defaults to now.
+        :return: the value's TimeUUID.
+        """
+        return _insert(self.store.compare_and_swap, value, timestamp)
+
+    def append_many(self, values):
+        """
+        Appends values at the current time in one write transaction. A
+        sharded store has no cursors, so the values are appended one at a
+        time to it.
+
+        :return: the values' TimeUUIDs.
+        """
+        if isinstance(self.store, ShardedStore):
+            return [self.append(value) for value in values]
+        with self.store.cursor(readonly=False) as cur:
+            return [_insert(cur.compare_and_swap, value) for value in values]
+
+    def range(self, start=None, stop=None, reverse=False, limit=None):
+        """
+        Streams values in the time range [start, stop), e.g.
+        range(start=time.time() - 300) for the last five minutes.
+
+        :param start: the first time, inclusive, as a datetime in UTC, a
+            timestamp or a TimeUUID.
+        :param stop: the last time, exclusive.
+        :param reverse: stream the latest values first.
+        :param limit: the maximum number of values.
+        :return: a generator of (TimeUUID, value) pairs.
+        """
+        for key, value in self.store.scan(start=_bound(start),
+                                          stop=_bound(stop),
+                                          reverse=reverse, limit=limit):
+            yield TimeUUID.from_sortable_bytes(key), value
+
+    def latest(self, n):
+        """
+        Gets the latest values, the latest first.
+
+        :return: a list of (TimeUUID, value) pairs.
+        """
+        return list(self.range(reverse=True, limit=n))
+
+    def truncate(self, before):
+        """
+        Removes values earlier than a time.
+
+        :param before: a datetime in UTC, a timestamp or a TimeUUID.
+        :return: the number of values removed.
+        """
+        return self.store.remove_range(stop=_bound(before))
+
+    def apply_retention(self):
+        """
+        Removes values older than the retention period.
+
+        :return: the number of values removed.
+        """
+        if not self.retention:
+            return 0
+        return self.truncate(time.time() - self.retention)
@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+"""
+Bulk export and import of stores.
+
+A dump is a stream of msgpack-encoded entries, each prefixed with its
+length as a 4-byte big-endian integer. A map of {'store': name} starts the
+records of a store, and each record is an array of [key, value], or of
+[key, value, deadline] if it expires, the deadline being in milliseconds
+since the epoch. Values are written decoded, so a dump doesn't depend on
+stores' compression. Records which have expired by the time they're
+loaded are skipped.
+Frozen stores are read-only and built from their tables, so they're
+neither exported nor imported.
+"""
+from __future__ import (absolute_import, division, unicode_literals)
+
+import struct
+import logging
+import itertools
+
+from msgpack import packb, unpackb
+
+from ava.spi.errors import DataError
+from .sharding import ShardedStore
+from .frozen import FrozenStore
+from .expiry import now_ms
+
+# the records whose deadlines are looked up in a transaction.
+_DEADLINE_BATCH = 1000
+
+logger = logging.getLogger(__name__)
+
+_LENGTH_FORMAT = b'>I'
+_LENGTH_SIZE = struct.calcsize(_LENGTH_FORMAT)
+
+_STORE = b'store'
+
+
+def _write_entry(out, entry):
+    data = packb(entry)
+    out.write(struct.pack(_LENGTH_FORMAT, len(data)))
+    out.write(data)
+
+
+def _read_entries(src):
+    while True:
+        header = src.read(_LENGTH_SIZE)
+        if not header:
+            return
+        if len(header) < _LENGTH_SIZE:
+            raise DataError("Truncated dump.")
+        size = struct.unpack(_LENGTH_FORMAT, header)[0]
+        data = src.read(size)
+        if len(data) < size:
+            raise DataError("Truncated dump.")
+        yield unpackb(data)
+
+
+def _shard(store, key):
+    if isinstance(store, ShardedStore):
+        return store.shard(key)
+    return store
+
+
+def _with_deadlines(store, items):
+    """
+    Adds their deadlines to (key, value) pairs of a store, looking them up a
+    batch at a time. No transaction is held while pairs are consumed.
+    """
+    while True:
+        batch = list(itertools.islice(items, _DEADLINE_BATCH))
+        if not batch:
+            return
+        keys_by_shard = {}
+        for key, _ in batch:
+            shard = _shard(store, key)
+            if shard.expiry is not None:
+                keys_by_shard.setdefault(shard, []).append(key)
+        deadlines = {}
+        for shard, keys in keys_by_shard.iteritems():
+            with shard._env.begin() as txn:
+                for key in keys:
+                    deadlines[key] = shard.expiry.deadline(txn, key)
+        for key, value in batch:
+            yield key, value, deadlines.get(key)
+
+
+def _ttl_of(deadline):
+    return max(deadline - now_ms(), 0) / 1000.0
+
+
+def export_stores(engine, out, store_names=None):
+    """
+    Writes stores to a file-like object. Stores are scanned in batches, so
+    memory use is bounded whatever their size.
+
+    :param engine: the data engine.
+    :param out: the file-like object.
+    :param store_names: the stores to export; defaults to all but frozen
+        ones.
+    :return: the number of records written.
+    """
+    if store_names is None:
+        store_names = sorted(
+            name for name in engine.store_names()
+            if not isinstance(engine.get_store(name, create=False),
+                              FrozenStore))
+
+    count = 0
+    for name in store_names:
+        store = engine.get_store(name, create=False)
+        if store is None:
+            raise DataError("Store not found: %s" % name)
+        if isinstance(store, FrozenStore):
+            raise DataError("Frozen stores can't be exported: %s" % name)
+
+        logger.debug("Exporting store: %s", name)
+        _write_entry(out, {_STORE: store.name})
+        for key, value, deadline in _with_deadlines(store, store.scan()):
+            if deadline is None:
+                _write_entry(out, [key, value])
+            else:
+                _write_entry(out, [key, value, deadline])
+            count += 1
+    return count
+
+
+class _StoreLoader(object):
+    """
+    Loads records into a store. Records are appended for as long as their
+    keys are sorted after the existing ones, which saves LMDB from searching
+    the tree and splitting pages half-full. Records of sharded stores are
+    put instead, as their keys are spread over the shards. Deadlines are
+    set as times to live from when records are written.
+    """
+    def __init__(self, engine, store):
+        self.engine = engine
+        self.store = store
+        self.pending = []
+        self.last = None
+        self.expiring = False
+        self.appending = not isinstance(store, ShardedStore)
+        if self.appending:
+            with store.cursor() as cur:
+                self.last = cur.key() if cur.last() else None
+
+    def add(self, key, value, deadline=None):
+        if deadline is not None and not self.expiring:
+            # it can't be done within a transaction.
+            self.engine.enable_expiry(self.store.name)
+            self.expiring = True
+        if self.appending and self.last is not None and key <= self.last:
+            logger.debug("Keys of store %s aren't sorted, appending stops.",
+                         self.store.name)
+            self.appending = False
+        self.last = key
+        self.pending.append((key, value, deadline))
+
+    def flush(self):
+        if not self.pending:
+            return
+        items = self.pending
+        self.pending = []
+        if isinstance(self.store, ShardedStore):
+            self.store.put_many((key, value) for key, value, deadline in items
+                                if deadline is None)
+            for key, value, deadline in items:
+                if deadline is not None:
+                    self.store.put(key, value, _ttl_of(deadline))
+            return
+        self.engine.run_heavy_write(self.store._env, len(items), self._write,
+                                    items, self.appending)
+
+    def _write(self, items, appending):
+        with self.engine.batch() as batch:
+            for key, value, deadline in items:
+                if appending:
+                    batch.append(self.store, key, value)
+                    if deadline is not None:
+                        batch.cursor(self.store).expire(key,
+                                                        _ttl_of(deadline))
+                elif deadline is None:
+                    batch.put(self.store, key, value)
+                else:
+                    batch.put(self.store, key, value, _ttl_of(deadline))
+
+
+def import_stores(engine, src, batch_size=10000):
+    """
+    Loads stores from a file-like object, creating them as needed, in
+    transactions of `batch_size` records each. Records replace existing
+    ones with the same keys.
+
+    :param engine: the data engine.
+    :param src: the file-like object.
+    :param batch_size: the records in a transaction.
+    :return: the number of records loaded.
+    """
+    loader = None
+    count = 0
+    for entry in _read_entries(src):
+        if isinstance(entry, dict):
+            if loader is not None:
+                loader.flush()
+            name = entry[_STORE]
+            logger.debug("Importing store: %s", name)
+            store = engine.get_store(name)
+            if isinstance(store, FrozenStore):
+                raise DataError("Frozen stores can't be imported: %s" % name)
+            loader = _StoreLoader(engine, store)
+            continue
+
+        if loader is None:
+            raise DataError("Record before any store in dump.")
+        key, value = entry[:2]
+        deadline = entry[2] if len(entry) > 2 else None
+        if deadline is not None and deadline <= now_ms():
+            continue
+        loader.add(key, value, deadline)
+        count += 1
+        if len(loader.pending) >= batch_size:
+            loader.flush()
+
+    if loader is not None:
+        loader.flush()
+    return count
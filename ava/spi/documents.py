@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+"""
+Document stores which keep model objects in data stores, msgpack-encoded.
+
+A document is encoded as a msgpack map from field names to the separately
+encoded field values. Hence, fields are decoded only when accessed, and
+fields left untouched by an update are written back as they were.
+"""
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+
+from msgpack import packb, unpackb
+
+from .models import Model
+from . import stores
+
+
+def _pack(value):
+    # text is kept apart from bytes, so both come back as they were.
+    return packb(value, use_bin_type=True)
+
+
+def _unpack(data):
+    return unpackb(data, raw=False)
+
+
+class Document(Model):
+    """ A model object which decodes its fields lazily.
+    """
+    def __init__(self, *args, **kwargs):
+        # encoded fields, which are moved into `store` once decoded, as they
+        # may be modified in place.
+        self._packed = {}
+        super(Document, self).__init__(*args, **kwargs)
+
+    @classmethod
+    def unpack(cls, data):
+        """ Creates a document from its encoded form.
+
+        :param data: the encoded document.
+        :return: the document.
+        """
+        doc = cls()
+        doc._packed = _unpack(data)
+        return doc
+
+    def pack(self):
+        """ Encodes the document. Fields which haven't been decoded are
+        copied without being encoded again.
+
+        :return: the encoded document.
+        """
+        fields = dict(self._packed)
+        for name, value in self.store.iteritems():
+            if name not in fields:
+                fields[name] = _pack(value)
+        return _pack(fields)
+
+    def __getitem__(self, key):
+        try:
+            return self.store[key]
+        except KeyError:
+            value = self.store[key] = _unpack(self._packed.pop(key))
+            return value
+
+    def __setitem__(self, key, value):
+        self._packed.pop(key, None)
+        self.store[key] = value
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self._packed.pop(key, None)
+        self.store.pop(key, None)
+
+    def __contains__(self, key):
+        return key in self.store or key in self._packed
+
+    def __iter__(self):
+        for key in self._packed.keys():
+            yield key
+        for key in self.store.keys():
+            if key not in self._packed:
+                yield key
+
+    def __len__(self):
+        return len(self._packed) + sum(1 for key in self.store
+                                       if key not in self._packed)
+
+    def as_dict(self):
+        for key in list(self._packed):
+            self[key]
+        return self.store
+
+
+def field_key(field_name):
+    """ Makes a key function for indexing documents by a field. Only that
+    field is decoded.
+
+    :param field_name: the field's name.
+    :return: the key function.
+    """
+    def key_func(value):
+        packed = _unpack(value).get(field_name)
+        if packed is None:
+            return None
+        return _unpack(packed)
+    return key_func
+
+
+class DocumentStore(object):
+    """ Keeps documents in a data store.
+    """
+    def __init__(self, store, document_class=Document):
+        self.store = store
+        self.document_class = document_class
+
+    def _to_document(self, model):
+        if isinstance(model, Document):
+            return model
+        if isinstance(model, Model):
+            model = model.as_dict()
+        return self.document_class(model)
+
+    def get(self, key):
+        """ Gets a document.
+
+        :param key: the document's key.
+        :return: the document, or None if not found.
+        """
+        data = self.store.get(key)
+        if data is None:
+            return None
+        return self.document_class.unpack(data)
+
+    def put(self, key, model):
+        """ Saves a document.
+
+        :param key: the document's key.
+        :param model: a document, model object or dict.
+        :return: True if saved.
+        """
+        return self.store.put(key, self._to_document(model).pack())
+
+    def update(self, key, *args, **kwargs):
+        """ Sets some fields of a document in one write transaction. Other
+        fields are neither decoded nor encoded again.
+
+        :param key: the document's key.
+        :return: the updated document, or None if not found.
+        """
+        with self.store.cursor(readonly=False) as cur:
+            data = cur.get(key)
+            if data is None:
+                return None
+            doc = self.document_class.unpack(data)
+            doc.update(*args, **kwargs)
+            cur.put(key, doc.pack())
+            return doc
+
+    def remove(self, key):
+        return self.store.remove(key)
+
+    def scan(self, start=None, stop=None, prefix=None, reverse=False,
+             limit=None):
+        """ Streams documents in key order.
+
+        :return: a generator of (key, document) pairs.
+        """
+        for key, data in self.store.scan(start=start, stop=stop, prefix=prefix,
+                                         reverse=reverse, limit=limit):
+            yield key, self.document_class.unpack(data)
+
+    def create_index(self, name, field_name, rebuild=False):
+        """ Creates a secondary index by a document field.
+
+        :param name: the index name.
+        :param field_name: the field's name.
+        :param rebuild: rebuild an existing index.
+        :return: the index.
+        """
+        return self.store.create_index(name, field_key(field_name),
+                                       rebuild=rebuild)
+
+    def find(self, index_name, index_key, limit=None):
+        """ Finds documents by an index.
+
+        :return: a generator of (key, document) pairs.
+        """
+        index = self.store.get_index(index_name)
+        for key, data in index.find(index_key, values=True, limit=limit):
+            yield key, self.document_class.unpack(data)
+
+
+def get(store_name, document_class=Document):
+    """ Gets or creates the named document store.
+
+    :param store_name:
+    :param document_class: the class of documents.
+    :return:
+    """
+    return DocumentStore(stores.get(store_name), document_class)
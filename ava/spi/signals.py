@@ -14,6 +14,8 @@ AGENT_STOPPING = "agent.stopping"
 MODULE_LOADED = "module.loaded"
 MODULE_UNLOADED = "module.unloaded"
 
+DATA_MAP_GROWN = "data.map_grown"
+
 
 def send(signal, *args, **kwargs):
     """
@@ -37,6 +37,149 @@ class IStore(object):
     def cursor(self, readonly=True):
         raise NotImplementedError()
 
+    @abstractmethod
+    def scan(self, start=None, stop=None, prefix=None, reverse=False,
+             limit=None, keys=True, values=True):
+        """
+        Streams records in key order.
+
+        :param start: the first key, inclusive.
+        :param stop: the last key, exclusive.
+        :param prefix: only keys with this prefix.
+        :param reverse: scan from the highest key downwards.
+        :param limit: the maximum number of records.
+        :param keys: whether to include keys.
+        :param values: whether to include values.
+        :return: a generator of (key, value) pairs, or of keys or values only
+            if the other is excluded.
+        """
+        raise NotImplementedError()
+
+    @abstractmethod
+    def count(self, start=None, stop=None, prefix=None):
+        """
+        Counts the records in a range without reading their values.
+
+        :return: the number of records.
+        """
+        raise NotImplementedError()
+
+    @abstractmethod
+    def approx_count(self, start=None, stop=None, prefix=None):
+        """
+        Estimates the number of records in a range without scanning it.
+
+        :return: the estimated number of records.
+        """
+        raise NotImplementedError()
+
+    @abstractmethod
+    def first_key(self, start=None, stop=None, prefix=None):
+        """
+        Gets the lowest key in a range.
+
+        :return: the key, or None if the range is empty.
+        """
+        raise NotImplementedError()
+
+    @abstractmethod
+    def last_key(self, start=None, stop=None, prefix=None):
+        """
+        Gets the highest key in a range.
+
+        :return: the key, or None if the range is empty.
+        """
+        raise NotImplementedError()
+
+    @abstractmethod
+    def create_index(self, name, key_func, rebuild=False):
+        """
+        Creates a secondary index maintained along with the records.
+
+        :param name: the index name.
+        :param key_func: a function of a record's value which returns an
+            index key, a list of index keys, or None.
+        :param rebuild: rebuild an existing index.
+        :return: the index.
+        """
+        raise NotImplementedError()
+
+    @abstractmethod
+    def get_index(self, name):
+        raise NotImplementedError()
+
+    @abstractmethod
+    def drop_index(self, name):
+        raise NotImplementedError()
+
+    @abstractmethod
+    def put_many(self, items):
+        """
+        Puts multiple records in one write transaction.
+
+        :param items: a mapping or an iterable of (key, value) pairs.
+        :return: a list of results, one for each item.
+        """
+        raise NotImplementedError()
+
+    @abstractmethod
+    def remove_many(self, keys):
+        """
+        Removes multiple records in one write transaction.
+
+        :param keys: an iterable of keys.
+        :return: a list of results, one for each key.
+        """
+        raise NotImplementedError()
+
+    @abstractmethod
+    def incr(self, key, delta=1, ttl=None):
+        """
+        Adds to a counter atomically. Counters are kept as decimal digits
+        and start from zero.
+
+        :param delta: the amount to add, which may be negative.
+        :param ttl: seconds after which the counter expires, set only when
+            it's created.
+        :return: the new count.
+        """
+        raise NotImplementedError()
+
+    @abstractmethod
+    def incr_many(self, deltas):
+        """
+        Adds to multiple counters in one write transaction.
+
+        :param deltas: a mapping or an iterable of (key, delta) pairs.
+        :return: a list of the new counts, one for each pair.
+        """
+        raise NotImplementedError()
+
+    @abstractmethod
+    def compare_and_swap(self, key, expected, new):
+        """
+        Replaces the value of a record atomically if it's the expected one.
+
+        :param expected: the expected value, or None if the record is
+            expected not to exist.
+        :param new: the new value, or None to remove the record.
+        :return: True if the value was replaced.
+        """
+        raise NotImplementedError()
+
+    @abstractmethod
+    def update(self, key, func):
+        """
+        Replaces the value of a record with the result of a function of it,
+        in one write transaction.
+
+        :param func: a function of the current value, or of None if the
+            record doesn't exist, which returns the new value, or None to
+            remove the record.
+        :return: the new value.
+        """
+        raise NotImplementedError()
+
 
 class ICursor(object):
     """ Interface for a cursor which is used to traverse the store.
@@ -195,4 +338,16 @@ def get(store_name):
     :param store_name:
     :return:
     """
-    return _get_data_engine().get_store(store_name)
\ No newline at end of file
+    return _get_data_engine().get_store(store_name)
+
+
+def snapshot(buffers=True):
+    """ Opens a read transaction shared by lookups in several stores, which
+    see a consistent snapshot of them.
+
+    :param buffers: whether to return values as buffers into the memory map,
+        which are valid only until the snapshot exits; if False, they're
+        copied.
+    :return: the snapshot, to be used as a context manager.
+    """
+    return _get_data_engine().snapshot(buffers=buffers)
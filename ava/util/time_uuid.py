@@ -83,6 +83,26 @@ class TimeUUID(uuid.UUID):
         else:
             return super(TimeUUID, self).__cmp__(other)
 
+    @property
+    def sortable_bytes(self):
+        """
+        The UUID as 16 bytes with the time fields first, most significant
+        first, so that the bytes sort in time order.
+        """
+        b = self.bytes
+        return b[6:8] + b[4:6] + b[0:4] + b[8:]
+
+    @classmethod
+    def from_sortable_bytes(cls, data):
+        """
+        Create a TimeUUID from the bytes given by :py:attr:`sortable_bytes`.
+
+        :param data: 16 bytes.
+        :returns: A TimeUUID object
+        :rtype: TimeUUID
+        """
+        return cls(bytes=data[4:8] + data[2:4] + data[0:2] + data[8:16])
+
     def get_datetime(self):
         return datetime.datetime.utcfromtimestamp(self.get_timestamp())
 
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, division, print_function, unicode_literals
+"""
+Endpoints for managing the agent's data.
+"""
+
+from ava.spi.context import get_context
+from ava.spi.webfront import dispatcher, check_authentication, create_app
+from ava.spi.webfront import response
+
+api = dispatcher.mount(b'data', create_app())
+api.add_hook('before_request', check_authentication)
+
+
+@api.get("/backup")
+def backup():
+    """
+    Streams a compacting copy of the data environment, which can be restored
+    as the data file of a pod.
+    """
+    engine = get_context().get('dataengine')
+    response.content_type = 'application/octet-stream'
+    response.set_header('Content-Disposition',
+                        'attachment; filename="data.mdb"')
+    return engine.backup_stream()
@@ -1,10 +1,17 @@
 # -*- coding: utf-8 -*-
 from __future__ import print_function, division, absolute_import
 
+import os
+import shutil
+import tempfile
 import unittest
 
 import gevent
-from ava.core.agent import Agent
+import mock
+
+from ava.spi.context import Context
+from ava.runtime import settings
+from ava.core.data import DataEngine
 
 
 class AgentTest(unittest.TestCase):
@@ -15,6 +22,9 @@ class AgentTest(unittest.TestCase):
 
     @classmethod
     def setUpClass(cls):
+        # imported here so that tests of the engines alone don't need the
+        # agent's dependencies.
+        from ava.core.agent import Agent
         AgentTest._agent = Agent()
         server_greenlet = gevent.spawn(AgentTest._agent.run)
 
@@ -28,3 +38,47 @@ class AgentTest(unittest.TestCase):
             gevent.sleep(0.5)
 
 
+class TempPod(object):
+    """
+    A temporary pod for running data engines with the given settings in
+    place of the `data` section of the config. Engines can be started on it
+    again, e.g. to test reopening the data. Used as a context manager, it
+    starts an engine and removes the pod when done.
+    """
+    def __init__(self, **conf):
+        self.conf = conf
+        self.pod_dir = tempfile.mkdtemp(prefix='ava-test-')
+        os.mkdir(os.path.join(self.pod_dir, 'data'))
+        self.engine = None
+
+    def start_engine(self, ctx=None, **conf):
+        """
+        Starts a data engine on the pod, bound to a context.
+
+        :param ctx: the context; defaults to a new one.
+        :param conf: settings overriding those of the pod.
+        :return: the engine.
+        """
+        if ctx is None:
+            ctx = Context(None)
+        conf = dict(settings.get('data') or {}, **dict(self.conf, **conf))
+        with mock.patch.dict(settings, data=conf), \
+                mock.patch('ava.runtime.environ.pod_dir',
+                           return_value=self.pod_dir):
+            engine = DataEngine()
+            ctx.bind('dataengine', engine)
+            engine.start(ctx)
+        return engine
+
+    def remove(self):
+        shutil.rmtree(self.pod_dir, ignore_errors=True)
+
+    def __enter__(self):
+        self.engine = self.start_engine()
+        return self.engine
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        try:
+            self.engine.stop()
+        finally:
+            self.remove()
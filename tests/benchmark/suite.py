@@ -0,0 +1,319 @@
+# -*- coding: utf-8 -*-
+"""
+Workload benchmarks for the data engine, run against a temporary pod.
+
+Each case measures one operation over a store for a combination of value
+size, key distribution, batch size and number of concurrent greenlets, and
+reports its throughput and latency percentiles. Results are written as JSON
+so that runs of different versions can be compared:
+
+    python -m tests.benchmark.suite --output after.json --baseline before.json
+"""
+from __future__ import print_function, division
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import itertools
+import subprocess
+from timeit import default_timer
+
+import gevent
+import lmdb
+
+from tests.bases import TempPod
+
+OPS = ('put', 'get', 'delete', 'scan')
+
+DISTRIBUTIONS = ('sequential', 'uniform', 'skewed')
+
+DEFAULT_MATRIX = dict(ops=OPS,
+                      value_sizes=(100, 4096),
+                      distributions=DISTRIBUTIONS,
+                      batch_sizes=(1, 100),
+                      concurrency=(1, 8))
+
+QUICK_MATRIX = dict(ops=OPS,
+                    value_sizes=(100,),
+                    distributions=('sequential', 'uniform'),
+                    batch_sizes=(1, 100),
+                    concurrency=(1, 4))
+
+# puts under each durability mode of the data engine.
+DURABILITY_MATRIX = dict(ops=('put',),
+                         value_sizes=(100,),
+                         distributions=('uniform',),
+                         batch_sizes=(1, 100),
+                         concurrency=(1,))
+
+DURABILITY_MODES = ('sync', 'nometasync', 'nosync')
+
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+def percentiles(samples):
+    """
+    Gets latency percentiles of samples in seconds, in microseconds.
+    """
+    if not samples:
+        return {}
+    samples = sorted(samples)
+    ret = {}
+    for p in PERCENTILES:
+        index = min(int(len(samples) * p / 100), len(samples) - 1)
+        ret['p%s' % p] = round(samples[index] * 1e6, 1)
+    ret['max'] = round(samples[-1] * 1e6, 1)
+    return ret
+
+
+def make_keys(distribution, count, key_space, seed=0):
+    """
+    Generates keys of a distribution over a key space of `key_space` keys.
+    Skewed keys follow a power law, so a few hot keys get most operations.
+    """
+    rnd = random.Random(seed)
+    if distribution == 'sequential':
+        indexes = (i % key_space for i in xrange(count))
+    elif distribution == 'uniform':
+        indexes = (rnd.randrange(key_space) for _ in xrange(count))
+    elif distribution == 'skewed':
+        indexes = (int(key_space * rnd.random() ** 4) for _ in xrange(count))
+    else:
+        raise ValueError("Unknown distribution: %s" % distribution)
+    return [b'key%010d' % i for i in indexes]
+
+
+def _chunks(items, size):
+    return [items[i:i + size] for i in xrange(0, len(items), size)]
+
+
+def _op_func(store, op, batch_size, value):
+    """
+    Gets a function which applies an operation to a chunk of keys, and
+    returns the number of records it worked on.
+    """
+    if op == 'put':
+        def put(keys):
+            if batch_size == 1:
+                store.put(keys[0], value)
+            else:
+                store.put_many((k, value) for k in keys)
+            return len(keys)
+        return put
+    if op == 'get':
+        def get(keys):
+            for k in keys:
+                store.get(k)
+            return len(keys)
+        return get
+    if op == 'delete':
+        def delete(keys):
+            if batch_size == 1:
+                store.remove(keys[0])
+            else:
+                store.remove_many(keys)
+            return len(keys)
+        return delete
+    if op == 'scan':
+        # a chunk is the first key of a range of `batch_size` records.
+        def scan(keys):
+            count = 0
+            for _ in store.scan(start=keys[0], limit=batch_size):
+                count += 1
+            return count
+        return scan
+    raise ValueError("Unknown operation: %s" % op)
+
+
+def run_case(engine, op, value_size, distribution, batch_size, concurrency,
+             records):
+    """
+    Runs one case in a new store, which is preloaded with `records` records
+    unless the operation is put.
+
+    :return: a dict of the case and its measurements.
+    """
+    store = engine.create_store(b'bench')
+    value = b'x' * value_size
+    try:
+        if op != 'put':
+            store.put_many((k, value) for k in
+                           make_keys('sequential', records, records))
+        if op == 'scan':
+            distribution = 'uniform'
+            starts = make_keys('uniform', max(records // batch_size, 1),
+                               records)
+            chunks = [[k] for k in starts]
+        else:
+            chunks = _chunks(make_keys(distribution, records, records),
+                             batch_size)
+
+        func = _op_func(store, op, batch_size, value)
+        latencies = []
+        counts = []
+
+        def worker(part):
+            for chunk in part:
+                t0 = default_timer()
+                counts.append(func(chunk))
+                latencies.append(default_timer() - t0)
+                # let the other workers in between calls.
+                if concurrency > 1:
+                    gevent.sleep(0)
+
+        parts = [chunks[i::concurrency] for i in xrange(concurrency)]
+        t0 = default_timer()
+        gevent.joinall([gevent.spawn(worker, it) for it in parts],
+                       raise_error=True)
+        elapsed = default_timer() - t0
+    finally:
+        engine.remove_store(b'bench')
+
+    count = sum(counts)
+    return dict(op=op, value_size=value_size, distribution=distribution,
+                batch_size=batch_size, concurrency=concurrency,
+                records=count, calls=len(chunks),
+                seconds=round(elapsed, 6),
+                records_per_sec=round(count / elapsed, 1),
+                latency_us=percentiles(latencies))
+
+
+def _cases(matrix):
+    seen = set()
+    for op, value_size, distribution, batch_size, concurrency in \
+            itertools.product(matrix['ops'], matrix['value_sizes'],
+                              matrix['distributions'], matrix['batch_sizes'],
+                              matrix['concurrency']):
+        if op == 'get':
+            # there's no batched get; lookups are one at a time.
+            batch_size = 1
+        if op == 'scan':
+            distribution = 'uniform'
+        case = (op, value_size, distribution, batch_size, concurrency)
+        if case not in seen:
+            seen.add(case)
+            yield case
+
+
+def _revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_suite(matrix=None, records=10000, conf=None, log=None):
+    """
+    Runs every case of a matrix, each in a fresh store of one temporary pod.
+
+    :param matrix: a dict of the values of each dimension; defaults to
+        DEFAULT_MATRIX.
+    :param records: the records each case works on.
+    :param conf: settings of the data engine, e.g. dict(group_commit=...).
+    :param log: a function called with the result of each case.
+    :return: a dict of the environment and the results.
+    """
+    matrix = matrix or DEFAULT_MATRIX
+    results = []
+    with TempPod(**(conf or {})) as engine:
+        for case in _cases(matrix):
+            result = run_case(engine, *case, records=records)
+            results.append(result)
+            if log is not None:
+                log(result)
+    return dict(timestamp=int(time.time()),
+                revision=_revision(),
+                python=platform.python_version(),
+                lmdb=lmdb.version(),
+                platform=platform.platform(),
+                records=records,
+                conf=conf or {},
+                results=results)
+
+
+def case_key(result):
+    return (result['op'], result['value_size'], result['distribution'],
+            result['batch_size'], result['concurrency'])
+
+
+def compare(baseline, current, tolerance=0.1):
+    """
+    Compares the throughput of the cases in two runs.
+
+    :param tolerance: the relative slowdown reported as a regression.
+    :return: a list of (case, baseline, current, ratio, regressed) tuples of
+        the cases found in both runs.
+    """
+    before = dict((case_key(it), it) for it in baseline['results'])
+    ret = []
+    for it in current['results']:
+        old = before.get(case_key(it))
+        if old is None:
+            continue
+        ratio = it['records_per_sec'] / old['records_per_sec']
+        ret.append((case_key(it), old['records_per_sec'],
+                    it['records_per_sec'], ratio, ratio < 1 - tolerance))
+    return ret
+
+
+def format_result(result):
+    latency = result['latency_us']
+    return ("%-6s %6dB %-10s batch=%-4d greenlets=%-2d %12.1f rec/s  "
+            "p50=%.1fus p99=%.1fus" %
+            (result['op'], result['value_size'], result['distribution'],
+             result['batch_size'], result['concurrency'],
+             result['records_per_sec'], latency.get('p50', 0),
+             latency.get('p99', 0)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmarks the data engine in a temporary pod.")
+    parser.add_argument('--output', help="write the results as JSON here")
+    parser.add_argument('--baseline',
+                        help="compare with the results of an earlier run")
+    parser.add_argument('--records', type=int, default=10000,
+                        help="records per case")
+    parser.add_argument('--quick', action='store_true',
+                        help="run a smaller matrix")
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help="relative slowdown reported as a regression")
+    parser.add_argument('--durability', choices=DURABILITY_MODES,
+                        help="the durability mode of the environments")
+    args = parser.parse_args(argv)
+
+    def log(result):
+        print(format_result(result))
+
+    matrix = QUICK_MATRIX if args.quick else DEFAULT_MATRIX
+    conf = None
+    if args.durability:
+        conf = dict(durability=dict(mode=args.durability))
+    report = run_suite(matrix, args.records, conf=conf, log=log)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+    if not args.baseline:
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    regressions = 0
+    for case, old, new, ratio, regressed in compare(baseline, report,
+                                                    args.tolerance):
+        if regressed:
+            regressions += 1
+        print("%s %-45s %12.1f -> %12.1f rec/s (%+.1f%%)" %
+              ('!' if regressed else ' ', ' '.join(str(it) for it in case),
+               old, new, (ratio - 1) * 100))
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
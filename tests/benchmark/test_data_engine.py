@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for the data engine. They are skipped unless the AVA_BENCHMARK
+environment variable is set.
+"""
+from __future__ import print_function
+
+import io
+import os
+import json
+import shutil
+import time
+import unittest
+
+from ava.spi.context import Context
+from ava.core.data import DataEngine, Cursor
+
+_ENABLED = bool(os.environ.get('AVA_BENCHMARK'))
+
+
+@unittest.skipUnless(_ENABLED, "Set AVA_BENCHMARK to run benchmarks.")
+class DataEngineBenchmark(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = DataEngine()
+        self.ctx = Context(None)
+        self.ctx.bind('dataengine', self.engine)
+        self.engine.start(self.ctx)
+        self.engine.remove_all_stores()
+
+    def tearDown(self):
+        self.engine.remove_all_stores()
+        self.engine.stop(self.ctx)
+
+    def _report(self, name, count, elapsed):
+        print("%s: %.2f us/op, %d ops/s" %
+              (name, elapsed / count * 1e6, count / elapsed))
+
+    def test_get_latency(self):
+        store = self.engine.create_store("bench")
+        keys = [b'key%06d' % i for i in xrange(1000)]
+        store.put_many((k, b'x' * 100) for k in keys)
+        database = self.engine.database
+        rounds = 20
+
+        # what every lookup used to pay: a DBI lookup plus a fresh cursor.
+        t0 = time.time()
+        for _ in xrange(rounds):
+            for k in keys:
+                _db = database.open_db(b'bench', create=False, dupsort=True)
+                _txn = database.begin(buffers=False)
+                with Cursor(_txn, _db) as cur:
+                    cur.get(k)
+        self._report("open_db + Cursor", rounds * len(keys), time.time() - t0)
+
+        t0 = time.time()
+        for _ in xrange(rounds):
+            for k in keys:
+                with self.engine.cursor(b'bench') as cur:
+                    cur.get(k)
+        self._report("DataEngine.cursor", rounds * len(keys), time.time() - t0)
+
+        t0 = time.time()
+        for _ in xrange(rounds):
+            for k in keys:
+                store.get(k)
+        self._report("Store.get", rounds * len(keys), time.time() - t0)
+
+    def _db_size(self, store):
+        with self.engine.database.begin() as txn:
+            stat = txn.stat(store._db)
+        return stat['psize'] * (stat['branch_pages'] + stat['leaf_pages'] +
+                                stat['overflow_pages'])
+
+    def test_compression(self):
+        # JSON-ish records, which compress several times over.
+        values = [json.dumps([dict(id=i * 10 + j, name="item-%d" % j,
+                                   tags=["red", "green", "blue"],
+                                   enabled=bool(j % 2))
+                              for j in xrange(10)])
+                  for i in xrange(2000)]
+        keys = [b'key%06d' % i for i in xrange(len(values))]
+
+        for name, compression in [(b'raw', None),
+                                  (b'zlib1', dict(level=1)),
+                                  (b'zlib6', dict(level=6))]:
+            store = self.engine.create_store(name, compression=compression)
+
+            t0 = time.time()
+            for k, v in zip(keys, values):
+                store.put(k, v)
+            self._report("%s put" % name, len(keys), time.time() - t0)
+
+            t0 = time.time()
+            for k in keys:
+                store.get(k)
+            self._report("%s get" % name, len(keys), time.time() - t0)
+            print("%s size: %d bytes" % (name, self._db_size(store)))
+
+    def test_import(self):
+        store = self.engine.create_store("bench")
+        count = 100000
+        store.put_many((b'key%08d' % i, b'x' * 100) for i in xrange(count))
+        out = io.BytesIO()
+        self.engine.export_stores(out, [b'bench'])
+
+        for batch_size in (10000, 100):
+            self.engine.remove_store(b'bench')
+            out.seek(0)
+            t0 = time.time()
+            self.engine.import_stores(out, batch_size=batch_size)
+            self._report("import, append, batches of %d" % batch_size,
+                         count, time.time() - t0)
+
+        # keys are no longer sorted after the existing ones.
+        self.engine.get_store(b'bench').remove_many(
+            b'key%08d' % i for i in xrange(1, count))
+        out.seek(0)
+        t0 = time.time()
+        self.engine.import_stores(out)
+        self._report("import, put, batches of 10000", count, time.time() - t0)
+
+    def test_frozen_get(self):
+        count = 100000
+        items = [(b'key%08d' % i, b'x' * 100) for i in xrange(count)]
+        store = self.engine.create_store("bench")
+        t0 = time.time()
+        store.put_many(items)
+        self._report("Store.put_many", count, time.time() - t0)
+
+        t0 = time.time()
+        frozen = self.engine.build_frozen(b'bench-frozen', items)
+        self._report("build_frozen", count, time.time() - t0)
+        self.addCleanup(shutil.rmtree, os.path.dirname(frozen.path))
+
+        keys = [k for k, _ in items[::10]]
+        for name, it in [("Store.get", store), ("FrozenStore.get", frozen)]:
+            t0 = time.time()
+            for k in keys:
+                it.get(k)
+            self._report(name, len(keys), time.time() - t0)
+
+    def test_map_reduce(self):
+        store = self.engine.create_store("bench")
+        count = 200000
+        store.put_many((b'key%08d' % i, b'type%d' % (i % 10) + b'x' * 200)
+                       for i in xrange(count))
+
+        def count_types(records):
+            counts = {}
+            for _, value in records:
+                kind = value[:5]
+                counts[kind] = counts.get(kind, 0) + 1
+            return counts
+
+        def merge(a, b):
+            for k, v in b.iteritems():
+                a[k] = a.get(k, 0) + v
+            return a
+
+        t0 = time.time()
+        expected = count_types(store.scan())
+        self._report("Store.scan", count, time.time() - t0)
+
+        for partitions in (1, 4, 16):
+            t0 = time.time()
+            result = self.engine.map_reduce(b'bench', count_types, merge,
+                                            partitions=partitions)
+            self._report("map_reduce, %d partitions" % partitions, count,
+                         time.time() - t0)
+            self.assertEqual(expected, result)
+
+    def test_range_count(self):
+        store = self.engine.create_store("bench")
+        count = 200000
+        store.put_many((b'key%08d' % i, b'x' * 200) for i in xrange(count))
+        start, stop = b'key%08d' % 50000, b'key%08d' % 150000
+
+        t0 = time.time()
+        expected = sum(1 for _ in store.scan(start=start, stop=stop,
+                                             values=False))
+        self._report("Store.scan, keys only", expected, time.time() - t0)
+
+        t0 = time.time()
+        self.assertEqual(expected, store.count(start, stop))
+        self._report("Store.count", expected, time.time() - t0)
+
+        t0 = time.time()
+        store.approx_count(start, stop)
+        self._report("Store.approx_count", expected, time.time() - t0)
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+"""
+Runs the workload benchmarks of suite.py. They are skipped unless the
+AVA_BENCHMARK environment variable is set; the results are written as JSON
+to the file named by AVA_BENCHMARK_OUTPUT, if set.
+"""
+from __future__ import print_function
+
+import os
+import json
+import unittest
+
+from . import suite
+
+_ENABLED = bool(os.environ.get('AVA_BENCHMARK'))
+
+
+@unittest.skipUnless(_ENABLED, "Set AVA_BENCHMARK to run benchmarks.")
+class WorkloadBenchmark(unittest.TestCase):
+
+    def test_workloads(self):
+        report = suite.run_suite(suite.QUICK_MATRIX, records=5000,
+                                 log=lambda it: print(suite.format_result(it)))
+        for result in report['results']:
+            self.assertTrue(result['records'] > 0)
+            self.assertIn('p99', result['latency_us'])
+
+        output = os.environ.get('AVA_BENCHMARK_OUTPUT')
+        if output:
+            with open(output, 'w') as f:
+                json.dump(report, f, indent=2, sort_keys=True)
+
+        comparison = suite.compare(report, report)
+        self.assertEqual(len(report['results']), len(comparison))
+        self.assertFalse(any(regressed for _, _, _, _, regressed in comparison))
+
+    def test_durability(self):
+        throughput = {}
+        for mode in suite.DURABILITY_MODES:
+            report = suite.run_suite(suite.DURABILITY_MATRIX, records=2000,
+                                     conf=dict(durability=dict(mode=mode)))
+            for result in report['results']:
+                print(mode, suite.format_result(result))
+                throughput[mode, result['batch_size']] = \
+                    result['records_per_sec']
+        for mode in suite.DURABILITY_MODES:
+            self.assertTrue(throughput[mode, 1] > 0)
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+
+import struct
+import unittest
+import gevent
+
+from ava.spi.context import Context
+from ava.spi.errors import DataError
+from ava.core.data import DataEngine
+
+
+class ChangeLogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = DataEngine()
+        self.ctx = Context(None)
+        self.ctx.bind('dataengine', self.engine)
+        self.engine.start(self.ctx)
+        self.changes = self.engine.enable_change_log(truncate_batch=2)
+        self.store = self.engine.create_store('changes')
+
+    def tearDown(self):
+        self.engine.remove_store(b'changes')
+        self.engine.disable_change_log(purge=True)
+        self.engine.stop(self.ctx)
+
+    def test_mutations_are_recorded(self):
+        self.store.put(b'k1', b'v1')
+        with self.engine.batch() as batch:
+            batch.put(b'changes', b'k2', b'v2')
+            batch.remove(b'changes', b'k1')
+            batch.remove(b'changes', b'k3')
+        try:
+            with self.engine.batch() as batch:
+                batch.put(b'changes', b'k4', b'v4')
+                raise RuntimeError()
+        except RuntimeError:
+            pass
+
+        changes = self.changes.read()
+        self.assertEqual([(b'changes', b'k1', b'put'),
+                          (b'changes', b'k2', b'put'),
+                          (b'changes', b'k1', b'delete')],
+                         [it[1:] for it in changes])
+        seqs = [it.seq for it in changes]
+        self.assertEqual(sorted(seqs), seqs)
+        self.assertEqual(changes[1:], self.changes.read(since=seqs[0]))
+
+    def test_blocking_tail(self):
+        def producer():
+            for i in range(3):
+                gevent.sleep(0.01)
+                self.store.put(b'k%d' % i, b'v')
+
+        gevent.spawn(producer)
+        keys = [change.key for change in self.changes.tail(timeout=0.2)]
+        self.assertEqual([b'k0', b'k1', b'k2'], keys)
+
+    def test_tail_woken_from_threadpool(self):
+        self.engine.offload_enabled = True
+        self.engine.offload_threshold = 2
+
+        def producer():
+            gevent.sleep(0.01)
+            self.store.put_many([(b'k1', b'v'), (b'k2', b'v')])
+
+        gevent.spawn(producer)
+        tail = self.changes.tail(timeout=1)
+        self.assertEqual(b'k1', next(tail).key)
+
+    def test_ack_truncates(self):
+        for i in range(5):
+            self.store.put(b'k%d' % i, b'v')
+        seqs = [it.seq for it in self.changes.read()]
+
+        self.assertEqual(2, self.changes.ack('c1', seqs[2]))
+        self.assertEqual(1, self.changes.ack('c1', seqs[2]))
+        self.assertEqual(seqs[2], self.changes.position('c1'))
+
+        # a consumer behind holds the log back.
+        self.assertEqual(0, self.changes.ack('c2', seqs[0]))
+        self.assertEqual([b'k3', b'k4'],
+                         [it.key for it in self.changes.tail(consumer='c1',
+                                                             timeout=0)])
+        self.changes.remove_consumer('c2')
+        self.assertEqual(2, self.changes.ack('c1', seqs[4]))
+        self.assertEqual([], self.changes.read())
+
+        # sequence numbers go on after the log is truncated.
+        self.engine.disable_change_log()
+        self.changes = self.engine.enable_change_log()
+        self.store.put(b'k5', b'v')
+        self.assertTrue(self.changes.read()[0].seq > seqs[4])
+
+    def test_append_out_of_order_refused(self):
+        # as if another process had logged a change behind this one's back.
+        ahead = struct.pack(b'>Q', self.changes.seq + 10)
+        self.engine.write(lambda txn: txn.put(ahead, b'',
+                                              db=self.changes._log_db))
+
+        try:
+            self.assertRaises(DataError, self.store.put, b'k1', b'v1')
+            self.assertIsNone(self.store.get(b'k1'))
+        finally:
+            self.engine.write(lambda txn: txn.delete(ahead,
+                                                     db=self.changes._log_db))
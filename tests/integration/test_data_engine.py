@@ -2,11 +2,23 @@
 
 from __future__ import print_function
 
+import io
+import os
+import shutil
+import tempfile
 import unittest
 import mock
+import lmdb
+import gevent
+from collections import Counter
 
 from ava.spi.context import Context
-from ava.core.data import DataEngine
+from ava.spi.signals import DATA_MAP_GROWN, AGENT_STARTED
+from ava.spi.errors import DataNotFoundError, DataError
+from ava.core.data import DataEngine, _thread_ident
+from ava.core.data.analytics import split_ranges
+from ava.core.task import TaskEngine
+from tests.bases import TempPod
 
 
 class TestDataEngine(unittest.TestCase):
@@ -177,3 +189,870 @@ class TestDataEngine(unittest.TestCase):
 
         self.engine.remove_store("queue")
 
+    def test_put_many_and_remove_many(self):
+        store = self.engine.create_store("testdb2")
+
+        results = store.put_many([('k1', 'v1'), ('k2', 'v2'), ('k3', 'v3')])
+        self.assertEqual([True, True, True], results)
+        self.assertEqual(3, len(store))
+        self.assertEqual('v2', store['k2'])
+
+        results = store.put_many({'k4': 'v4'})
+        self.assertEqual([True], results)
+
+        results = store.remove_many(['k1', 'k5'])
+        self.assertEqual([True, False], results)
+        self.assertIsNone(store['k1'])
+        self.assertEqual(3, len(store))
+
+        self.engine.remove_store("testdb2")
+
+    def test_batch_across_stores(self):
+        store1 = self.engine.create_store("testdb1")
+        store2 = self.engine.create_store("testdb2")
+
+        with self.engine.batch() as b:
+            b.put("testdb1", 'k1', 'v1')
+            b.put("testdb2", 'k2', 'v2')
+            b.remove("testdb2", 'k3')
+
+        self.assertEqual([True, True, False], b.results)
+        self.assertEqual('v1', store1['k1'])
+        self.assertEqual('v2', store2['k2'])
+
+        self.engine.remove_store("testdb1")
+        self.engine.remove_store("testdb2")
+
+    def test_batch_abort(self):
+        store = self.engine.create_store("testdb2")
+
+        try:
+            with self.engine.batch() as b:
+                b.put("testdb2", 'k1', 'v1')
+                raise Exception()
+        except:
+            pass
+
+        self.assertIsNone(store['k1'])
+
+        with self.assertRaises(DataNotFoundError):
+            with self.engine.batch() as b:
+                b.put("nonexistent", 'k1', 'v1')
+
+        self.engine.remove_store("testdb2")
+
+    def test_group_commit(self):
+        store = self.engine.create_store("testdb2")
+        self.engine.enable_group_commit(max_delay=0.01, max_batch=100)
+        try:
+            def writer(i):
+                return store.put('k%d' % i, 'v%d' % i)
+
+            jobs = [gevent.spawn(writer, i) for i in range(50)]
+            gevent.joinall(jobs)
+            self.assertTrue(all(job.value for job in jobs))
+            self.assertLess(self.engine.coalescer.commits, 50)
+
+            self.assertEqual('v7', store['k7'])
+            self.assertTrue(store.remove('k7'))
+            self.assertFalse(store.remove('k7'))
+            self.assertEqual(49, len(store))
+        finally:
+            self.engine.disable_group_commit()
+
+        self.engine.remove_store("testdb2")
+
+    def test_group_commit_isolates_failures(self):
+        store = self.engine.create_store("testdb2")
+        self.engine.enable_group_commit(max_delay=0.01, max_batch=100)
+        try:
+            def writer(key, value):
+                return store.put(key, value)
+
+            jobs = [gevent.spawn(writer, b'k%d' % i, b'v') for i in range(10)]
+            jobs.append(gevent.spawn(writer, b'', b'v'))
+            jobs.append(gevent.spawn(writer, b'k', None))
+            gevent.joinall(jobs)
+            self.assertTrue(all(job.value for job in jobs[:10]))
+            self.assertIsInstance(jobs[10].exception, DataError)
+            self.assertIn(b'MDB_BAD_VALSIZE', str(jobs[10].exception))
+            self.assertIsInstance(jobs[11].exception, TypeError)
+            self.assertEqual(10, len(store))
+
+            # the coalescer keeps serving writes.
+            self.assertTrue(store.put(b'k', b'v'))
+            self.assertTrue(store.remove(b'k'))
+        finally:
+            self.engine.disable_group_commit()
+
+    def test_read_view_with_buffers(self):
+        store = self.engine.create_store("testdb2")
+        store.put_many([('k1', 'value1'), ('k2', 'value2')])
+
+        with store.read_view() as view:
+            val1 = view.get('k1')
+            self.assertNotIsInstance(val1, bytes)
+            self.assertEqual(b'value1', bytes(val1))
+            self.assertEqual(b'value2', bytes(view.get('k2')))
+            self.assertIsNone(view.get('k3'))
+
+        self.engine.remove_store("testdb2")
+
+    def test_open_value(self):
+        store = self.engine.create_store("testdb2")
+        store['k1'] = b'x' * 100000
+
+        stream = store.open_value('k1')
+        self.assertEqual(100000, len(stream))
+        try:
+            chunks = [chunk.tobytes() for chunk in stream]
+        finally:
+            stream.close()
+        self.assertEqual(b'x' * 100000, b''.join(chunks))
+
+        self.assertIsNone(store.open_value('k2'))
+
+        self.engine.remove_store("testdb2")
+
+    def test_scan(self):
+        store = self.engine.create_store("testdb2")
+        store.put_many((b'k%02d' % i, b'v%02d' % i) for i in range(20))
+        store.put_many([(b'a1', b'x'), (b'z1', b'y')])
+        self.engine.scan_batch = 3
+
+        items = list(store.scan(start=b'k05', stop=b'k10'))
+        self.assertEqual([(b'k%02d' % i, b'v%02d' % i) for i in range(5, 10)],
+                         items)
+
+        keys = list(store.scan(prefix=b'k', keys=True, values=False))
+        self.assertEqual([b'k%02d' % i for i in range(20)], keys)
+
+        values = list(store.scan(prefix=b'k1', reverse=True, limit=4,
+                                 keys=False))
+        self.assertEqual([b'v19', b'v18', b'v17', b'v16'], values)
+
+        keys = list(store.scan(stop=b'k02', reverse=True, values=False))
+        self.assertEqual([b'k01', b'k00', b'a1'], keys)
+
+        self.assertEqual(22, len(list(store)))
+        self.assertEqual([], list(store.scan(start=b'k10', stop=b'k05')))
+
+        self.engine.remove_store("testdb2")
+
+    def test_scan_resumes_after_concurrent_delete(self):
+        store = self.engine.create_store("testdb2")
+        store.put_many((b'k%02d' % i, b'v') for i in range(10))
+        self.engine.scan_batch = 2
+
+        keys = []
+        for key in store.scan(values=False):
+            keys.append(key)
+            if key == b'k01':
+                store.remove(b'k02')
+        self.assertEqual([b'k00', b'k01'] + [b'k%02d' % i
+                                             for i in range(3, 10)], keys)
+
+        self.engine.remove_store("testdb2")
+
+    def test_iterator_with_values(self):
+        store = self.engine.create_store("testdb2")
+        store.put_many([('k1', 'v1'), ('k2', 'v2')])
+
+        with self.engine.cursor("testdb2") as cur:
+            cur.first()
+            self.assertEqual([('k1', 'v1'), ('k2', 'v2')],
+                             list(cur.iternext(values=True)))
+
+        self.engine.remove_store("testdb2")
+
+    def test_secondary_index(self):
+        store = self.engine.create_store("testdb2")
+        store.put_many([('k1', 'alice:1'), ('k2', 'bob:2'), ('k3', 'alice:3')])
+        self.engine.scan_batch = 2
+
+        owner = lambda value: value.split(':')[0]
+        index = store.create_index('by_owner', owner)
+        self.assertIs(index, store.get_index('by_owner'))
+        self.assertEqual(['k1', 'k3'], list(index.find('alice')))
+
+        store.put('k4', 'carol:4')
+        store['k1'] = 'bob:1'
+        store.remove('k3')
+        with self.engine.batch() as b:
+            b.put("testdb2", 'k5', 'alice:5')
+        with self.engine.cursor("testdb2", readonly=False) as cur:
+            cur.post('dave:6')
+
+        self.assertEqual([('k5', 'alice:5')],
+                         list(index.find('alice', values=True)))
+        self.assertEqual(['k1', 'k2'], list(index.find('bob')))
+        self.assertEqual(['k1', 'k2', 'k4'],
+                         list(index.scan(start='b', stop='d')))
+        self.assertEqual(['k4', 'k2', 'k1'],
+                         list(index.scan(start='b', stop='d', reverse=True)))
+        self.assertEqual(5, len(index))
+
+        # reattaching doesn't rebuild; rebuilding applies a new key function.
+        index = store.create_index('by_owner', owner)
+        self.assertEqual(5, len(index))
+        index = store.create_index('by_id', lambda v: v.split(':')[1])
+        self.assertEqual(['k1', 'k2'], list(index.scan(stop='3')))
+
+        self.assertTrue(store.drop_index('by_id'))
+        self.assertFalse(store.drop_index('by_id'))
+        self.assertIsNone(store.get_index('by_id'))
+
+        self.engine.remove_store("testdb2")
+        self.assertEqual([], self.engine._internal_db_names(b'\x1findex'))
+
+    def test_index_rebuilt_after_unregistered_writes(self):
+        store = self.engine.create_store("testdb2")
+        owner = lambda value: value.split(':')[0]
+        store.create_index('by_owner', owner)
+        store.put_many([('k1', 'alice:1'), ('k2', 'bob:2')])
+
+        self._reopen_engine()
+        store = self.engine.get_store("testdb2", create=False)
+        self.assertEqual({b'by_owner'}, store.unregistered_indexes)
+        store.remove('k1')
+        store.put('k3', 'alice:3')
+        index = store.create_index('by_owner', owner)
+        self.assertEqual([('k3', 'alice:3')],
+                         list(index.find('alice', values=True)))
+        self.assertEqual(set(), store.unregistered_indexes)
+
+        # an index created again before any write is kept as it is.
+        self._reopen_engine()
+        store = self.engine.get_store("testdb2", create=False)
+        with mock.patch.object(self.engine, '_backfill_index') as backfill:
+            index = store.create_index('by_owner', owner)
+        self.assertFalse(backfill.called)
+        self.assertEqual(['k2'], list(index.find('bob')))
+
+    def _reopen_engine(self):
+        self.engine.stop(self.ctx)
+        self.engine = DataEngine()
+        self.engine.start(self.ctx)
+
+    def test_index_aborted_with_transaction(self):
+        store = self.engine.create_store("testdb2")
+        index = store.create_index('by_value', lambda v: v)
+
+        try:
+            with self.engine.batch() as b:
+                b.put("testdb2", 'k1', 'v1')
+                raise Exception()
+        except:
+            pass
+
+        self.assertEqual([], list(index.find('v1')))
+        self.engine.remove_store("testdb2")
+
+    def test_data_locked_while_running(self):
+        other = DataEngine()
+        self.assertRaises(DataError, other.start, Context(None))
+
+        self.engine.stop(self.ctx)
+        other.start(Context(None))
+        other.stop()
+        self.engine.start(self.ctx)
+
+    def _restart_engine(self, **conf):
+        """ Restarts the engine in a temporary pod with the given settings.
+        """
+        self.engine.stop(self.ctx)
+        pod = TempPod(**conf)
+        self.addCleanup(pod.remove)
+        self.engine = pod.start_engine(self.ctx)
+
+    def test_map_growth(self):
+        self._restart_engine(map_size=1048576, map_growth=1048576)
+        map_size = self.engine.usage()['map_size']
+        grown = []
+
+        def receiver(map_size=None, **kwargs):
+            grown.append(map_size)
+
+        self.ctx.connect(receiver, signal=DATA_MAP_GROWN)
+        try:
+            store = self.engine.create_store("testdb2")
+            value = b'x' * 1000
+            count = map_size // 1000
+            store.put_many((b'k%06d' % i, value) for i in range(count))
+            with self.engine.cursor("testdb2", readonly=False) as cur:
+                for i in range(count, count * 2):
+                    cur.put(b'k%06d' % i, value)
+            for i in range(count * 2, count * 2 + 1000):
+                store.put(b'k%06d' % i, value)
+        finally:
+            self.ctx.disconnect(receiver, signal=DATA_MAP_GROWN)
+
+        self.assertEqual(count * 2 + 1000, len(store))
+        self.assertTrue(grown)
+        usage = self.engine.usage()
+        self.assertEqual(grown[-1], usage['map_size'])
+        self.assertEqual(len(grown), usage['map_growths'])
+        self.assertLessEqual(usage['used_ratio'], 1)
+
+    def test_map_growth_waits_for_readers(self):
+        self._restart_engine(map_size=1048576, map_growth=1048576)
+        store = self.engine.create_store("testdb2")
+        store['k'] = b'v'
+        values = []
+
+        def reader():
+            with store.read_view() as view:
+                gevent.sleep(0.1)
+                values.append(bytes(view.get('k')))
+
+        job = gevent.spawn(reader)
+        gevent.sleep(0)
+        count = self.engine.usage()['map_size'] // 1000
+        store.put_many((b'k%06d' % i, b'x' * 1000) for i in range(count))
+        job.join()
+
+        self.assertEqual([b'v'], values)
+        self.assertTrue(self.engine.map_growths > 0)
+
+    def test_map_growth_holds_off_writers(self):
+        self._restart_engine(map_size=1048576, map_growth=4194304)
+        store = self.engine.create_store("testdb2")
+        results = []
+
+        def reader():
+            with store.read_view() as view:
+                view.get(b'c')
+                gevent.sleep(0.1)
+
+        def writer():
+            results.append(store.incr(b'c', 100))
+
+        job = gevent.spawn(reader)
+        gevent.sleep(0)
+        # the writer runs while the batch waits for the reader to grow the
+        # map, and mustn't commit in between.
+        jobs = [job, gevent.spawn(writer)]
+        with self.engine.batch() as batch:
+            self.assertEqual(1, batch.incr(b'testdb2', b'c', 1))
+            batch.put(b'testdb2', b'big', b'x' * 2097152)
+        gevent.joinall(jobs, raise_error=True)
+
+        self.assertEqual([101], results)
+        self.assertEqual(b'101', store.get(b'c'))
+        self.assertTrue(self.engine.map_growths > 0)
+
+    def test_map_full_in_own_snapshot(self):
+        self._restart_engine(map_size=1048576, map_growth=1048576)
+        store = self.engine.create_store("testdb2")
+        store.put(b'k', b'v')
+        value = b'x' * 1000
+
+        # the map can't be grown for a writer holding a reader itself.
+        with self.engine.snapshot(buffers=False) as view:
+            self.assertEqual(b'v', view.get(b'testdb2', b'k'))
+            with self.assertRaises(DataError):
+                for i in range(2000):
+                    store.put(b'k%06d' % i, value)
+        self.assertEqual(0, self.engine.map_growths)
+
+        # others aren't held off afterwards.
+        for i in range(2000):
+            store.put(b'k%06d' % i, value)
+        self.assertTrue(self.engine.map_growths > 0)
+
+    def test_map_growth_timeout(self):
+        self._restart_engine(map_size=1048576, map_growth=1048576,
+                             grow_timeout=0.05)
+        store = self.engine.create_store("testdb2")
+
+        def reader():
+            with store.read_view() as view:
+                view.get(b'k')
+                gevent.sleep(0.5)
+
+        job = gevent.spawn(reader)
+        gevent.sleep(0)
+        with self.assertRaises(DataError):
+            store.put(b'big', b'x' * 2097152)
+        job.kill()
+        self.assertEqual(0, self.engine.map_growths)
+
+    def test_map_grown_ahead(self):
+        self._restart_engine(map_size=1048576, map_growth=1048576)
+        store = self.engine.create_store("testdb2")
+        i = 0
+        while self.engine.usage()['used_ratio'] < 0.8:
+            store.put_many((b'k%06d' % j, b'x' * 1000)
+                           for j in range(i, i + 20))
+            i += 20
+        map_size = self.engine.usage()['map_size']
+
+        # housekeeping doesn't wait for readers to grow the map.
+        with store.read_view() as view:
+            view.get(b'k000000')
+            self.engine.housekeep()
+        self.assertEqual(map_size, self.engine.usage()['map_size'])
+
+        self.engine.housekeep()
+        self.assertEqual(map_size + 1048576,
+                         self.engine.usage()['map_size'])
+        self.engine.housekeep()
+        self.assertEqual(map_size + 1048576,
+                         self.engine.usage()['map_size'])
+
+    def test_map_size_limit(self):
+        self._restart_engine(map_size=1048576, map_growth=1048576)
+        self.engine.max_map_size = self.engine.usage()['map_size']
+        store = self.engine.create_store("testdb2")
+
+        count = self.engine.max_map_size // 1000
+        with self.assertRaises(DataError):
+            store.put_many((b'k%06d' % i, b'x' * 1000) for i in range(count))
+        self.assertEqual(0, len(store))
+
+    def test_offload(self):
+        self.engine.offload_enabled = True
+        self.engine.offload_threshold = 10
+        self.addCleanup(setattr, self.engine, 'offload_enabled', False)
+        store = self.engine.create_store("testdb2")
+
+        ticks = []
+
+        def tick():
+            while True:
+                ticks.append(1)
+                gevent.sleep(0)
+        ticker = gevent.spawn(tick)
+        gevent.sleep(0)
+
+        items = [(b'k%04d' % i, b'v%d' % i) for i in range(100)]
+        self.assertTrue(all(store.put_many(iter(items))))
+        self.assertEqual(items, list(store.scan()))
+        store.create_index("by_value", lambda v: v)
+        self.assertEqual(100, len(store.get_index("by_value")))
+        self.assertTrue(all(store.remove_many(k for k, _ in items[:50])))
+        self.assertEqual(50, len(store))
+        ticker.kill()
+        self.assertTrue(len(ticks) > 1)
+
+        self.engine.remove_store("testdb2")
+        self.assertFalse(self.engine.store_exists("testdb2"))
+
+    def test_offloaded_map_growth(self):
+        self._restart_engine(map_size=1048576, map_growth=1048576)
+        self.engine.offload_enabled = True
+        self.engine.offload_threshold = 10
+        store = self.engine.create_store("testdb2")
+        store.put(b'c', b'0')
+
+        sleeps = []
+        sleep = gevent.sleep
+
+        def checked_sleep(*args):
+            sleeps.append(_thread_ident())
+            return sleep(*args)
+
+        def writer():
+            for _ in range(50):
+                store.incr(b'c', 1)
+                gevent.sleep(0.001)
+
+        with mock.patch('ava.core.data.gevent.sleep', checked_sleep):
+            job = gevent.spawn(writer)
+            gevent.sleep(0.005)
+            # the map is grown on the hub, and the writer can't commit
+            # before the offloaded batch is replayed.
+            deltas = [(b'c', 1)] + [(b'n%063d' % i, 1) for i in range(30000)]
+            counts = store.incr_many(deltas)
+            job.join()
+
+        self.assertEqual(30001, len(counts))
+        self.assertTrue(self.engine.map_growths > 0)
+        self.assertEqual(b'51', store.get(b'c'))
+        self.assertEqual(set([_thread_ident()]), set(sleeps))
+
+    def test_compression(self):
+        store = self.engine.create_store("testdb2")
+        store.put(b'old', b'a' * 1000)
+        store.put(b'magic', b'\x1fz\x01 not compressed')
+
+        store = self.engine.create_store("testdb2",
+                                         compression=dict(threshold=100))
+        store.create_index("by_prefix", lambda v: v[:1])
+        store.put(b'big', b'b' * 1000)
+        store.put(b'small', b'c' * 10)
+
+        with self.engine.database.begin(db=store._db) as txn:
+            self.assertEqual(b'a' * 1000, txn.get(b'old'))
+            self.assertTrue(len(txn.get(b'big')) < 100)
+            self.assertEqual(b'c' * 10, txn.get(b'small'))
+
+        self.assertEqual(b'a' * 1000, store.get(b'old'))
+        self.assertEqual(b'\x1fz\x01 not compressed', store.get(b'magic'))
+        self.assertEqual(b'b' * 1000, store[b'big'])
+        self.assertEqual([(b'big', b'b' * 1000)],
+                         list(store.get_index("by_prefix").find(b'b',
+                                                                values=True)))
+        self.assertEqual(b'b' * 1000, dict(store.scan())[b'big'])
+        with store.cursor() as cur:
+            self.assertEqual(b'b' * 1000, cur.get(b'big'))
+            self.assertIn((b'big', b'b' * 1000), list(cur.iternext(values=True)))
+        with store.read_view() as cur:
+            self.assertEqual(b'b' * 1000, cur.get(b'big'))
+
+        store.compressor = None
+        store.put(b'magic', b'\x1fz\x01 still not compressed')
+        self.assertEqual(b'b' * 1000, store.get(b'big'))
+        self.assertEqual(b'\x1fz\x01 still not compressed',
+                         store.get(b'magic'))
+
+        # written raw by a version which didn't escape values.
+        with self.engine.database.begin(db=store._db, write=True) as txn:
+            txn.put(b'legacy', b'\x1fz\x01 legacy')
+        self.assertEqual(b'\x1fz\x01 legacy', store.get(b'legacy'))
+
+    def test_read_cache(self):
+        store = self.engine.create_store("testdb2", cache=dict(max_entries=2))
+        store.put(b'k1', b'v1')
+        self.assertEqual(b'v1', store.get(b'k1'))
+        self.assertEqual(b'v1', store.get(b'k1'))
+        self.assertIsNone(store.get(b'k0'))
+        self.assertIsNone(store.get(b'k0'))
+        stats = store.cache.stats()
+        self.assertEqual(2, stats['hits'])
+        self.assertEqual(2, stats['misses'])
+
+        store.put(b'k0', b'v0')
+        self.assertEqual(b'v0', store.get(b'k0'))
+        with self.engine.batch() as batch:
+            batch.put(b'testdb2', b'k1', b'v1.1')
+        self.assertEqual(b'v1.1', store.get(b'k1'))
+        with store.cursor(readonly=False) as cur:
+            cur.remove(b'k1')
+        self.assertIsNone(store.get(b'k1'))
+
+        # a read racing with a write transaction doesn't cache a stale value.
+        with store.cursor(readonly=False) as cur:
+            cur.put(b'k0', b'v0.1')
+            self.assertEqual(b'v0', store.get(b'k0'))
+        self.assertEqual(b'v0.1', store.get(b'k0'))
+
+        try:
+            with store.cursor(readonly=False) as cur:
+                cur.put(b'k0', b'aborted')
+                raise RuntimeError()
+        except RuntimeError:
+            pass
+        self.assertEqual(b'v0.1', store.get(b'k0'))
+
+        store.put_many([(b'k%d' % i, b'v') for i in range(2, 5)])
+        for i in range(2, 5):
+            store.get(b'k%d' % i)
+        self.assertEqual(2, len(store.cache))
+        self.assertTrue(store.cache.stats()['evictions'] > 0)
+
+    def test_read_cache_by_bytes(self):
+        store = self.engine.create_store("testdb2",
+                                         cache=dict(max_entries=0,
+                                                    max_bytes=100))
+        store.put_many([(b'k%d' % i, b'x' * 30) for i in range(10)])
+        for i in range(10):
+            store.get(b'k%d' % i)
+        self.assertEqual(3, len(store.cache))
+        self.assertTrue(store.cache.size <= 100)
+
+    def test_backup(self):
+        store = self.engine.create_store("testdb2")
+        store.put_many((b'k%04d' % i, b'x' * 1000) for i in range(1000))
+        store.remove_many(b'k%04d' % i for i in range(0, 1000, 2))
+
+        backup_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, backup_dir)
+        path = os.path.join(backup_dir, b'backup.mdb')
+        size = self.engine.backup(path)
+        self.assertEqual(size, os.path.getsize(path))
+        self.assertFalse(os.path.exists(path + b'.tmp'))
+
+        with open(os.path.join(backup_dir, b'stream.mdb'), 'wb') as f:
+            for chunk in self.engine.backup_stream(chunk_size=4096):
+                f.write(chunk)
+
+        for name in (b'backup.mdb', b'stream.mdb'):
+            env = lmdb.Environment(os.path.join(backup_dir, name),
+                                   subdir=False, readonly=True, max_dbs=8,
+                                   lock=False)
+            try:
+                _db = env.open_db(b'testdb2', create=False)
+                with env.begin(db=_db) as txn:
+                    self.assertEqual(500, txn.stat(_db)['entries'])
+                    self.assertEqual(b'x' * 1000, txn.get(b'k0001'))
+            finally:
+                env.close()
+
+    def test_export_and_import(self):
+        store = self.engine.create_store("testdb2", compression=dict(
+            threshold=10))
+        store.put_many((b'k%04d' % i, b'v' * i) for i in range(100))
+        self.engine.create_store("testdb3").put(b'k', b'v')
+
+        out = io.BytesIO()
+        self.assertEqual(101, self.engine.export_stores(
+            out, [b'testdb2', b'testdb3']))
+        self.engine.remove_store(b'testdb2')
+        self.engine.remove_store(b'testdb3')
+
+        # keys already in the store are loaded with plain puts.
+        self.engine.create_store("testdb3").put(b'z', b'old')
+        out.seek(0)
+        self.assertEqual(101, self.engine.import_stores(out, batch_size=7))
+
+        store = self.engine.get_store(b'testdb2')
+        self.assertEqual(100, len(store))
+        self.assertEqual(b'v' * 50, store.get(b'k0050'))
+        self.assertEqual([(b'k', b'v'), (b'z', b'old')],
+                         list(self.engine.get_store(b'testdb3').scan()))
+
+    def test_export_and_import_deadlines(self):
+        store = self.engine.create_store("testdb2")
+        store.put(b'k1', b'v1')
+        store.put(b'k2', b'v2', ttl=60)
+        store.put(b'k3', b'v3', ttl=0.05)
+
+        out = io.BytesIO()
+        self.assertEqual(3, self.engine.export_stores(out, [b'testdb2']))
+        self.engine.remove_store(b'testdb2')
+        gevent.sleep(0.1)
+
+        # the record which has expired since is left out.
+        out.seek(0)
+        self.assertEqual(2, self.engine.import_stores(out))
+        store = self.engine.get_store(b'testdb2')
+        self.assertEqual([b'k1', b'k2'], list(store.scan(values=False)))
+        self.assertIsNone(store.ttl(b'k1'))
+        self.assertTrue(59 < store.ttl(b'k2') <= 60)
+
+    def test_append(self):
+        store = self.engine.create_store("testdb2")
+        index = store.create_index("by_value", lambda v: v)
+        with store.cursor(readonly=False) as cur:
+            self.assertTrue(cur.append(b'k1', b'v1'))
+            self.assertTrue(cur.append(b'k2', b'v2'))
+            self.assertFalse(cur.append(b'k0', b'v0'))
+        self.assertEqual([b'k1', b'k2'], list(store))
+        self.assertEqual([b'k1', b'k2'], list(index.scan()))
+
+    def test_expiry(self):
+        store = self.engine.create_store("testdb2")
+        index = store.create_index("by_value", lambda v: v)
+        store.put(b'k1', b'v1', ttl=0.05)
+        store.put(b'k2', b'v2', ttl=60)
+        store.put(b'k3', b'v3')
+        self.assertEqual(b'v1', store.get(b'k1'))
+        self.assertTrue(0 < store.ttl(b'k2') <= 60)
+        self.assertIsNone(store.ttl(b'k3'))
+        self.assertTrue(store.expire(b'k3', 0.05))
+        self.assertFalse(store.expire(b'k4', 0.05))
+
+        # a plain put makes a record persistent again.
+        store.put(b'k2', b'v2')
+        self.assertIsNone(store.ttl(b'k2'))
+
+        gevent.sleep(0.1)
+        self.assertIsNone(store.get(b'k1'))
+        self.assertEqual([b'k2'], list(store))
+        self.assertEqual([b'k2'], list(index.scan()))
+        with store.cursor() as cur:
+            self.assertIsNone(cur.get(b'k3'))
+            self.assertFalse(cur.exists(b'k3'))
+
+        self.assertEqual(3, len(store))
+        self.assertEqual(2, self.engine.sweep_expired())
+        self.assertEqual(1, len(store))
+        self.assertEqual(1, len(index))
+        self.assertEqual(0, self.engine.sweep_expired())
+
+    def test_expiry_sweeper(self):
+        taskengine = TaskEngine()
+        taskengine.start(self.ctx)
+        self.addCleanup(taskengine.stop, self.ctx)
+        self.addCleanup(self.ctx.unbind, 'taskengine')
+        self.engine.sweep_interval = 0.01
+        self.engine.sweep_batch = 10
+        self.ctx.send(signal=AGENT_STARTED, sender=self)
+
+        store = self.engine.create_store("testdb2")
+        with self.engine.batch() as batch:
+            self.assertRaises(DataError, batch.put, b'testdb2', b'k', b'v', 1)
+        self.engine.enable_expiry(b'testdb2')
+        with self.engine.batch() as batch:
+            for i in range(25):
+                batch.put(b'testdb2', b'k%02d' % i, b'v', 0.01)
+        gevent.sleep(0.2)
+        self.assertEqual(0, len(store))
+
+    def test_counters(self):
+        store = self.engine.create_store("testdb2")
+        self.assertEqual(1, store.incr(b'hits'))
+        self.assertEqual(6, store.incr(b'hits', 5))
+        self.assertEqual(4, store.incr(b'hits', -2))
+        self.assertEqual(b'4', store.get(b'hits'))
+        store.put(b'name', b'abc')
+        self.assertRaises(DataError, store.incr, b'name')
+
+        self.assertEqual([1, 5, 2], store.incr_many([(b'a', 1), (b'hits', 1),
+                                                     (b'a', 1)]))
+        self.assertEqual(b'5', store.get(b'hits'))
+
+        store.incr(b'window', ttl=60)
+        self.assertTrue(store.ttl(b'window') > 59)
+        store.incr(b'window', ttl=1)
+        self.assertTrue(store.ttl(b'window') > 59)
+
+        self.engine.enable_group_commit(max_delay=0.01)
+        try:
+            jobs = [gevent.spawn(store.incr, b'shared') for _ in range(50)]
+            gevent.joinall(jobs, raise_error=True)
+        finally:
+            self.engine.disable_group_commit()
+        self.assertEqual(b'50', store.get(b'shared'))
+
+    def test_compare_and_swap(self):
+        store = self.engine.create_store("testdb2")
+        self.assertTrue(store.compare_and_swap(b'k', None, b'v1'))
+        self.assertFalse(store.compare_and_swap(b'k', None, b'v2'))
+        self.assertFalse(store.compare_and_swap(b'k', b'v0', b'v2'))
+        self.assertTrue(store.compare_and_swap(b'k', b'v1', b'v2'))
+        self.assertEqual(b'v2', store.get(b'k'))
+        self.assertTrue(store.compare_and_swap(b'k', b'v2', None))
+        self.assertIsNone(store.get(b'k'))
+
+    def test_update(self):
+        store = self.engine.create_store("testdb2")
+        store.create_index("by_value", lambda v: v)
+        self.assertEqual(b'a', store.update(b'k', lambda v: (v or b'') + b'a'))
+        self.assertEqual(b'ab', store.update(b'k', lambda v: v + b'b'))
+        self.assertEqual([b'k'], list(store.get_index("by_value").find(b'ab')))
+        self.assertIsNone(store.update(b'k', lambda v: None))
+        self.assertIsNone(store.get(b'k'))
+        self.assertEqual(0, len(store.get_index("by_value")))
+
+        with self.engine.batch() as batch:
+            batch.update(b'testdb2', b'k', lambda v: b'x')
+            batch.incr(b'testdb2', b'n', 2)
+            batch.compare_and_swap(b'testdb2', b'k', b'x', b'y')
+        self.assertEqual([b'x', 2, True], batch.results)
+        self.assertEqual(b'y', store.get(b'k'))
+
+    def test_snapshot(self):
+        users = self.engine.create_store("testdb2")
+        history = self.engine.create_store("testdb3")
+        self.addCleanup(self.engine.remove_store, b'testdb3')
+        users.put(b'u1', b'alice')
+        history.put_many((b'u1:%d' % i, b'e%d' % i) for i in range(5))
+        history.put(b'u2:0', b'other')
+
+        with self.engine.snapshot(buffers=False) as view:
+            self.assertEqual(b'alice', view.get(b'testdb2', b'u1'))
+            # writes after the view begins aren't seen.
+            users.put(b'u1', b'bob')
+            history.put(b'u1:5', b'e5')
+            self.assertEqual(b'alice', view[b'testdb2'].get(b'u1'))
+            self.assertEqual([b'e%d' % i for i in range(5)],
+                             list(view.scan(b'testdb3', prefix=b'u1:',
+                                            keys=False)))
+            self.assertEqual([b'u1:4', b'u1:3'],
+                             list(view.scan(history, prefix=b'u1:',
+                                            reverse=True, limit=2,
+                                            values=False)))
+            self.assertTrue(view.exists(b'testdb3', b'u2:0'))
+            cur = view.cursor(b'testdb3')
+            self.assertTrue(cur.first())
+            self.assertEqual(b'u1:0', cur.key())
+            self.assertRaises(DataNotFoundError, view.get, b'nosuch', b'k')
+        self.assertEqual(b'bob', users.get(b'u1'))
+
+        with self.engine.snapshot() as view:
+            self.assertEqual(b'bob', bytes(view.get(users, b'u1')))
+
+    def test_map_reduce(self):
+        store = self.engine.create_store("testdb2")
+        store.put_many((b'k%05d' % i, b'type%d' % (i % 3)) for i in range(3000))
+
+        def count_types(records):
+            counts = Counter()
+            for _, value in records:
+                counts[value] += 1
+            return counts
+
+        def add(a, b):
+            return a + b
+
+        expected = Counter({b'type0': 1000, b'type1': 1000, b'type2': 1000})
+        self.assertEqual(expected, self.engine.map_reduce(
+            b'testdb2', count_types, add))
+        self.assertEqual(expected, self.engine.map_reduce(
+            b'testdb2', count_types, add, partitions=1))
+
+        def count(records):
+            return sum(1 for _ in records)
+        self.assertEqual(3000, self.engine.map_reduce(
+            b'testdb2', count, add, initial=0, partitions=7, values=False))
+
+        with self.engine.database.begin() as txn:
+            ranges = split_ranges(txn, store._db, 8)
+        self.assertTrue(1 < len(ranges) <= 8)
+        self.assertEqual(b'k00000', ranges[0][0])
+        self.assertIsNone(ranges[-1][1])
+        for (_, stop), (start, _) in zip(ranges, ranges[1:]):
+            self.assertEqual(stop, start)
+
+        self.engine.enable_expiry(b'testdb2')
+        with self.engine.batch() as batch:
+            batch.put(b'testdb2', b'k00000', b'type0', -1)
+        self.assertEqual(2999, self.engine.map_reduce(
+            b'testdb2', count, add, initial=0))
+
+        store.remove_range()
+        self.assertEqual(0, self.engine.map_reduce(
+            b'testdb2', count, add, initial=0))
+        self.assertRaises(DataNotFoundError, self.engine.map_reduce,
+                          b'nosuch', count, add)
+
+    def test_range_aggregates(self):
+        store = self.engine.create_store("testdb2")
+        self.assertEqual(0, store.count())
+        self.assertEqual(0, store.approx_count(prefix=b'k'))
+        self.assertIsNone(store.first_key())
+        self.assertIsNone(store.last_key())
+
+        store.put_many((b'k%05d' % i, b'v') for i in range(5000))
+        self.assertEqual(5000, store.count())
+        self.assertEqual(1000, store.count(b'k01000', b'k02000'))
+        self.assertEqual(100, store.count(prefix=b'k012'))
+        self.assertEqual(0, store.count(b'k02000', b'k01000'))
+        self.assertEqual(5000, store.approx_count())
+        estimate = store.approx_count(b'k01000', b'k02000')
+        self.assertTrue(500 < estimate < 2000, estimate)
+        self.assertEqual(0, store.approx_count(b'z'))
+
+        self.assertEqual(b'k00000', store.first_key())
+        self.assertEqual(b'k04999', store.last_key())
+        self.assertEqual(b'k01000', store.first_key(start=b'k00999x'))
+        self.assertEqual(b'k01999', store.last_key(stop=b'k02000'))
+        self.assertEqual(b'k01200', store.first_key(prefix=b'k012'))
+        self.assertEqual(b'k01299', store.last_key(prefix=b'k012'))
+        self.assertIsNone(store.first_key(b'k01000', b'k01000'))
+        self.assertIsNone(store.last_key(prefix=b'x'))
+
+        self.engine.offload_enabled = True
+        self.engine.offload_threshold = 100
+        self.addCleanup(setattr, self.engine, 'offload_enabled', False)
+        self.assertEqual(1000, store.count(b'k01000', b'k02000'))
+
+        self.engine.enable_expiry(b'testdb2')
+        with self.engine.batch() as batch:
+            batch.put(b'testdb2', b'k00000', b'v', -1)
+            batch.put(b'testdb2', b'k04999', b'v', -1)
+        self.assertEqual(4998, store.count())
+        self.assertEqual(b'k00001', store.first_key())
+        self.assertEqual(b'k04998', store.last_key())
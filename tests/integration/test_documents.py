@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+
+import unittest
+
+from msgpack import unpackb
+from ava.spi.context import Context
+from ava.spi.models import Model
+from ava.spi.documents import Document, DocumentStore
+from ava.core.data import DataEngine
+
+
+class DocumentTest(unittest.TestCase):
+
+    def test_pack_and_unpack(self):
+        doc = Document(name='test', tags=['a', 'b'], size=3)
+        doc2 = Document.unpack(doc.pack())
+
+        self.assertEqual(3, len(doc2))
+        self.assertTrue('name' in doc2)
+        self.assertEqual(set(['name', 'tags', 'size']), set(doc2))
+        self.assertEqual('test', doc2['name'])
+        self.assertEqual(['a', 'b'], doc2['tags'])
+        self.assertEqual(3, doc2.as_dict()['size'])
+
+    def test_decode_lazily(self):
+        doc = Document.unpack(Document(name='test', size=3).pack())
+        self.assertEqual({}, doc.store)
+
+        self.assertEqual(3, doc['size'])
+        self.assertEqual(['size'], list(doc.store.keys()))
+
+    def test_untouched_fields_are_copied(self):
+        packed = Document(name='test', size=3).pack()
+        doc = Document.unpack(packed)
+        doc['size'] = 4
+        del doc['name']
+
+        fields = unpackb(doc.pack())
+        self.assertEqual(['size'], list(fields.keys()))
+
+        doc = Document.unpack(packed)
+        doc['size'] = 4
+        self.assertEqual(unpackb(packed)['name'], unpackb(doc.pack())['name'])
+
+    def test_fields_modified_in_place(self):
+        doc = Document.unpack(Document(tags=['a'], size=3).pack())
+        doc['tags'].append('b')
+
+        doc = Document.unpack(doc.pack())
+        self.assertEqual(['a', 'b'], doc['tags'])
+        self.assertEqual(3, doc['size'])
+        self.assertEqual(2, len(doc))
+        self.assertEqual({'tags': ['a', 'b'], 'size': 3}, doc.as_dict())
+
+    def test_text_and_bytes(self):
+        doc = Document(name='caf\xe9', data=b'\xff\x00')
+        doc = Document.unpack(doc.pack())
+
+        self.assertEqual('caf\xe9', doc['name'])
+        self.assertIsInstance(doc['name'], type(''))
+        self.assertEqual(b'\xff\x00', doc['data'])
+        self.assertIsInstance(doc['data'], bytes)
+
+
+class DocumentStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = DataEngine()
+        self.ctx = Context(None)
+        self.ctx.bind('dataengine', self.engine)
+        self.engine.start(self.ctx)
+        self.engine.remove_all_stores()
+        self.docs = DocumentStore(self.engine.create_store('docs'))
+
+    def tearDown(self):
+        self.engine.remove_all_stores()
+        self.engine.stop(self.ctx)
+
+    def test_crud(self):
+        self.docs.put('d1', Model(name='test', size=1))
+        self.docs.put('d2', {'name': 'test2', 'size': 2})
+
+        doc = self.docs.get('d1')
+        self.assertIsInstance(doc, Document)
+        self.assertEqual('test', doc['name'])
+
+        doc = self.docs.update('d2', size=3)
+        self.assertEqual(3, self.docs.get('d2')['size'])
+        self.assertEqual('test2', self.docs.get('d2')['name'])
+        self.assertIsNone(self.docs.update('d3', size=3))
+
+        self.assertEqual(['d1', 'd2'], [k for k, _ in self.docs.scan()])
+
+        self.assertTrue(self.docs.remove('d1'))
+        self.assertIsNone(self.docs.get('d1'))
+
+    def test_find_by_field(self):
+        self.docs.put('d1', Model(owner='alice'))
+        self.docs.put('d2', Model(owner='bob'))
+        self.docs.create_index('by_owner', 'owner')
+        self.docs.put('d3', Model(owner='alice'))
+
+        found = [k for k, _ in self.docs.find('by_owner', 'alice')]
+        self.assertEqual(['d1', 'd3'], found)
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+import unittest
+import mock
+import gevent
+
+from ava.spi.context import Context
+from ava.spi.signals import AGENT_STARTED, AGENT_STOPPING
+from ava.spi.errors import DataError
+from ava.core.task import TaskEngine
+from tests.bases import TempPod
+
+
+class TestDurability(unittest.TestCase):
+
+    def setUp(self):
+        self.pod = TempPod(placement={'placed': 'cache'},
+                           shards={'sharded': 2})
+        self.addCleanup(self.pod.remove)
+        self.ctx = Context(None)
+        self.engine = self._start_engine(
+            mode='sync', flush_interval=0.01,
+            environments={'cache': 'nosync', 'shard-1': 'nometasync'})
+
+    def _start_engine(self, **durability):
+        return self.pod.start_engine(self.ctx, durability=durability)
+
+    def tearDown(self):
+        self.engine.stop(self.ctx)
+
+    def test_modes(self):
+        self.engine.create_store(b'placed').put(b'k', b'v')
+        self.engine.get_store(b'sharded').put(b'k', b'v')
+        environments = self.engine.environments
+
+        flags = self.engine.database.flags()
+        self.assertTrue(flags['sync'] and flags['metasync'])
+        flags = environments[b'cache'].flags()
+        self.assertFalse(flags['sync'])
+        flags = environments[b'shard-0'].flags()
+        self.assertTrue(flags['sync'] and flags['metasync'])
+        flags = environments[b'shard-1'].flags()
+        self.assertTrue(flags['sync'])
+        self.assertFalse(flags['metasync'])
+
+        self.assertEqual(2, self.engine.flush())
+        self.assertEqual(b'v', self.engine.get_store(b'placed').get(b'k'))
+
+    def test_unknown_mode(self):
+        self.engine.stop(self.ctx)
+        self.assertRaises(DataError, self._start_engine, mode='sometimes')
+        self.engine = self._start_engine()
+        self.assertEqual(0, self.engine.flush())
+
+    def test_flushed_periodically_and_when_stopping(self):
+        self.engine.create_store(b'placed')
+        env = self.engine.environments[b'cache']
+        spy = mock.Mock(wraps=env)
+        self.engine._lazy_envs[:] = [spy]
+
+        taskengine = TaskEngine()
+        taskengine.start(self.ctx)
+        self.addCleanup(taskengine.stop, self.ctx)
+        self.addCleanup(self.ctx.unbind, 'taskengine')
+        self.ctx.send(signal=AGENT_STARTED, sender=self)
+        gevent.sleep(0.05)
+        self.assertTrue(spy.sync.called)
+
+        self.engine._flusher.kill()
+        spy.reset_mock()
+        self.ctx.send(signal=AGENT_STOPPING, sender=self)
+        spy.sync.assert_called_once_with(True)
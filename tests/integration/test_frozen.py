@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+import io
+import os
+import unittest
+
+from ava.spi.context import Context
+from ava.spi.errors import DataError
+from ava.core.data.frozen import FrozenStore, build
+from tests.bases import TempPod
+
+
+class TestFrozenStore(unittest.TestCase):
+
+    def setUp(self):
+        self.pod = TempPod(frozen={'geo': 'tables/geo.tbl'})
+        self.addCleanup(self.pod.remove)
+        self.pod_dir = self.pod.pod_dir
+        self.ctx = Context(None)
+        self.engine = self.pod.start_engine(self.ctx)
+        self.items = [(b'key%03d' % i, b'value%d' % i) for i in range(100)]
+
+    def tearDown(self):
+        self.engine.stop(self.ctx)
+
+    def test_lookup(self):
+        store = self.engine.build_frozen(b'lookup', iter(self.items))
+        self.assertIsInstance(store, FrozenStore)
+        self.assertIs(store, self.engine.get_store(b'lookup'))
+        self.assertEqual(100, len(store))
+        self.assertEqual(b'value42', store.get(b'key042'))
+        self.assertEqual(b'value0', store[u'key000'])
+        self.assertIsNone(store.get(b'key0425'))
+        self.assertIsNone(store.get(b'a'))
+        self.assertIsNone(store.get(b'z'))
+
+        self.assertRaises(DataError, store.put, b'k', b'v')
+        self.assertRaises(DataError, store.remove, b'key000')
+        self.assertRaises(DataError, store.create_index, b'i', lambda v: v)
+        self.assertRaises(DataError, self.engine.create_store, b'lookup')
+        with self.engine.batch() as batch:
+            self.assertRaises(DataError, batch.put, b'lookup', b'k', b'v')
+
+    def test_scan(self):
+        store = self.engine.build_frozen(b'lookup', self.items)
+        self.assertEqual(self.items, list(store.scan()))
+        self.assertEqual(self.items[::-1], list(store.scan(reverse=True)))
+        self.assertEqual(self.items[10:20],
+                         list(store.scan(start=b'key010', stop=b'key020')))
+        self.assertEqual([k for k, _ in self.items[50:60]],
+                         list(store.scan(prefix=b'key05', values=False)))
+        self.assertEqual([v for _, v in self.items[59:49:-1]],
+                         list(store.scan(prefix=b'key05', reverse=True,
+                                         keys=False)))
+        self.assertEqual(self.items[:3], list(store.scan(limit=3)))
+        self.assertEqual(self.items[-1:-4:-1],
+                         list(store.scan(reverse=True, limit=3)))
+        self.assertEqual([], list(store.scan(start=b'key050',
+                                             stop=b'key040')))
+        self.assertEqual([], list(store.scan(prefix=b'nokey')))
+
+    def test_range_aggregates(self):
+        store = self.engine.build_frozen(b'lookup', self.items)
+        self.assertEqual(100, store.count())
+        self.assertEqual(10, store.count(prefix=b'key05'))
+        self.assertEqual(10, store.approx_count(b'key010', b'key020'))
+        self.assertEqual(0, store.count(b'key050', b'key040'))
+        self.assertEqual(b'key000', store.first_key())
+        self.assertEqual(b'key099', store.last_key())
+        self.assertEqual(b'key011', store.first_key(start=b'key0105'))
+        self.assertEqual(b'key059', store.last_key(prefix=b'key05'))
+        self.assertIsNone(store.first_key(prefix=b'nokey'))
+        self.assertIsNone(store.last_key(stop=b'a'))
+
+    def test_cursor(self):
+        store = self.engine.build_frozen(b'lookup', self.items)
+        with self.engine.cursor(b'lookup') as cur:
+            self.assertTrue(cur.first())
+            self.assertEqual(b'key000', cur.key())
+            self.assertTrue(cur.next())
+            self.assertEqual(b'value1', cur.value())
+            self.assertTrue(cur.last())
+            self.assertFalse(cur.next())
+            self.assertTrue(cur.seek(b'key010'))
+            self.assertFalse(cur.seek(b'key0105'))
+            self.assertTrue(cur.seek_range(b'key0105'))
+            self.assertEqual(b'key011', cur.key())
+            self.assertTrue(cur.prev())
+            self.assertEqual(b'key010', cur.key())
+            self.assertEqual([b'key010', b'key009'],
+                             list(cur.iterprev())[:2])
+            self.assertTrue(cur.exists(b'key099'))
+            self.assertRaises(DataError, cur.put, b'k', b'v')
+        self.assertRaises(DataError, store.cursor, readonly=False)
+
+    def test_not_transferred(self):
+        self.engine.build_frozen(b'lookup', self.items)
+        self.engine.create_store(b'plain').put(b'k', b'v')
+
+        out = io.BytesIO()
+        self.assertEqual(1, self.engine.export_stores(out))
+        self.assertRaises(DataError, self.engine.export_stores, io.BytesIO(),
+                          [b'lookup'])
+
+        self.engine.remove_store(b'plain')
+        self.engine.import_stores(io.BytesIO(out.getvalue()))
+        self.assertEqual(b'v', self.engine.get_store(b'plain').get(b'k'))
+
+        # a dump of a store which is frozen here.
+        out = io.BytesIO()
+        self.engine.create_store(b'others').put(b'k', b'v')
+        self.engine.export_stores(out, [b'others'])
+        dump = out.getvalue().replace(b'others', b'lookup')
+        self.assertRaises(DataError, self.engine.import_stores,
+                          io.BytesIO(dump))
+        self.assertEqual(100, len(self.engine.get_store(b'lookup')))
+
+    def test_build(self):
+        path = os.path.join(self.pod_dir, 'data', 'frozen', 'bad.tbl')
+        self.assertRaises(DataError, build, path,
+                          [(b'b', b'1'), (b'a', b'2')])
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual([], os.listdir(os.path.dirname(path)))
+
+        self.assertEqual(0, build(path, []))
+        store = self.engine.open_frozen(b'bad')
+        self.assertEqual(0, len(store))
+        self.assertEqual([], list(store.scan()))
+        self.assertIsNone(store.get(b'a'))
+
+    def test_swap(self):
+        store = self.engine.build_frozen(b'lookup', self.items)
+        cur = store.cursor()
+        self.assertTrue(cur.first())
+
+        path = store.path
+        build(path, [(b'new', b'version')])
+        # the store keeps serving the old table until it's reloaded.
+        self.assertEqual(b'value1', store.get(b'key001'))
+        self.engine.housekeep()
+        self.assertEqual(1, len(store))
+        self.assertEqual(b'version', store.get(b'new'))
+        self.assertIsNone(store.get(b'key001'))
+        # a cursor keeps the table it was opened on.
+        self.assertTrue(cur.next())
+        self.assertEqual(b'key001', cur.key())
+        cur.close()
+
+        store = self.engine.build_frozen(b'lookup', self.items[:5])
+        self.assertEqual(5, len(store))
+
+    def test_configured_path(self):
+        self.assertIsNone(self.engine.get_store(b'geo', create=False))
+        path = os.path.join(self.pod_dir, 'data', 'tables', 'geo.tbl')
+        self.engine.build_frozen(b'geo', self.items)
+        self.assertTrue(os.path.exists(path))
+
+        self.engine.stop(self.ctx)
+        self.engine = self.pod.start_engine(self.ctx)
+        store = self.engine.get_store(b'geo', create=False)
+        self.assertIsInstance(store, FrozenStore)
+        self.assertEqual(b'value7', store.get(b'key007'))
+
+    def test_reopened_after_restart(self):
+        self.engine.build_frozen(b'lookup', self.items)
+        self.engine.build_frozen(b'gone', self.items)
+        self.engine.remove_store(b'gone')
+
+        self.engine.stop(self.ctx)
+        self.engine = self.pod.start_engine(self.ctx)
+        store = self.engine.get_store(b'lookup', create=False)
+        self.assertIsInstance(store, FrozenStore)
+        self.assertEqual(b'value7', store.get(b'key007'))
+        self.assertIsNone(self.engine.get_store(b'gone', create=False))
+
+    def test_backup(self):
+        self.engine.build_frozen(b'lookup', self.items)
+        self.engine.build_frozen(b'geo', self.items[:5])
+        self.engine.create_store(b'plain').put(b'k', b'v')
+
+        backup_dir = os.path.join(self.pod_dir, 'backup')
+        self.assertTrue(self.engine.backup(backup_dir) > 0)
+        self.assertTrue(os.path.isfile(os.path.join(backup_dir, 'data.mdb')))
+
+        # the backup is restored as the data path.
+        self.engine.stop(self.ctx)
+        restored = TempPod(frozen={'geo': 'tables/geo.tbl'})
+        self.addCleanup(restored.remove)
+        os.rmdir(os.path.join(restored.pod_dir, 'data'))
+        os.rename(backup_dir, os.path.join(restored.pod_dir, 'data'))
+        self.engine = restored.start_engine(self.ctx)
+        self.assertEqual(100, len(self.engine.get_store(b'lookup')))
+        self.assertEqual(5, len(self.engine.get_store(b'geo')))
+        self.assertEqual(b'v', self.engine.get_store(b'plain').get(b'k'))
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+
+import time
+import unittest
+import gevent
+
+from ava.spi.context import Context
+from ava.spi.errors import DataError
+from ava.core.data import DataEngine
+
+
+class QueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = DataEngine()
+        self.ctx = Context(None)
+        self.ctx.bind('dataengine', self.engine)
+        self.engine.start(self.ctx)
+        self.queue = self.engine.get_queue('jobs')
+
+    def tearDown(self):
+        self.engine.remove_queue('jobs')
+        self.engine.stop(self.ctx)
+
+    def test_put_and_get_in_order(self):
+        self.assertIs(self.queue, self.engine.get_queue('jobs'))
+        self.queue.put('v1')
+        self.queue.put_many(['v2', 'v3'])
+        self.assertEqual(3, len(self.queue))
+
+        values = [self.queue.get(timeout=0).value for _ in range(3)]
+        self.assertEqual(['v1', 'v2', 'v3'], values)
+        self.assertIsNone(self.queue.get(timeout=0))
+
+    def test_blocking_get(self):
+        def producer():
+            gevent.sleep(0.05)
+            self.queue.put('v1')
+
+        gevent.spawn(producer)
+        t0 = time.time()
+        msg = self.queue.get(timeout=5)
+        self.assertEqual('v1', msg.value)
+        self.assertLess(time.time() - t0, 1)
+
+        t0 = time.time()
+        self.assertIsNone(self.queue.get(timeout=0.05))
+        self.assertGreaterEqual(time.time() - t0, 0.05)
+
+    def test_get_batch(self):
+        self.queue.put_many(['v%d' % i for i in range(5)])
+        messages = self.queue.get_batch(3, timeout=0)
+        self.assertEqual(['v0', 'v1', 'v2'], [m.value for m in messages])
+        self.assertEqual(2, len(self.queue.get_batch(3, timeout=0)))
+        self.assertEqual([], self.queue.get_batch(3, timeout=0))
+
+        # like get(), it waits for a message by default.
+        gevent.spawn_later(0.05, self.queue.put, 'v5')
+        self.assertEqual(['v5'], [m.value for m in self.queue.get_batch(3)])
+
+    def test_ack_and_nack(self):
+        self.queue.put_many(['v1', 'v2'])
+        msg1 = self.queue.get(timeout=0)
+        msg2 = self.queue.get(timeout=0)
+
+        self.assertTrue(self.queue.ack(msg1))
+        self.assertFalse(self.queue.ack(msg1))
+
+        self.assertTrue(self.queue.nack(msg2))
+        self.assertRaises(DataError, self.queue.ack, b'')
+        self.assertRaises(DataError, self.queue.nack, b'')
+        self.queue.put('v3')
+        self.assertEqual('v2', self.queue.get(timeout=0).value)
+
+        stats = self.queue.stats()
+        self.assertEqual(1, stats['ready'])
+        self.assertEqual(1, stats['inflight'])
+        self.assertEqual(3, stats['puts'])
+        self.assertEqual(1, stats['acks'])
+        self.assertEqual(1, stats['nacks'])
+
+    def test_visibility_timeout(self):
+        self.queue.put('v1')
+        msg = self.queue.get(timeout=0, visibility_timeout=0.05)
+
+        # the blocked consumer wakes up when the delivery expires.
+        msg2 = self.queue.get(timeout=5)
+        self.assertEqual(msg.key, msg2.key)
+        self.assertFalse(self.queue.ack(msg))
+        self.assertTrue(self.queue.ack(msg2))
+        self.assertEqual(1, self.queue.stats()['redeliveries'])
+
+    def test_reopen(self):
+        self.queue.put_many(['v1', 'v2'])
+        self.queue.get(timeout=0)
+        self.engine.stop(self.ctx)
+
+        self.engine = DataEngine()
+        self.engine.start(self.ctx)
+        self.queue = self.engine.get_queue('jobs')
+        key = self.queue.put('v3')
+        self.assertEqual(b'\x00' * 7 + b'\x03', key)
+        self.assertEqual(['v2', 'v3'],
+                         [m.value for m in self.queue.get_batch(5)])
+
+    def test_put_out_of_order_refused(self):
+        # as if another process had put a message behind this one's back.
+        self.engine.write(lambda txn: txn.put(b'\x00' * 7 + b'\x09', 'v9',
+                                              db=self.queue._ready_db))
+
+        self.assertRaises(DataError, self.queue.put_many, ['v1', 'v2'])
+        self.assertEqual(1, len(self.queue))
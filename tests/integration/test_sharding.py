@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+import os
+import unittest
+import lmdb
+
+from ava.spi.context import Context
+from ava.spi.errors import DataError
+from ava.core.data.backup import environment_names
+from ava.core.data.sharding import ShardedStore, shard_of
+from tests.bases import TempPod
+
+
+class TestSharding(unittest.TestCase):
+
+    def setUp(self):
+        self.pod = TempPod(placement={'placed': 'test-env'},
+                           shards={'sharded': 4})
+        self.addCleanup(self.pod.remove)
+        self.ctx = Context(None)
+        self.engine = self.pod.start_engine(self.ctx)
+
+    def tearDown(self):
+        self.engine.stop(self.ctx)
+
+    def test_placement(self):
+        store = self.engine.create_store(b'placed')
+        plain = self.engine.create_store(b'plain')
+        self.assertIs(self.engine.environments[b'test-env'], store._env)
+        self.assertIs(self.engine.database, plain._env)
+
+        store.put(b'k1', b'v1')
+        self.assertEqual(b'v1', store.get(b'k1'))
+        with self.engine.cursor(b'placed') as cur:
+            self.assertEqual(b'v1', cur.get(b'k1'))
+        with self.engine.database.begin() as txn:
+            self.assertIsNone(txn.get(b'placed'))
+
+        with self.engine.batch() as batch:
+            batch.put(b'placed', b'k2', b'v2')
+            self.assertRaises(DataError, batch.put, b'plain', b'k2', b'v2')
+        self.assertEqual(b'v2', store.get(b'k2'))
+
+        self.engine.get_store(b'sharded')
+        with self.engine.snapshot(buffers=False) as view:
+            self.assertEqual(b'v2', view.get(b'placed', b'k2'))
+            self.assertRaises(DataError, view.get, b'plain', b'k2')
+            self.assertRaises(DataError, view.get, b'sharded', b'k2')
+
+    def test_sharded_crud(self):
+        store = self.engine.get_store(b'sharded')
+        self.assertIsInstance(store, ShardedStore)
+        self.assertEqual(4, len(store.shards))
+
+        keys = [b'key%03d' % i for i in range(100)]
+        for key in keys:
+            self.assertTrue(store.put(key, key.upper()))
+        self.assertEqual(100, len(store))
+        self.assertEqual(b'KEY042', store.get(b'key042'))
+        for i, shard in enumerate(store.shards):
+            self.assertTrue(len(shard) > 0)
+            for key in shard.scan(values=False):
+                self.assertEqual(i, shard_of(key, 4))
+
+        self.assertTrue(store.remove(b'key042'))
+        self.assertIsNone(store.get(b'key042'))
+        self.assertRaises(DataError, store.create_index, b'idx', lambda v: v)
+
+    def test_sharded_scan(self):
+        store = self.engine.get_store(b'sharded')
+        keys = [b'key%03d' % i for i in range(100)]
+        store.put_many((key, key) for key in reversed(keys))
+
+        self.assertEqual(keys, list(store.scan(values=False)))
+        self.assertEqual(keys[::-1], list(store.scan(reverse=True,
+                                                     values=False)))
+        self.assertEqual(keys[10:15], list(store.scan(start=b'key010',
+                                                      limit=5,
+                                                      values=False)))
+        self.assertEqual(keys[20:30], list(store.scan(prefix=b'key02',
+                                                      keys=False)))
+        self.assertEqual(10, store.remove_range(prefix=b'key05'))
+        self.assertEqual(90, len(store))
+
+    def test_sharded_scan_of_keys(self):
+        store = self.engine.get_store(b'sharded')
+        store.put_many((b'key%03d' % i, b'value') for i in range(20))
+        calls = []
+        for shard in store.shards:
+            scan = shard.scan
+
+            def recording_scan(*args, **kwargs):
+                calls.append(kwargs.get('values', True))
+                return scan(*args, **kwargs)
+            shard.scan = recording_scan
+
+        self.assertEqual(20, len(list(store.scan(values=False))))
+        self.assertEqual([False] * 4, calls)
+
+    def test_sharded_timeseries(self):
+        series = self.engine.get_timeseries(b'sharded')
+        uids = series.append_many([b'v1', b'v2', b'v3'])
+        self.assertEqual(3, len(uids))
+        self.assertEqual(3, len(set(uids)))
+        self.assertEqual(sorted(uids), [uid for uid, _ in series.range()])
+
+    def test_sharded_put_many(self):
+        self.engine.offload_enabled = True
+        self.engine.offload_threshold = 10
+        self.addCleanup(setattr, self.engine, 'offload_enabled', False)
+        store = self.engine.get_store(b'sharded')
+
+        items = [(b'k%04d' % i, b'v%d' % i) for i in range(200)]
+        self.assertEqual([True] * 200, store.put_many(items))
+        self.assertEqual(items, list(store.scan()))
+        results = store.remove_many([b'k0001', b'missing', b'k0002'])
+        self.assertEqual([True, False, True], results)
+        self.assertEqual(198, len(store))
+
+    def test_sharded_group_commit(self):
+        self.engine.enable_group_commit(max_delay=0.01)
+        store = self.engine.get_store(b'sharded')
+        plain = self.engine.get_store(b'plain')
+        for i in range(20):
+            store.put(b'k%02d' % i, b'v')
+            plain.put(b'k%02d' % i, b'v')
+        self.assertEqual(20, len(store))
+        self.assertEqual(20, len(plain))
+        self.engine.disable_group_commit()
+
+    def test_reopen(self):
+        self.engine.get_store(b'sharded').put(b'k1', b'v1')
+        self.engine.create_store(b'placed').put(b'k2', b'v2')
+        self.engine.stop(self.ctx)
+
+        self.engine = self.pod.start_engine(self.ctx)
+        store = self.engine.get_store(b'sharded', create=False)
+        self.assertIsInstance(store, ShardedStore)
+        self.assertEqual(b'v1', store.get(b'k1'))
+        store = self.engine.get_store(b'placed', create=False)
+        self.assertEqual(b'v2', store.get(b'k2'))
+        self.assertEqual([b'shard-0', b'shard-1', b'shard-2', b'shard-3',
+                          b'test-env'], sorted(self.engine.environments))
+
+    def test_sharded_counters(self):
+        store = self.engine.get_store(b'sharded')
+        deltas = [(b'c%02d' % i, i) for i in range(20)]
+        self.assertEqual(range(20), store.incr_many(deltas))
+        self.assertEqual(range(0, 40, 2), store.incr_many(deltas))
+        self.assertEqual(39, store.incr(b'c19', 1))
+        self.assertTrue(store.compare_and_swap(b'c00', b'0', b'1'))
+        self.assertEqual(b'1', store.get(b'c00'))
+
+    def test_sharded_map_reduce(self):
+        store = self.engine.get_store(b'sharded')
+        store.put_many((b'k%04d' % i, b'%d' % i) for i in range(500))
+
+        def total(records):
+            return sum(int(value) for _, value in records)
+        self.assertEqual(sum(range(500)), self.engine.map_reduce(
+            b'sharded', total, lambda a, b: a + b, partitions=8))
+
+    def test_sharded_range_aggregates(self):
+        store = self.engine.get_store(b'sharded')
+        store.put_many((b'k%04d' % i, b'v') for i in range(1000))
+        self.assertEqual(1000, store.count())
+        self.assertEqual(100, store.count(prefix=b'k01'))
+        self.assertTrue(0 < store.approx_count(b'k0100', b'k0600') < 1000)
+        self.assertEqual(b'k0000', store.first_key())
+        self.assertEqual(b'k0999', store.last_key())
+        self.assertEqual(b'k0199', store.last_key(prefix=b'k01'))
+        self.assertIsNone(store.first_key(prefix=b'x'))
+
+    def test_backup(self):
+        self.engine.get_store(b'sharded').put_many(
+            (b'k%02d' % i, b'v') for i in range(20))
+        self.engine.create_store(b'placed').put(b'k', b'v')
+        self.engine.create_store(b'plain').put(b'k', b'v')
+
+        backup_dir = os.path.join(self.pod.pod_dir, 'backup')
+        self.assertTrue(self.engine.backup(backup_dir) > 0)
+        self.assertEqual([b'shard-0', b'shard-1', b'shard-2', b'shard-3',
+                          b'test-env'], environment_names(backup_dir))
+
+        count = 0
+        for name in [b''] + environment_names(backup_dir):
+            env = lmdb.Environment(os.path.join(backup_dir, name),
+                                   readonly=True, max_dbs=8, lock=False)
+            try:
+                for store_name in (b'sharded', b'placed', b'plain'):
+                    with env.begin() as txn:
+                        if txn.get(store_name) is None:
+                            continue
+                    _db = env.open_db(store_name, create=False)
+                    with env.begin() as txn:
+                        count += txn.stat(_db)['entries']
+            finally:
+                env.close()
+        self.assertEqual(22, count)
+
+        self.assertRaises(DataError, self.engine.backup_stream)
+        chunks = list(self.engine.backup_stream(environment=b'test-env'))
+        self.assertTrue(chunks)
+
+    def test_change_log_refused(self):
+        self.assertRaises(DataError, self.engine.enable_change_log)
+        self.assertIsNone(self.engine.changes)
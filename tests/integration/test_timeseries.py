@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+
+import time
+import datetime
+import unittest
+
+from ava.spi.context import Context
+from ava.core.data import DataEngine
+from tests.bases import TempPod
+
+
+class TimeSeriesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = DataEngine()
+        self.ctx = Context(None)
+        self.ctx.bind('dataengine', self.engine)
+        self.engine.start(self.ctx)
+        self.series = self.engine.get_timeseries('metrics')
+
+    def tearDown(self):
+        self.engine.remove_store(b'metrics')
+        self.engine.stop(self.ctx)
+
+    def test_range(self):
+        now = time.time()
+        for i in range(10):
+            self.series.append(b'v%d' % i, timestamp=now - 100 + i * 10)
+        self.assertIs(self.series, self.engine.get_timeseries('metrics'))
+        self.assertEqual(10, len(self.series))
+
+        values = [v for _, v in self.series.range(start=now - 50)]
+        self.assertEqual([b'v5', b'v6', b'v7', b'v8', b'v9'], values)
+        values = [v for _, v in self.series.range(start=now - 50,
+                                                  stop=now - 30)]
+        self.assertEqual([b'v5', b'v6'], values)
+
+        start = datetime.datetime.utcfromtimestamp(now - 100)
+        uid, value = next(self.series.range(start=start))
+        self.assertEqual(b'v0', value)
+        self.assertAlmostEqual(now - 100, uid.get_timestamp(), places=3)
+
+        self.assertEqual([b'v9', b'v8'],
+                         [v for _, v in self.series.latest(2)])
+
+    def test_append_now(self):
+        uids = self.series.append_many([b'v1', b'v2'])
+        uids.append(self.series.append(b'v3'))
+        self.assertEqual(uids, [uid for uid, _ in self.series.range()])
+
+    def test_append_at_same_time(self):
+        now = time.time()
+        uids = set(self.series.append(b'v%d' % i, timestamp=now)
+                   for i in range(500))
+        self.assertEqual(500, len(uids))
+        self.assertEqual(500, len(self.series))
+
+        uids = self.series.append_many([b'v'] * 500)
+        self.assertEqual(500, len(set(uids)))
+        self.assertEqual(1000, len(self.series))
+
+    def test_retention(self):
+        now = time.time()
+        for i in range(10):
+            self.series.append(b'v', timestamp=now - i * 60)
+        self.assertEqual(4, self.series.truncate(now - 330))
+        self.assertEqual(6, len(self.series))
+
+        self.engine.get_timeseries('metrics', retention=150)
+        self.engine.housekeep()
+        self.assertEqual(3, len(self.series))
+
+    def test_retention_from_config(self):
+        pod = TempPod()
+        self.addCleanup(pod.remove)
+        engine = pod.start_engine()
+        now = time.time()
+        series = engine.get_timeseries('events')
+        for i in range(10):
+            series.append(b'v', timestamp=now - i * 60)
+        engine.stop()
+
+        engine = pod.start_engine(retention={'events': 150})
+        self.addCleanup(engine.stop)
+        engine.housekeep()
+        self.assertEqual(3, len(engine.get_store('events')))
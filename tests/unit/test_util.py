@@ -23,6 +23,15 @@ class UtilTest(unittest.TestCase):
             self.assertTrue(now > prev)
             prev = now
 
+    def test_time_uuid_sortable_bytes(self):
+        prev = time_uuid.utcnow()
+        for i in xrange(1000):
+            now = time_uuid.utcnow()
+            self.assertEqual(16, len(now.sortable_bytes))
+            self.assertTrue(now.sortable_bytes > prev.sortable_bytes)
+            self.assertEqual(now, time_uuid.TimeUUID.from_sortable_bytes(
+                now.sortable_bytes))
+            prev = now
 
     def test_parse_authorization_header(self):
         result = webutils.parse_authorization_header('EAvatar key="1234",realm="http://eavatar.me", token="abcd"')